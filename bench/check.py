@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Check for performance regressions against a stored baseline.
+
+Runs a fixed workload (see bench.run: import WORKLOAD games, score them, and
+write WORKLOAD player pages and the global pages) and compares these against
+bench/baseline.json:
+
+- add_game: seconds and queries per game imported
+- score_game: seconds and queries per game scored
+- render_player_page: seconds and queries per player page written
+- global_pages: seconds and queries to write the index, streaks and
+  highscores pages
+- peak_rss_kb: the process's peak memory use
+
+A metric fails if it's more than its tolerance (a fraction, by kind of
+metric) above the baseline. Query counts are deterministic, so their
+tolerance is small; wall time varies between machines and runs, so its
+tolerance is large. After an intended change, or on a new machine, write a
+new baseline with --update and commit it.
+
+Usage: python -m bench.check [--baseline FILE] [--update] (or make bench-check)
+"""
+
+import io
+import os
+import sys
+import json
+import argparse
+import tempfile
+import contextlib
+import collections
+
+import scoreboard.querycount as querycount
+
+from bench import run
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# Changing these invalidates the baseline
+WORKLOAD = collections.OrderedDict([("games", 2000), ("player_pages", 100), ("seed", 0)])
+# Largest allowed increase over the baseline, as a fraction, by kind
+TOLERANCES = collections.OrderedDict(
+    [("seconds", 0.5), ("queries", 0.1), ("peak_rss_kb", 0.25)]
+)
+GLOBAL_STAGES = ("index", "404", "streaks", "highscores")
+
+
+def measure() -> collections.OrderedDict:
+    """Run the workload and return its metrics."""
+    querycount.ENABLED = True
+    with tempfile.TemporaryDirectory() as tmp:
+        # The pipeline prints a lot
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = run.run(
+                WORKLOAD["games"],
+                WORKLOAD["seed"],
+                "sqlite:///" + os.path.join(tmp, "bench.db3"),
+                os.path.join(tmp, "website"),
+                WORKLOAD["player_pages"],
+            )
+    stages = results["stages"]
+    queries = querycount.counter.stages
+    units = querycount.counter.units
+    games = results["games"]
+    pages = units["page"].units
+    return collections.OrderedDict(
+        [
+            ("add_game.seconds", stages["import"] / games),
+            ("add_game.queries", queries["import"].count / games),
+            ("score_game.seconds", stages["score"] / games),
+            ("score_game.queries", units["game"].queries / units["game"].units),
+            ("render_player_page.seconds", stages["website.player_pages"] / pages),
+            ("render_player_page.queries", units["page"].queries / pages),
+            (
+                "global_pages.seconds",
+                sum(stages["website." + stage] for stage in GLOBAL_STAGES),
+            ),
+            (
+                "global_pages.queries",
+                sum(
+                    queries["website." + stage].count
+                    for stage in GLOBAL_STAGES
+                    if "website." + stage in queries
+                ),
+            ),
+            ("peak_rss_kb", results["peak_rss_kb"]),
+        ]
+    )
+
+
+def tolerance(baseline: dict, metric: str) -> float:
+    """Return a metric's tolerance, from the baseline or TOLERANCES."""
+    kind = metric.rsplit(".", 1)[-1]
+    return baseline.get("tolerances", TOLERANCES).get(kind, TOLERANCES[kind])
+
+
+def compare(baseline: dict, current: dict) -> bool:
+    """Print a report comparing current with baseline metrics.
+
+    Returns True if no metric regressed.
+    """
+    ok = True
+    print(
+        "%-28s %12s %12s %8s %8s  %s"
+        % ("metric", "baseline", "current", "change", "limit", "")
+    )
+    for metric, value in current.items():
+        base = baseline["metrics"].get(metric)
+        if base is None:
+            print("%-28s %12s %12.4g %8s %8s  new" % (metric, "-", value, "", ""))
+            continue
+        limit = tolerance(baseline, metric)
+        change = (value - base) / base if base else 0.0
+        regressed = value > base * (1 + limit)
+        ok = ok and not regressed
+        print(
+            "%-28s %12.4g %12.4g %+7.0f%% %+7.0f%%  %s"
+            % (
+                metric,
+                base,
+                value,
+                change * 100,
+                limit * 100,
+                "REGRESSED" if regressed else "ok",
+            )
+        )
+    return ok
+
+
+def main() -> None:
+    """Run the check from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--baseline",
+        metavar="FILE",
+        default=BASELINE,
+        help="Baseline JSON. Default: bench/baseline.json",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="Write the metrics to the baseline instead of checking them",
+    )
+    args = parser.parse_args()
+
+    print(
+        "Running workload: %s"
+        % ", ".join("%s=%s" % item for item in WORKLOAD.items())
+    )
+    current = measure()
+
+    if args.update:
+        baseline = collections.OrderedDict(
+            [
+                ("revision", run.git_revision()),
+                ("workload", WORKLOAD),
+                ("tolerances", TOLERANCES),
+                ("metrics", current),
+            ]
+        )
+        with open(args.baseline, "w") as f:
+            f.write(json.dumps(baseline, indent=2) + "\n")
+        print("Wrote baseline to %s" % args.baseline)
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["workload"] != WORKLOAD:
+        sys.exit(
+            "The baseline was recorded with a different workload (%s), "
+            "run with --update" % baseline["workload"]
+        )
+    print("Comparing with baseline from revision %s" % baseline["revision"])
+    if not compare(baseline, current):
+        sys.exit("Performance regressed, see above")
+    print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
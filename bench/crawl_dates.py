@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Micro-benchmark for parsing crawl date strings.
+
+Compares modelutils.crawl_date_to_datetime and the bulk parsers against the
+original string-rebuilding implementation.
+
+Usage: python -m bench.crawl_dates [--dates N]
+"""
+
+import argparse
+import datetime
+import random
+import time
+
+import scoreboard.model  # pylint: disable=unused-import
+import scoreboard.modelutils as modelutils
+
+
+def legacy_crawl_date_to_datetime(d: str) -> datetime.datetime:
+    """The original crawl_date_to_datetime, for comparison."""
+    d = d[:4] + "%02d" % (int(d[4:6]) + 1) + d[6:]
+    return datetime.datetime(
+        year=int(d[:4]),
+        month=int(d[4:6]),
+        day=int(d[6:8]),
+        hour=int(d[8:10]),
+        minute=int(d[10:12]),
+        second=int(d[12:14]),
+    )
+
+
+def synthetic_dates(n: int, seed: int = 0) -> list:
+    """Return n crawl date strings spread over a few years."""
+    rng = random.Random(seed)
+    return [
+        "%04d%02d%02d%02d%02d%02dS"
+        % (
+            rng.randint(2010, 2018),
+            rng.randrange(12),
+            rng.randint(1, 28),
+            rng.randrange(24),
+            rng.randrange(60),
+            rng.randrange(60),
+        )
+        for _ in range(n)
+    ]
+
+
+def _rate(n: int, func, *args) -> float:  # type: ignore
+    start = time.perf_counter()
+    func(*args)
+    return n / (time.perf_counter() - start)
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dates", type=int, default=1000000)
+    args = parser.parse_args()
+
+    dates = synthetic_dates(args.dates)
+    n = len(dates)
+    results = (
+        (
+            "legacy crawl_date_to_datetime",
+            _rate(n, lambda: [legacy_crawl_date_to_datetime(d) for d in dates]),
+        ),
+        (
+            "crawl_date_to_datetime",
+            _rate(n, lambda: [modelutils.crawl_date_to_datetime(d) for d in dates]),
+        ),
+        ("crawl_dates_to_datetimes", _rate(n, modelutils.crawl_dates_to_datetimes, dates)),
+        ("crawl_dates_to_epochs", _rate(n, modelutils.crawl_dates_to_epochs, dates)),
+    )
+    for name, rate in results:
+        print("%-30s %10.0f dates/sec" % (name, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Micro-benchmark for normalising API game records.
+
+Compares log_import.GameNormaliser against the per-game normalisation that
+log_import.add_game used to do. Both resolve dimension ids through the same
+(warm) model caches, so this measures the data cleansing itself.
+
+Usage: python -m bench.normalise [--games N]
+"""
+
+import argparse
+import os
+import random
+import re
+import tempfile
+import time
+
+import scoreboard.model as model
+import scoreboard.orm as orm
+import scoreboard.log_import as log_import
+import scoreboard.modelutils as modelutils
+import scoreboard.constants as const
+
+
+def synthetic_games(n: int, seed: int = 0) -> list:
+    """Return n API game records with a plausible spread of values."""
+    rng = random.Random(seed)
+    species = sorted(sp.short for sp in const.SPECIES)
+    backgrounds = sorted(bg.short for bg in const.BACKGROUNDS)
+    gods = sorted(g.name for g in const.GODS)
+    branches = sorted(br.short for br in const.BRANCHES)
+    games = []
+    for i in range(n):
+        start = "2016%02d%02d%02d%02d%02dS" % (
+            rng.randrange(12),
+            rng.randint(1, 28),
+            rng.randrange(24),
+            rng.randrange(60),
+            rng.randrange(60),
+        )
+        games.append(
+            {
+                "src_abbr": rng.choice(("cao", "cpo", "cbro", "cxc")),
+                "data": {
+                    "name": "player%d" % rng.randrange(n // 20 + 1),
+                    "start": start,
+                    "end": start[:8] + "23" + start[10:],
+                    "v": rng.choice(("0.17.1", "0.18.0", "0.19-a0")),
+                    "lv": "0.1",
+                    "char": rng.choice(species) + rng.choice(backgrounds),
+                    "race": "Minotaur",
+                    "god": rng.choice(gods),
+                    "br": rng.choice(branches),
+                    "lvl": rng.randint(1, 15),
+                    "xl": rng.randint(1, 27),
+                    "turn": rng.randint(100, 100000),
+                    "dur": rng.randint(100, 100000),
+                    "sc": rng.randint(1, 10000000),
+                    "ktyp": rng.choice(const.KTYPS),
+                    "tmsg": "slain by a goblin",
+                    "urune": rng.randint(0, 15),
+                    "dam": rng.randint(0, 100),
+                },
+            }
+        )
+    return games
+
+
+def legacy_normalise(s, api_game: dict) -> dict:
+    """The normalisation add_game did before GameNormaliser, for comparison."""
+    if "start" not in api_game["data"]:
+        return None
+    if "v" not in api_game["data"]:
+        return None
+    if "char" not in api_game["data"]:
+        return None
+    if api_game["data"]["lv"] != "0.1":
+        return None
+
+    game = {}
+    game.update(api_game["data"])
+    game["gid"] = "%s:%s:%s" % (game["name"], api_game["src_abbr"], game["start"])
+    game["v"] = re.match(r"(0.\d+)", game["v"]).group()
+    if "god" not in game:
+        game["god"] = "Atheist"
+    game["god"] = const.GOD_NAME_FIXUPS.get(game["god"], game["god"])
+    game["race"] = const.SPECIES_NAME_FIXUPS.get(game["race"], game["race"])
+    if game["v"] in ("0.1", "0.2", "0.3", "0.4", "0.5") and game["char"][:2] == "Gn":
+        game["char"] = "Gm" + game["char"][2:]
+    if game["char"][:2] in const.SPECIES_SHORTNAME_FIXUPS:
+        oldrace = game["char"][:2]
+        newrace = const.SPECIES_SHORTNAME_FIXUPS[oldrace]
+        game["char"] = newrace + game["char"][2:]
+    if game["char"][2:] in const.BACKGROUND_SHORTNAME_FIXUPS:
+        oldbg = game["char"][2:]
+        newbg = const.BACKGROUND_SHORTNAME_FIXUPS[oldbg]
+        game["char"] = game["char"][:2] + newbg
+    game["br"] = const.BRANCH_NAME_FIXUPS.get(game["br"], game["br"])
+    game["ktyp"] = const.KTYP_FIXUPS.get(game["ktyp"], game["ktyp"])
+    game["rc"] = game["char"][:2]
+    game["bg"] = game["char"][2:]
+
+    branch_id = model.get_branch_id(s, game["br"])
+    server_id = model.get_server_id(s, api_game["src_abbr"])
+    return {
+        "gid": game["gid"],
+        "account_id": model.get_account_id(s, game["name"], server_id),
+        "player_id": model.get_player_id(s, game["name"]),
+        "species_id": model.get_species_id(s, game["char"][:2]),
+        "background_id": model.get_background_id(s, game["char"][2:]),
+        "god_id": model.get_god_id(s, game["god"]),
+        "version_id": model.get_version_id(s, game["v"]),
+        "place_id": model.get_place_id(s, branch_id, game["lvl"]),
+        "xl": game["xl"],
+        "tmsg": game.get("tmsg", ""),
+        "turn": game["turn"],
+        "dur": game["dur"],
+        "runes": game.get("urune", 0),
+        "score": game["sc"],
+        "start": modelutils.crawl_date_to_datetime(game["start"]),
+        "end": modelutils.crawl_date_to_datetime(game["end"]),
+        "ktyp_id": model.get_ktyp_id(s, game["ktyp"]),
+        "potions_used": game.get("potionsused", -1),
+        "scrolls_used": game.get("scrollsused", -1),
+        "dam": game.get("dam", 0),
+        "tdam": game.get("tdam", game.get("dam", 0)),
+        "sdam": game.get("sdam", game.get("dam", 0)),
+    }
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--games", type=int, default=100000)
+    args = parser.parse_args()
+
+    games = synthetic_games(args.games)
+    with tempfile.TemporaryDirectory() as tmp:
+        orm.setup_database("sqlite:///" + os.path.join(tmp, "bench.db3"))
+        s = orm.get_session()
+        # Warm the dimension caches, so both paths do the same DB work
+        for game in games:
+            legacy_normalise(s, game)
+
+        start = time.perf_counter()
+        for game in games:
+            legacy_normalise(s, game)
+        legacy = time.perf_counter() - start
+
+        normaliser = log_import.GameNormaliser()
+        start = time.perf_counter()
+        normaliser.normalise_page(s, games)
+        normalised = time.perf_counter() - start
+        s.close()
+
+    print("legacy add_game:  %10.0f games/sec" % (len(games) / legacy))
+    print("GameNormaliser:   %10.0f games/sec" % (len(games) / normalised))
+    print("speedup:          %10.2fx" % (legacy / normalised))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""Local stand-in for the game API, for benchmarks and load tests.
+
+Serves GET /event?type=game&offset=N&limit=M (or type=milestone) with the
+same contract as the real game API (status, message, results, next_offset,
+and src_abbr and data in each result), so log_import.load_logfiles and
+load_milestones can be exercised without the network. The events come from a
+seeded synthetic dataset (see bench.synthetic) or from a recording of the
+real API's games (see `record`).
+
+Faults can be injected to soak-test the importer's retries and checkpointing:
+
+- latency: seconds added to every response, plus up to jitter seconds more
+- error_rate: fraction of requests answered with HTTP 503
+- timeout_rate: fraction of requests which hang for hang seconds, longer than
+  log_import.API_TIMEOUT, before being answered
+- duplicate_rate: fraction of pages which start up to a page before the
+  requested offset, so they repeat games the importer has already seen
+
+Usage:
+    python -m bench.replay [--games 1M] [--error-rate 0.05] [--port 8080]
+    python -m bench.replay --recording FILE
+    python -m bench.replay --record URL FILE [--games 10k]
+"""
+
+import json
+import time
+import bisect
+import random
+import argparse
+import threading
+import http.server
+import socketserver
+import urllib.parse
+from typing import List, Optional
+
+import requests
+
+from bench import synthetic
+
+
+class SyntheticDataset:
+    """Games generated on demand by bench.synthetic."""
+
+    def __init__(self, seed: int, num_games: int) -> None:
+        self.seed = seed
+        self.num_games = num_games
+
+    def page(self, offset: int, limit: int, event_type: str = "game") -> List[dict]:
+        """Return up to limit games (or milestones) starting from offset."""
+        end = min(self.num_games, offset + limit)
+        make = synthetic.milestone if event_type == "milestone" else synthetic.game
+        return [
+            make(self.seed, index, self.num_games)
+            for index in range(max(0, offset), end)
+        ]
+
+
+class RecordedDataset:
+    """Games recorded from the game API, one JSON result per line."""
+
+    def __init__(self, path: str) -> None:
+        with open(path) as f:
+            games = {}
+            for line in f:
+                if line.strip():
+                    game = json.loads(line)
+                    games[game["id"]] = game
+        self.games = sorted(games.values(), key=lambda game: game["id"])
+        self.ids = [game["id"] for game in self.games]
+
+    def page(self, offset: int, limit: int, event_type: str = "game") -> List[dict]:
+        """Return up to limit games with ids from offset.
+
+        Only games are recorded, so there are no milestones.
+        """
+        if event_type != "game":
+            return []
+        start = bisect.bisect_left(self.ids, offset)
+        return self.games[start : start + limit]
+
+
+class Faults:
+    """Faults to inject into the stand-in's responses."""
+
+    def __init__(
+        self,
+        *,
+        latency: float = 0,
+        jitter: float = 0,
+        error_rate: float = 0,
+        timeout_rate: float = 0,
+        hang: float = 20,
+        duplicate_rate: float = 0,
+        seed: Optional[int] = None
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.duplicate_rate = duplicate_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def roll(self, rate: float) -> bool:
+        """Return True with probability rate."""
+        with self.lock:
+            return self.rng.random() < rate
+
+    def delay(self) -> float:
+        """Return the seconds to delay a response by."""
+        if self.roll(self.timeout_rate):
+            return self.hang
+        with self.lock:
+            return self.latency + self.rng.uniform(0, self.jitter)
+
+    def rewind(self, offset: int, limit: int) -> int:
+        """Return an offset up to a page before offset."""
+        with self.lock:
+            return max(0, offset - self.rng.randint(1, limit))
+
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    """Serve pages of the server's dataset."""
+
+    server = None  # type: ReplayServer
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """Serve a page of events."""
+        try:
+            self.serve_page()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up, eg after a timeout
+            pass
+
+    def serve_page(self) -> None:
+        """Serve a page of events, injecting the server's faults."""
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        event_type = query.get("type", ["game"])[0]
+        if url.path != "/event" or event_type not in ("game", "milestone"):
+            self.send_error(404)
+            return
+        try:
+            offset = int(query.get("offset", ["0"])[0])
+            limit = int(query.get("limit", ["1000"])[0])
+        except ValueError:
+            self.send_error(400)
+            return
+        server = self.server
+        server.count("requests")
+
+        faults = server.faults
+        delay = faults.delay()
+        if delay >= faults.hang:
+            server.count("timeouts")
+        if delay:
+            time.sleep(delay)
+        if faults.roll(faults.error_rate):
+            server.count("errors")
+            self.send_error(503)
+            return
+        if faults.roll(faults.duplicate_rate):
+            server.count("duplicates")
+            offset = faults.rewind(offset, limit)
+
+        results = server.dataset.page(offset, limit, event_type)
+        server.count(event_type + "s", len(results))
+        body = json.dumps(
+            {
+                "status": 200,
+                "message": "OK",
+                "results": results,
+                "next_offset": results[-1]["id"] + 1 if results else offset,
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:  # type: ignore # pylint: disable=redefined-builtin
+        """Don't log requests."""
+        pass
+
+
+class ReplayServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Game API stand-in.
+
+    Parameters:
+        seed, num_games: synthetic dataset to serve, unless dataset is given
+        port: port to listen on, by default any free port
+        dataset: SyntheticDataset or RecordedDataset to serve
+        faults: Faults to inject, by default none
+    """
+
+    def __init__(
+        self,
+        seed: int = 0,
+        num_games: int = 0,
+        port: int = 0,
+        *,
+        dataset=None,
+        faults: Optional[Faults] = None
+    ) -> None:
+        super().__init__(("127.0.0.1", port), ReplayHandler)
+        self.daemon_threads = True
+        self.dataset = dataset or SyntheticDataset(seed, num_games)
+        self.faults = faults or Faults()
+        self.counts = {
+            "requests": 0,
+            "games": 0,
+            "milestones": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "duplicates": 0,
+        }
+        self.counts_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        """The game API url to pass to load_logfiles."""
+        return "http://127.0.0.1:%s/event" % self.server_address[1]
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Add n to one of the server's counts."""
+        with self.counts_lock:
+            self.counts[name] += n
+
+    def start(self) -> None:
+        """Serve requests in a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def record(api_url: str, path: str, num_games: int, limit: int = 1000) -> int:
+    """Record up to num_games games from a game API into a file.
+
+    Returns the number of games recorded.
+    """
+    offset = 0
+    recorded = 0
+    with open(path, "w") as f:
+        while recorded < num_games:
+            r = requests.get(
+                api_url,
+                {
+                    "type": "game",
+                    "offset": offset,
+                    "limit": min(limit, num_games - recorded),
+                },
+                timeout=60,
+            )
+            r.raise_for_status()
+            results = r.json()["results"]
+            if not results:
+                break
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+            recorded += len(results)
+            offset = r.json()["next_offset"]
+            print("Recorded %s games..." % recorded)
+    return recorded
+
+
+def main() -> None:
+    """Run the stand-in from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--games", default="10k", help="Games to serve or record, eg 10k or 1M"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Dataset seed")
+    parser.add_argument(
+        "--recording", metavar="FILE", help="Serve games recorded in FILE"
+    )
+    parser.add_argument(
+        "--record",
+        nargs=2,
+        metavar=("URL", "FILE"),
+        help="Record games from the game API at URL into FILE, then exit",
+    )
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds to delay each response"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0, help="Up to this many more seconds delay"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="Fraction of HTTP 503 responses"
+    )
+    parser.add_argument(
+        "--timeout-rate", type=float, default=0, help="Fraction of hung responses"
+    )
+    parser.add_argument(
+        "--hang", type=float, default=20, help="Seconds a hung response hangs for"
+    )
+    parser.add_argument(
+        "--duplicate-rate",
+        type=float,
+        default=0,
+        help="Fraction of pages repeating already served games",
+    )
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record[0], args.record[1], synthetic.parse_count(args.games))
+        return
+
+    if args.recording:
+        dataset = RecordedDataset(args.recording)
+    else:
+        dataset = SyntheticDataset(args.seed, synthetic.parse_count(args.games))
+    faults = Faults(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        timeout_rate=args.timeout_rate,
+        hang=args.hang,
+        duplicate_rate=args.duplicate_rate,
+        seed=args.seed,
+    )
+    server = ReplayServer(port=args.port, dataset=dataset, faults=faults)
+    print("Serving the game API at %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("Served %s" % server.counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of importing, scoring and writing the website.
+
+A seeded synthetic dataset (see bench.synthetic) is imported through a local
+replay of the game API (see bench.replay), then scored, then the website is
+written. Each stage, and each write_website stage, is timed separately. The
+results are written as JSON so they can be compared across versions.
+
+Usage: python -m bench.run [--games 10k|1M|10M] [--seed N] [--output FILE]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import collections
+
+import scoreboard.model as model
+import scoreboard.orm as orm
+import scoreboard.querycount as querycount
+import scoreboard.log_import as log_import
+import scoreboard.scoring as scoring
+import scoreboard.util as util
+import scoreboard.write_website as write_website
+
+from bench import replay, synthetic
+
+try:
+    import resource
+except ImportError:  # Not on win32
+    resource = None
+
+
+def git_revision() -> str:
+    """Return the current git revision, if available."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def peak_rss_kb() -> int:
+    """Return this process's peak resident set size in KiB, if known."""
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def run(
+    num_games: int, seed: int, db_uri: str, website_dir: str, player_pages: int
+) -> dict:
+    """Run the benchmark, returning the results."""
+    server = replay.ReplayServer(seed, num_games)
+    server.start()
+    orm.setup_database(db_uri)
+    write_website.WEBSITE_DIR = website_dir
+
+    timings = collections.OrderedDict()  # type: collections.OrderedDict
+    try:
+        with util.stage_timer(timings, "import"), querycount.stage("import"):
+            log_import.load_logfiles(server.url)
+        with util.stage_timer(timings, "score"), querycount.stage("score"):
+            scoring.score_games()
+        website_timings = write_website.write_website(
+            players=None if player_pages is None else [],
+            urlbase="",
+            extra_player_pages=player_pages or 0,
+        )
+    finally:
+        server.shutdown()
+    for stage, secs in website_timings.items():
+        timings["website." + stage] = secs
+    timings["website"] = sum(website_timings.values())
+
+    s = orm.get_session()
+    games = model.count_games(s)
+    players = len(model.list_player_ids(s))
+    s.close()
+    return collections.OrderedDict(
+        [
+            ("benchmark", "end_to_end"),
+            ("revision", git_revision()),
+            ("timestamp", datetime.datetime.utcnow().isoformat()),
+            ("python", platform.python_version()),
+            ("database", db_uri.split(":", 1)[0]),
+            ("seed", seed),
+            ("games", games),
+            ("players", players),
+            ("stages", timings),
+            (
+                "throughput",
+                {
+                    "import_games_per_sec": games / timings["import"],
+                    "score_games_per_sec": games / timings["score"],
+                },
+            ),
+            ("peak_rss_kb", peak_rss_kb()),
+        ]
+    )
+
+
+def main() -> None:
+    """Run the benchmark from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--games", default="10k", help="Games to import, eg 10k, 1M or 10M"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Dataset seed")
+    parser.add_argument(
+        "--database",
+        metavar="URI",
+        help="sqlalchemy database URI. Default: a temporary sqlite database",
+    )
+    parser.add_argument(
+        "--player-pages",
+        metavar="NUM",
+        type=int,
+        help="Only write NUM player pages. Default: all",
+    )
+    parser.add_argument(
+        "--output", metavar="FILE", help="Write JSON results to FILE"
+    )
+    args = parser.parse_args()
+
+    start = time.time()
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run(
+            synthetic.parse_count(args.games),
+            args.seed,
+            args.database or "sqlite:///" + os.path.join(tmp, "bench.db3"),
+            os.path.join(tmp, "website"),
+            args.player_pages,
+        )
+    print()
+    print("%-32s %10s" % ("stage", "seconds"))
+    for stage, secs in results["stages"].items():
+        print("%-32s %10.2f" % (stage, secs))
+    print("Benchmark took %.1f seconds" % (time.time() - start))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""Benchmark of loader.py's startup cost.
+
+Measures:
+
+- import time of loader.py and each stage module, from `python -X importtime`
+- wall time to start a process which imports loader.py
+- time and queries for orm.setup_database on a new database (cold) and on
+  one which is already set up (warm)
+
+Usage: python -m bench.startup [--runs N] [--output FILE]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import statistics
+import subprocess
+import collections
+
+import scoreboard.model  # pylint: disable=unused-import
+import scoreboard.orm as orm
+import scoreboard.querycount as querycount
+
+from bench.run import git_revision
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Imported in this order, so each stage module's time excludes loader's
+MODULES = (
+    "loader",
+    "scoreboard.log_import",
+    "scoreboard.scoring",
+    "scoreboard.write_website",
+)
+
+
+def import_times() -> collections.OrderedDict:
+    """Return the seconds taken to import each of MODULES, and the slowest
+    modules they import."""
+    code = "; ".join("import %s" % module for module in MODULES)
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_DIR,
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    ).stderr.decode()
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        modules.append((name.rstrip(), int(self_us), int(cumulative_us)))
+    # Top-level imports aren't indented
+    top_level = {
+        name.strip(): cumulative
+        for name, _, cumulative in modules
+        if not name.startswith("  ")
+    }
+    slowest = sorted(modules, key=lambda module: module[1], reverse=True)[:10]
+    return collections.OrderedDict(
+        [
+            ("total", sum(self_us for _, self_us, _ in modules) / 1e6),
+            (
+                "modules",
+                collections.OrderedDict(
+                    (module, top_level.get(module, 0) / 1e6) for module in MODULES
+                ),
+            ),
+            (
+                "slowest_self",
+                collections.OrderedDict(
+                    (name.strip(), self_us / 1e6) for name, self_us, _ in slowest
+                ),
+            ),
+        ]
+    )
+
+
+def process_startup(runs: int) -> float:
+    """Return the median wall time to start python and import loader."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", "import loader"], cwd=REPO_DIR, check=True
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def setup_database(db_uri: str) -> collections.OrderedDict:
+    """Time setup_database on a new database, then again once it's set up."""
+    querycount.ENABLED = True
+    out = collections.OrderedDict()  # type: collections.OrderedDict
+    for stage in ("cold", "warm"):
+        start = time.perf_counter()
+        # Seeding prints a line per row
+        with querycount.stage(stage), contextlib.redirect_stdout(io.StringIO()):
+            orm.setup_database(db_uri)
+        out[stage] = collections.OrderedDict(
+            [
+                ("seconds", time.perf_counter() - start),
+                ("queries", querycount.counter.stages[stage].count),
+            ]
+        )
+    return out
+
+
+def main() -> None:
+    """Run the benchmark from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--runs", type=int, default=5, help="Process starts to time. Default: 5"
+    )
+    parser.add_argument("--output", metavar="FILE", help="Write JSON results to FILE")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup = setup_database("sqlite:///" + os.path.join(tmp, "startup.db3"))
+    results = collections.OrderedDict(
+        [
+            ("benchmark", "startup"),
+            ("revision", git_revision()),
+            ("python", sys.version.split()[0]),
+            ("imports", import_times()),
+            ("process_startup", process_startup(args.runs)),
+            ("setup_database", setup),
+        ]
+    )
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
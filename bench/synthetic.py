@@ -0,0 +1,167 @@
+"""Seeded synthetic game API events.
+
+Games are generated independently from (seed, index), so any page of a huge
+dataset can be produced on demand without generating the games before it.
+The distributions are loosely modelled on the real servers:
+
+- A few prolific players play a large share of the games.
+- Each player has a fixed skill, which is their chance of winning a game.
+  Most players almost never win, and a handful of strong players win often
+  enough to build streaks.
+- Species and backgrounds come from constants.SPECIES/BACKGROUNDS, mostly
+  playable ones.
+- Games start in index order, and so end in roughly index order like the
+  API's offsets.
+- Milestones (see milestone) are by the same players, at the same rate as
+  games: mostly branches entered, then uniques killed and runes found.
+"""
+
+import datetime
+import functools
+import random
+from typing import Iterator
+
+import scoreboard.constants as const
+
+# Average seconds between game ends. 10M games cover about 3 years.
+GAME_INTERVAL = 10
+EPOCH = datetime.datetime(2016, 1, 1)
+SERVERS = ("cao", "cpo", "cbro", "cxc", "lld", "cue", "cwz")
+VERSIONS = ("0.17.1", "0.18.2", "0.19.0", "0.20-a0-123-gabcdef")
+# ktyps for games which aren't won, with rough relative frequencies
+DEATH_KTYPS = (("mon", 70), ("quitting", 10), ("leaving", 5), ("beam", 5))
+DEATH_KTYPS += tuple((ktyp, 1) for ktyp in const.KTYPS if ktyp not in ("winning",))
+MONSTERS = ("a goblin", "a jackal", "Sigmund", "an orc priest", "an ogre")
+MILESTONE_TYPES = ("br.enter",) * 6 + ("uniq",) * 3 + ("rune",)
+UNIQUES = ("Sigmund", "Grinder", "Ijyb", "Blork the orc", "Sonja")
+RUNES = ("slimy", "silver", "golden", "decaying", "serpentine", "barnacled")
+
+_SPECIES = sorted(sp.short for sp in const.SPECIES if sp.playable)
+_OLD_SPECIES = sorted(sp.short for sp in const.SPECIES if not sp.playable)
+_BACKGROUNDS = sorted(bg.short for bg in const.BACKGROUNDS if bg.playable)
+_OLD_BACKGROUNDS = sorted(bg.short for bg in const.BACKGROUNDS if not bg.playable)
+_GODS = sorted(god.name for god in const.GODS if god.playable)
+_BRANCHES = sorted(br.short for br in const.BRANCHES)
+_DEATH_KTYPS = [ktyp for ktyp, weight in DEATH_KTYPS for _ in range(weight)]
+
+
+def num_players(num_games: int) -> int:
+    """Number of distinct players in a dataset of num_games games."""
+    return max(10, num_games // 50)
+
+
+@functools.lru_cache(maxsize=None)
+def player_skill(seed: int, player: int) -> float:
+    """Return a player's chance of winning a game."""
+    rng = random.Random("%s:player:%s" % (seed, player))
+    # Most players rarely win, a few win a lot
+    return min(0.8, rng.betavariate(0.3, 12) * 2)
+
+
+def crawl_date(when: datetime.datetime) -> str:
+    """Format a datetime as a crawl logfile date (months are 0-based)."""
+    return "%04d%02d%02d%02d%02d%02dS" % (
+        when.year,
+        when.month - 1,
+        when.day,
+        when.hour,
+        when.minute,
+        when.second,
+    )
+
+
+def game(seed: int, index: int, num_games: int) -> dict:
+    """Return the index'th game API record of a dataset."""
+    rng = random.Random("%s:game:%s" % (seed, index))
+    players = num_players(num_games)
+    # The lowest numbered players are the most prolific: the top 1% of
+    # players play about a fifth of the games.
+    player = int(players * rng.random() ** 3)
+    won = rng.random() < player_skill(seed, player)
+
+    # Start times are unique, so gids are too
+    start = EPOCH + datetime.timedelta(seconds=index * GAME_INTERVAL)
+    dur = rng.randint(20000, 200000) if won else int(rng.expovariate(1 / 5000)) + 30
+    turn = dur * rng.randint(3, 8) // 2
+    end = start + datetime.timedelta(seconds=dur)
+    if rng.random() < 0.95:
+        char = rng.choice(_SPECIES) + rng.choice(_BACKGROUNDS)
+    else:
+        char = rng.choice(_SPECIES + _OLD_SPECIES) + rng.choice(
+            _BACKGROUNDS + _OLD_BACKGROUNDS
+        )
+    if won:
+        runes = rng.choice((3, 3, 3, 3, 4, 5, 6, 15))
+        xl = rng.randint(24, 27)
+        br, lvl = "Zot", 5
+        ktyp = "winning"
+        tmsg = "escaped with the Orb"
+    else:
+        runes = rng.choice((0,) * 20 + (1, 2, 3))
+        xl = min(27, int(rng.expovariate(1 / 6)) + 1)
+        br = rng.choice(("D",) * 10 + tuple(_BRANCHES))
+        lvl = rng.randint(1, 15)
+        ktyp = rng.choice(_DEATH_KTYPS)
+        tmsg = "slain by %s" % rng.choice(MONSTERS)
+    dam = rng.randint(1, 100)
+    data = {
+        "name": "player%d" % player,
+        "start": crawl_date(start),
+        "end": crawl_date(end),
+        "v": VERSIONS[min(len(VERSIONS) - 1, index * len(VERSIONS) // num_games)],
+        "lv": "0.1",
+        "char": char,
+        "god": rng.choice(_GODS) if xl > 3 else "Atheist",
+        "br": br,
+        "lvl": lvl,
+        "xl": xl,
+        "turn": turn,
+        "dur": dur,
+        "sc": int(xl ** 3 * (runes + 1) * rng.uniform(1, 4)) + (1000000 if won else 0),
+        "ktyp": ktyp,
+        "tmsg": tmsg,
+        "urune": runes,
+        "dam": dam,
+        "sdam": dam,
+        "tdam": dam,
+        "potionsused": rng.randint(0, 100),
+        "scrollsused": rng.randint(0, 100),
+    }
+    return {"id": index, "src_abbr": SERVERS[player % len(SERVERS)], "data": data}
+
+
+def milestone(seed: int, index: int, num_games: int) -> dict:
+    """Return the index'th milestone API record of a dataset."""
+    rng = random.Random("%s:milestone:%s" % (seed, index))
+    player = int(num_players(num_games) * rng.random() ** 3)
+    when = EPOCH + datetime.timedelta(seconds=index * GAME_INTERVAL)
+    data = {
+        "name": "player%d" % player,
+        "time": crawl_date(when),
+        "v": VERSIONS[min(len(VERSIONS) - 1, index * len(VERSIONS) // num_games)],
+        "lv": "0.1",
+        "type": rng.choice(MILESTONE_TYPES),
+    }
+    if data["type"] == "br.enter":
+        data["br"] = rng.choice(_BRANCHES)
+        data["milestone"] = "entered %s." % data["br"]
+    elif data["type"] == "uniq":
+        data["milestone"] = "killed %s." % rng.choice(UNIQUES)
+    else:
+        data["milestone"] = "found a %s rune of Zot." % rng.choice(RUNES)
+    return {"id": index, "src_abbr": SERVERS[player % len(SERVERS)], "data": data}
+
+
+def games(seed: int, num_games: int, start: int = 0) -> Iterator[dict]:
+    """Yield the game API records of a dataset, from index start."""
+    for index in range(start, num_games):
+        yield game(seed, index, num_games)
+
+
+def parse_count(count: str) -> int:
+    """Parse a game count like '10k' or '1M'."""
+    multipliers = {"k": 10 ** 3, "m": 10 ** 6}
+    suffix = count[-1:].lower()
+    if suffix in multipliers:
+        return int(float(count[:-1]) * multipliers[suffix])
+    return int(count)
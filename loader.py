@@ -2,14 +2,33 @@
 """CLI to run dcss-scoreboard."""
 
 import argparse
+import contextlib
+import importlib
+import signal
 import sys
 import os
+import threading
 import time
+import traceback
+from typing import Callable, Iterator, List, Tuple
 
-import scoreboard.log_import
+import scoreboard.constants
+import scoreboard.metrics
+import scoreboard.model
 import scoreboard.orm
-import scoreboard.scoring
-import scoreboard.write_website
+import scoreboard.profiling
+import scoreboard.querycount
+
+# The stage modules (log_import, scoring and write_website) are imported when
+# their stage runs, so skipped stages don't pay for importing requests, jinja2
+# and jsmin.
+
+# Set any of these to skip that stage
+SKIP_STAGE_VARS = (
+    'SCOREBOARD_SKIP_IMPORT',
+    'SCOREBOARD_SKIP_SCORING',
+    'SCOREBOARD_SKIP_WEBSITE',
+)
 
 
 def error(msg: str) -> None:
@@ -51,43 +70,402 @@ def read_commandline() -> argparse.Namespace:
         type=int,
         help="(Re-)Generate pages for an additional NUM players (least recently updated first)",
     )
+    parser.add_argument(
+        "--scoring-batch-size",
+        metavar="NUM",
+        default=1000,
+        type=int,
+        help="Score NUM games per database transaction. Default: 1000",
+    )
+    parser.add_argument(
+        "--import-workers",
+        metavar="NUM",
+        default=4,
+        type=int,
+        help="Import from up to NUM game sources at once. Default: 4",
+    )
+    parser.add_argument(
+        "--api-request-interval",
+        metavar="SECS",
+        default=0,
+        type=float,
+        help="Wait at least SECS between requests to each game API. Default: 0",
+    )
+    parser.add_argument(
+        "--commit-pages",
+        metavar="NUM",
+        default=1,
+        type=int,
+        help="Commit imported games every NUM pages. Default: 1",
+    )
+    parser.add_argument(
+        "--commit-seconds",
+        metavar="SECS",
+        default=None,
+        type=float,
+        help="Also commit imported games when SECS have passed since the "
+        "last commit. Default: off",
+    )
+    parser.add_argument(
+        "--milestones",
+        action="store_true",
+        help="Also import milestones from the game APIs.",
+    )
+    parser.add_argument(
+        "--stream-api",
+        action="store_true",
+        help="Parse game API responses as they're downloaded (needs ijson).",
+    )
+    parser.add_argument(
+        "--redrive-rejected",
+        metavar="REASON",
+        nargs="?",
+        const="all",
+        help="Before importing, retry games in the rejected_games table "
+        "(only those rejected for REASON, if specified).",
+    )
+    parser.add_argument(
+        "--gid-filter",
+        metavar="PATH",
+        default=os.environ.get("SCOREBOARD_GID_FILTER"),
+        help="Keep a filter of imported games at PATH to skip re-imported "
+        "games quickly. Default: $SCOREBOARD_GID_FILTER",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running, importing, scoring and writing the website every "
+        "--interval seconds. SIGHUP reloads constants, SIGTERM stops.",
+    )
+    parser.add_argument(
+        "--interval",
+        metavar="SECS",
+        default=60,
+        type=float,
+        help="With --daemon, start a cycle every SECS. Default: 60",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Score games and write their players' pages while importing, "
+        "instead of after it (see scoreboard/pipeline.py).",
+    )
+    parser.add_argument(
+        "--stream-batch-seconds",
+        metavar="SECS",
+        default=5,
+        type=float,
+        help="With --stream, write player pages every SECS. Default: 5",
+    )
+    parser.add_argument(
+        "--stream-global-interval",
+        metavar="SECS",
+        default=60,
+        type=float,
+        help="With --stream, rewrite the global pages at most every SECS. "
+        "Default: 60",
+    )
+    parser.add_argument(
+        "--stream-watermark-margin",
+        metavar="SECS",
+        default=3600,
+        type=float,
+        help="With --stream, hold games back until every source has imported "
+        "games which ended SECS later, since sources return games out of "
+        "order. Default: 3600",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="STAGE[,STAGE]",
+        type=lambda stages: stages.split(","),
+        default=[],
+        help="Profile these stages: %s. player_page profiles each player "
+        "page render." % ", ".join(scoreboard.profiling.STAGES),
+    )
+    parser.add_argument(
+        "--profile-dir",
+        metavar="DIR",
+        default="profiles",
+        help="Write profiles to DIR. Default: profiles",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="Also write a tracemalloc diff for each profiled stage.",
+    )
 
     args = parser.parse_args()
+    try:
+        logfile_sources()
+    except ValueError as e:
+        parser.error(str(e))
+    unknown = set(args.profile) - set(scoreboard.profiling.STAGES)
+    if unknown:
+        parser.error("unknown --profile stages: %s" % ", ".join(sorted(unknown)))
     return args
 
 
-def main() -> None:
-    """Run CLI."""
-    args = read_commandline()
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Context manager to count the queries of, time and profile a stage."""
+    with scoreboard.querycount.stage(name), scoreboard.metrics.stage(
+        name
+    ), scoreboard.profiling.stage(name):
+        yield
 
-    # XXX SUPER HACK
-    # Wait a few seconds so that the postgres container has time to start up.
-    time.sleep(5)
-    scoreboard.orm.setup_database()
+
+def import_games(
+    args: argparse.Namespace,
+    on_commit: Callable = lambda source, rows: None,
+    on_done: Callable = lambda source: None,
+) -> None:
+    """Import new games from all sources.
+
+    on_commit and on_done are passed to log_import.import_sources.
+    """
+    from scoreboard import log_import
+
+    if args.redrive_rejected:
+        log_import.redrive_rejected_games(
+            reason=None
+            if args.redrive_rejected == "all"
+            else args.redrive_rejected
+        )
+    print("Loading latest games")
+    log_import.import_sources(
+        api_sources(),
+        logfile_sources(),
+        workers=args.import_workers,
+        min_interval=args.api_request_interval,
+        stream=args.stream_api,
+        gid_filter_path=args.gid_filter,
+        commit_pages=args.commit_pages,
+        commit_interval=args.commit_seconds,
+        milestones=args.milestones,
+        on_commit=on_commit,
+        on_done=on_done,
+    )
+
+
+def api_sources() -> List[str]:
+    """Return the game API urls to import.
+
+    They're read from SCOREBOARD_GAME_API, a whitespace-separated list.
+    """
+    return os.environ.get('SCOREBOARD_GAME_API', '').split()
+
+
+def logfile_sources() -> List[Tuple[str, str]]:
+    """Return the local logfiles to import, as (src, path) tuples.
+
+    They're read from SCOREBOARD_LOGFILES, a whitespace-separated list of
+    SRC=PATH.
+
+    Raises:
+        ValueError: if an entry isn't SRC=PATH.
+    """
+    logfiles = []
+    for logfile in os.environ.get('SCOREBOARD_LOGFILES', '').split():
+        src, _, path = logfile.partition('=')
+        if not src or not path:
+            raise ValueError(
+                "Invalid SCOREBOARD_LOGFILES entry %r, expected SRC=PATH" % logfile
+            )
+        logfiles.append((src, path))
+    return logfiles
+
+
+def import_stage(args: argparse.Namespace) -> None:
+    """Import new games from all sources."""
+    with stage("import"):
+        import_games(args)
+
+
+def stream_cycle(args: argparse.Namespace, first: bool, global_pages: bool) -> None:
+    """Import, score and write the website concurrently (see run_cycle)."""
+    from scoreboard import pipeline
+
+    if first and args.rebuild_player_pages:
+        players = None
+    else:
+        players = args.players if first and args.players else []
+    sources = api_sources() + [path for src, path in logfile_sources()]
+    with stage("pipeline"):
+        pipeline.Pipeline(
+            args.urlbase,
+            sources=sources,
+            players=players,
+            extra_player_pages=args.extra_player_pages,
+            global_pages=global_pages,
+            scoring_batch_size=args.scoring_batch_size,
+            batch_seconds=args.stream_batch_seconds,
+            global_interval=args.stream_global_interval,
+            watermark_margin=args.stream_watermark_margin,
+        ).run(lambda on_commit, on_done: import_games(args, on_commit, on_done))
+
+
+def run_cycle(
+    args: argparse.Namespace, first: bool = True, global_pages: bool = True
+) -> bool:
+    """Import, score and write the website once.
+
+    Parameters:
+        args: command line arguments
+        first: whether this is the daemon's first cycle (or not a daemon).
+            Player pages requested on the command line are only written
+            in the first cycle.
+        global_pages: write the global pages even if nothing is scored, eg
+            because they haven't been written since games were last scored
+
+    Returns:
+        Whether the global pages still need writing (ie the website stage
+        was skipped after games were scored).
+    """
+    scoreboard.metrics.registry.start_run()
+    if args.stream:
+        skipped = [var for var in SKIP_STAGE_VARS if os.environ.get(var) != None]
+        if not skipped:
+            stream_cycle(args, first, global_pages)
+            finish_cycle()
+            return False
+        # The pipeline runs every stage, so run the others one by one
+        print("%s set, not streaming" % ", ".join(skipped))
 
     if os.environ.get('SCOREBOARD_SKIP_IMPORT') == None:
-        print("Loading latest games")
-        scoreboard.log_import.load_logfiles(api_url=os.environ['SCOREBOARD_GAME_API'])
+        import_stage(args)
 
     if os.environ.get('SCOREBOARD_SKIP_SCORING') == None:
+        from scoreboard import scoring
+
         print("Scoring games")
-        players = scoreboard.scoring.score_games()
+        with stage("score"):
+            players = scoring.score_games(
+                batch_size=args.scoring_batch_size
+            )
+        # Unless they're out of date already, the global pages only change
+        # if something was scored
+        global_pages = global_pages or bool(players)
     else:
         players = None
+        global_pages = True
 
     if os.environ.get('SCOREBOARD_SKIP_WEBSITE') == None:
-        if args.rebuild_player_pages:
+        if first and args.rebuild_player_pages:
             players = None
-        if args.players:
+        if first and args.players:
             if players:
                 players.update(args.players)
             else:
                 players = args.players
-        scoreboard.write_website.write_website(
-            urlbase=args.urlbase,
-            players=players,
-            extra_player_pages=args.extra_player_pages,
-        )
+        from scoreboard import write_website
+
+        with stage("website"):
+            write_website.write_website(
+                urlbase=args.urlbase,
+                players=players,
+                extra_player_pages=args.extra_player_pages,
+                global_pages=global_pages,
+            )
+        global_pages = False
+
+    finish_cycle()
+    return global_pages
+
+
+def finish_cycle() -> None:
+    """Write the cycle's profiles, metrics and query report."""
+    scoreboard.profiling.finish()
+    scoreboard.metrics.write(website_dir())
+    scoreboard.querycount.report()
+
+
+def website_dir() -> str:
+    """Return the website dir, without importing write_website needlessly."""
+    if "scoreboard.write_website" in sys.modules:
+        return sys.modules["scoreboard.write_website"].WEBSITE_DIR
+    return os.environ.get('SCOREBOARD_WEBSITE_PATH', "website")
+
+
+def reload_constants() -> None:
+    """Reload scoreboard.constants and everything derived from it."""
+    print("Reloading constants")
+    importlib.reload(scoreboard.constants)
+    scoreboard.model.clear_caches()
+    if "scoreboard.write_website" in sys.modules:
+        sys.modules["scoreboard.write_website"].clear_cache()
+    scoreboard.orm.seed_database()
+
+
+class Daemon:
+    """Run a cycle every interval seconds until SIGTERM/SIGINT.
+
+    The database engine, dimension id caches, compiled templates and global
+    records are kept between cycles, and each cycle only imports, scores and
+    writes what's new. SIGHUP reloads constants before the next cycle.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.stopping = False
+        self.reload = False
+        self.wakeup = threading.Event()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.hangup)
+
+    def stop(self, signum, frame) -> None:  # type: ignore
+        """Stop after the current cycle."""
+        print("Got signal %s, stopping after this cycle" % signum)
+        self.stopping = True
+        self.wakeup.set()
+
+    def hangup(self, signum, frame) -> None:  # type: ignore
+        """Reload constants before the next cycle."""
+        print("Got SIGHUP, reloading constants before the next cycle")
+        self.reload = True
+
+    def run(self, args: argparse.Namespace) -> None:
+        """Run cycles until stopped."""
+        first = True
+        # Only cleared once the global pages are written, so games scored by
+        # a cycle whose website stage failed are shown by the next one
+        global_pages = True
+        while not self.stopping:
+            start = time.time()
+            if self.reload:
+                self.reload = False
+                reload_constants()
+            try:
+                global_pages = run_cycle(args, first, global_pages)
+            except Exception:  # pylint: disable=broad-except
+                # Carry on next cycle, like run-one-constantly would
+                print("Cycle failed:")
+                print(traceback.format_exc())
+                global_pages = True
+            first = False
+            wait = start + self.interval - time.time()
+            if wait > 0 and not self.stopping:
+                print("Sleeping for %.0f secs" % wait)
+                self.wakeup.wait(wait)
+        print("Stopped")
+
+
+def main() -> None:
+    """Run CLI."""
+    args = read_commandline()
+    scoreboard.profiling.configure(
+        args.profile, directory=args.profile_dir, memory=args.profile_memory
+    )
+
+    # XXX SUPER HACK
+    # Wait a few seconds so that the postgres container has time to start up.
+    time.sleep(5)
+    scoreboard.orm.setup_database()
+
+    if args.daemon:
+        Daemon(args.interval).run(args)
+    else:
+        run_cycle(args)
 
 
 if __name__ == "__main__":
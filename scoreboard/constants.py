@@ -980,3 +980,7 @@ ACHIEVEMENTS = (
     ),
 )
 LOGFILE_API_GAME_ARGS = {"type": "game", "limit": "1000"}
+LOGFILE_API_MILESTONE_ARGS = {"type": "milestone", "limit": "1000"}
+# Milestone text, eg 'found a silver rune of Zot.' and 'killed Sigmund.'
+MILESTONE_RUNE_REGEX = re.compile(r"found an? (\w+) rune")
+MILESTONE_UNIQUE_REGEX = re.compile(r"^killed (.+?)\.?$")
@@ -0,0 +1,142 @@
+"""Bloom filter of imported game ids.
+
+Used by log_import to drop games which have already been imported without a
+database round trip. A Bloom filter never gives false negatives, so games it
+doesn't know about are definitely new; games it might know about are checked
+against the database.
+
+The filter is saved to disk between runs. If it's missing, or knows about
+fewer games than the database, it's rebuilt from the games table.
+"""
+
+import os
+import math
+import struct
+import hashlib
+import threading
+from typing import Iterable, Optional
+
+import sqlalchemy.orm
+
+import scoreboard.model as model
+import scoreboard.orm as orm
+
+# Magic, bits, hashes, capacity, count
+HEADER = struct.Struct("<8sQQQQ")
+MAGIC = b"DCSSGID1"
+# Target false positive rate when the filter is at capacity
+ERROR_RATE = 0.001
+MIN_CAPACITY = 100000
+
+
+class GidFilter:
+    """A Bloom filter of gids.
+
+    Thread-safe, so it can be shared by concurrent imports.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.num_bits = max(
+            8, int(-capacity * math.log(ERROR_RATE) / math.log(2) ** 2)
+        )
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        # Number of gids added
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _indexes(self, gid: str) -> Iterable[int]:
+        """Bit indexes for a gid (using double hashing)."""
+        digest = hashlib.blake2b(gid.encode("utf8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, gid: str) -> None:
+        """Add a gid to the filter."""
+        with self._lock:
+            for i in self._indexes(gid):
+                self.bits[i >> 3] |= 1 << (i & 7)
+            self.count += 1
+
+    def __contains__(self, gid: str) -> bool:
+        """Return False if gid is definitely not in the filter."""
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(gid))
+
+    @property
+    def full(self) -> bool:
+        """Has the filter exceeded its target error rate?"""
+        return self.count > self.capacity
+
+    def save(self, path: str) -> None:
+        """Save the filter to path (atomically)."""
+        tmp = path + ".tmp"
+        with self._lock, open(tmp, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC, self.num_bits, self.num_hashes, self.capacity, self.count
+                )
+            )
+            f.write(self.bits)
+        os.replace(tmp, path)
+
+    @classmethod
+    def read(cls, path: str) -> Optional["GidFilter"]:
+        """Read a filter saved with save, or return None if it's unusable."""
+        try:
+            with open(path, "rb") as f:
+                magic, num_bits, num_hashes, capacity, count = HEADER.unpack(
+                    f.read(HEADER.size)
+                )
+                bits = bytearray(f.read())
+        except (OSError, struct.error):
+            return None
+        if magic != MAGIC or len(bits) != (num_bits + 7) // 8:
+            return None
+        gid_filter = cls.__new__(cls)
+        gid_filter.capacity = capacity
+        gid_filter.num_bits = num_bits
+        gid_filter.num_hashes = num_hashes
+        gid_filter.bits = bits
+        gid_filter.count = count
+        gid_filter._lock = threading.Lock()
+        return gid_filter
+
+
+def build(s: sqlalchemy.orm.session.Session, num_games: int) -> GidFilter:
+    """Build a filter from the gids in the database.
+
+    The filter is sized for twice the current number of games, so it doesn't
+    need rebuilding for a while.
+    """
+    gid_filter = GidFilter(max(MIN_CAPACITY, num_games * 2))
+    for gid in model.iter_gids(s):
+        gid_filter.add(gid)
+    return gid_filter
+
+
+def load(path: str) -> GidFilter:
+    """Load the filter saved at path, rebuilding it if needed."""
+    s = orm.get_session()
+    try:
+        num_games = model.count_games(s)
+        gid_filter = GidFilter.read(path)
+        if gid_filter is None:
+            print("Building gid filter for %s games" % num_games)
+        elif gid_filter.count < num_games:
+            print(
+                "Gid filter is out of date (%s < %s games), rebuilding"
+                % (gid_filter.count, num_games)
+            )
+            gid_filter = None
+        elif gid_filter.full:
+            print("Gid filter is full, rebuilding")
+            gid_filter = None
+        if gid_filter is None:
+            gid_filter = build(s, num_games)
+            gid_filter.save(path)
+    finally:
+        s.close()
+    return gid_filter
@@ -1,177 +1,1413 @@
 """Handle reading logfiles and parsing them."""
 
+import io
+import os
 import re
+import json
+import mmap
 import time
+import random
+import datetime
+import functools
+import threading
 import traceback
+import collections
+import concurrent.futures
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import sqlalchemy.orm  # for sqlalchemy.orm.session.Session type hints
 import requests
+import urllib3
+
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json  # type: ignore
+    except ImportError:
+        fast_json = None  # type: ignore
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 import scoreboard.constants as const
+import scoreboard.gidfilter as gidfilter
+import scoreboard.metrics as metrics
 import scoreboard.model as model
 import scoreboard.modelutils as modelutils
 import scoreboard.orm as orm
 import scoreboard.util as util
 
-# Logfile format escapes : as ::, so we use re.split
-# instead of the naive line.split(':')
-LINE_SPLIT_PATTERN = re.compile("(?<!:):(?!:)")
+# Logfile fields which the game API returns as integers
+LOGFILE_INTEGER_FIELDS = frozenset(
+    (
+        "lvl",
+        "xl",
+        "turn",
+        "dur",
+        "sc",
+        "urune",
+        "potionsused",
+        "scrollsused",
+        "dam",
+        "sdam",
+        "tdam",
+    )
+)
+# Bytes of logfile to read per unit of work. Roughly 1000 games.
+LOGFILE_CHUNK_SIZE = 2 ** 20
+
+IMPORTED = metrics.registry.counter(
+    "scoreboard_imported_total", "Games or milestones imported, by source"
+)
+IMPORT_RATE = metrics.registry.gauge(
+    "scoreboard_import_per_second", "Import throughput, by source"
+)
+IMPORT_LAG = metrics.registry.gauge(
+    "scoreboard_import_lag_seconds", "Age of the newest event imported, by source"
+)
+REJECTED = metrics.registry.counter(
+    "scoreboard_rejected_games_total", "Games rejected, by reason"
+)
+API_LATENCY = metrics.registry.histogram(
+    "scoreboard_api_request_seconds", "Game API request latency, by source"
+)
+API_RETRIES = metrics.registry.counter(
+    "scoreboard_api_retries_total", "Failed game API requests, by source"
+)
+API_TIMEOUTS = metrics.registry.counter(
+    "scoreboard_api_timeouts_total", "Timed out game API requests, by source"
+)
+
+# RejectedGame reasons
+REJECT_MISSING_FIELD = "missing_field"
+REJECT_UNPARSEABLE = "unparseable"
+REJECT_INVALID = "invalid"
+REJECT_DB_ERROR = "db_error"
+# Rejected games to print per reason per import. The rest are only counted.
+REJECT_LOG_LIMIT = 10
+
+
+class RejectionLog:
+    """Rate-limited logging of rejected games, with counts per reason."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.counts = collections.Counter()  # type: collections.Counter
+        self._lock = threading.Lock()
+
+    def note(self, reason: str, detail: str) -> None:
+        """Log a rejected game, unless too many have been logged already."""
+        REJECTED.inc(reason=reason)
+        with self._lock:
+            self.counts[reason] += 1
+            count = self.counts[reason]
+        if count <= self.limit:
+            print("Rejected game (%s): %s" % (reason, detail))
+        if count == self.limit:
+            print("Further %s rejections will only be counted" % reason)
+
+    def summary(self) -> None:
+        """Print the number of games rejected for each reason, and reset."""
+        with self._lock:
+            counts, self.counts = self.counts, collections.Counter()
+        if counts:
+            print(
+                "Rejected games (see rejected_games table): %s"
+                % ", ".join("%s: %s" % item for item in sorted(counts.items()))
+            )
+
+
+rejections = RejectionLog(REJECT_LOG_LIMIT)
 
 
-@util.retry(max_tries=3, wait=5)
-def request_logfile_lines(url, current_key):
+class GameRejected(Exception):
+    """Raised by GameNormaliser when a game record is invalid."""
+
+    def __init__(self, reason: str, detail: str) -> None:
+        super().__init__(detail)
+        self.reason = reason
+        self.detail = detail
+
+
+def reject(api_game: dict, reason: str, detail: str) -> dict:
+    """Log a rejected game record, and return its RejectedGame columns."""
+    rejections.note(reason, "%s (%.200s)" % (detail, api_game))
+    return {
+        "src": api_game.get("src_abbr", ""),
+        "reason": reason,
+        "detail": detail[:1000],
+        "record": json.dumps(api_game),
+        "rejected": datetime.datetime.utcnow(),
+    }
+
+
+# Decode with orjson/ujson if available (see requirements-speedups.txt)
+json_loads = fast_json.loads if fast_json is not None else json.loads
+
+
+# ApiController settings
+API_MIN_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 5000
+# Grow the page size when responses take less than half this, and shrink it
+# when they take longer.
+API_TARGET_LATENCY = 2.0
+API_TIMEOUT = 15
+# Consecutive failed requests before the circuit breaker opens
+API_MAX_TRIES = 5
+API_BACKOFF_BASE = 1.0
+API_BACKOFF_MAX = 60.0
+# Seconds before an open circuit breaker lets another request through
+API_CIRCUIT_COOLDOWN = 300.0
+# Errors reading or decoding a response, which count as failed requests.
+# Streamed responses are read straight from urllib3.
+API_READ_ERRORS = (
+    ValueError,
+    requests.exceptions.RequestException,
+    urllib3.exceptions.HTTPError,
+) + ((ijson.JSONError,) if ijson is not None else ())  # type: tuple
+
+
+def request_logfile_lines(url, current_key, stream=False, args=None, timeout=15):
     """Request another batch of logfile lines.
 
+    If stream is True, the response body is left to be read by decode_page.
+    args are the API arguments, defaulting to const.LOGFILE_API_GAME_ARGS.
+    Retrying is left to the caller (see ApiController).
+
     May raise requests.exceptions.ReadTimeout.
     """
-    params = const.LOGFILE_API_GAME_ARGS
-    params["offset"] = current_key
+    if args is None:
+        args = const.LOGFILE_API_GAME_ARGS
+    params = dict(args, offset=current_key)
     start = time.time()
-    r = requests.get(url, params, timeout=15)
+    r = requests.get(url, params, timeout=timeout, stream=stream)
     total = time.time() - start
     print(
-        "Log API request from offset %s finished in %.1d seconds"
-        % (params["offset"], total)
+        "Log API request to %s from offset %s finished in %.1f seconds"
+        % (url, params["offset"], total)
     )
     if r.status_code != 200:
         raise RuntimeError("HTTP response code %s" % r.status_code)
     return r
 
 
-def load_logfiles(api_url: str) -> None:
-    """Read logfiles and parse their data.
+class RateLimiter:
+    """Spaces out requests to an API, across all the threads using it.
 
-    Logfiles are kept in a directory with structure:
-    logdir/{src}/{log or milestone file}.
+    Parameters:
+        min_interval: minimum seconds between requests
     """
-    print("Loading all logfiles")
-    start = time.time()
-    games = 0
+
+    def __init__(self, min_interval: float) -> None:
+        self.min_interval = min_interval
+        self.next_request = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Wait until the next request can be made."""
+        with self.lock:
+            now = time.time()
+            wait = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.min_interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class CircuitOpen(Exception):
+    """Raised by ApiController when the game API has failed too often."""
+
+    pass
+
+
+class ApiController:
+    """Page size, retries and circuit breaker for requests to a game API.
+
+    The page size grows while responses are fast, and shrinks when they're
+    slow or time out. Failed requests are retried with exponential backoff
+    and full jitter. After API_MAX_TRIES failures in a row the circuit
+    breaker opens: CircuitOpen is raised, and further requests are refused
+    until API_CIRCUIT_COOLDOWN has passed.
+    """
+
+    def __init__(self, page_size: int) -> None:
+        self.page_size = min(max(page_size, API_MIN_PAGE_SIZE), API_MAX_PAGE_SIZE)
+        self.latencies = collections.deque(maxlen=1000)  # type: collections.deque
+        self.requests = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.failures = 0  # in a row
+        self.open_until = None  # type: Optional[float]
+
+    def request(
+        self, url: str, current_key: int, args: dict, stream: bool = False
+    ) -> dict:
+        """Request a page from the API and decode it, retrying as needed.
+
+        Failing to read or decode the response counts as a failed request.
+        See decode_page for stream.
+
+        Raises CircuitOpen if the API keeps failing.
+        """
+        if self.open_until is not None:
+            if time.time() < self.open_until:
+                raise CircuitOpen("%s is failing, not retrying yet" % url)
+            # Half-open: let one request through
+            self.failures = API_MAX_TRIES - 1
+        while True:
+            start = time.time()
+            self.requests += 1
+            try:
+                r = request_logfile_lines(
+                    url,
+                    current_key,
+                    stream=stream,
+                    args=dict(args, limit=str(self.page_size)),
+                    timeout=API_TIMEOUT,
+                )
+            except (requests.exceptions.RequestException, RuntimeError) as e:
+                self._failed(url, e)
+                continue
+            try:
+                response = decode_page(r, stream)
+            except API_READ_ERRORS as e:
+                print("Failed to decode the response from %s" % url)
+                # A streamed response has already been consumed
+                if not stream:
+                    print(r.text)
+                self._failed(url, e)
+                continue
+            API_LATENCY.observe(time.time() - start, source=url)
+            self._succeeded(time.time() - start)
+            return response
+
+    def _succeeded(self, latency: float) -> None:
+        """Record a successful request, and adapt the page size."""
+        self.latencies.append(latency)
+        self.failures = 0
+        self.open_until = None
+        if latency < API_TARGET_LATENCY / 2:
+            self.page_size = min(API_MAX_PAGE_SIZE, self.page_size * 3 // 2)
+        elif latency > API_TARGET_LATENCY:
+            self.page_size = max(API_MIN_PAGE_SIZE, self.page_size // 2)
+
+    def _failed(self, url: str, e: Exception) -> None:
+        """Record a failed request, then wait or open the circuit breaker."""
+        self.failures += 1
+        API_RETRIES.inc(source=url)
+        if isinstance(
+            e, (requests.exceptions.Timeout, urllib3.exceptions.TimeoutError)
+        ):
+            self.timeouts += 1
+            API_TIMEOUTS.inc(source=url)
+            self.page_size = max(API_MIN_PAGE_SIZE, self.page_size // 2)
+        if self.failures >= API_MAX_TRIES:
+            self.open_until = time.time() + API_CIRCUIT_COOLDOWN
+            raise CircuitOpen(
+                "%s failed %s times in a row (%s)" % (url, self.failures, e)
+            )
+        self.retries += 1
+        wait = random.uniform(
+            0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** self.failures)
+        )
+        print(
+            "Request to %s failed (%s), waiting %.1f secs and retrying"
+            % (url, e, wait)
+        )
+        time.sleep(wait)
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """Return a percentile (0-100) of recent request latencies."""
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        index = int(len(latencies) * percentile / 100)
+        return latencies[min(len(latencies) - 1, index)]
+
+    def stats(self) -> dict:
+        """Return the controller's current state and counters."""
+        return {
+            "page_size": self.page_size,
+            "requests": self.requests,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "circuit_open": self.open_until is not None,
+            "latency_p50": self.latency_percentile(50),
+            "latency_p90": self.latency_percentile(90),
+            "latency_p99": self.latency_percentile(99),
+        }
+
+    def __str__(self) -> str:
+        stats = self.stats()
+        return (
+            "page size %(page_size)s, %(requests)s requests, %(retries)s retries, "
+            "latency p50/p90/p99 %(latency_p50).2f/%(latency_p90).2f/"
+            "%(latency_p99).2f secs" % stats
+            if self.latencies
+            else "page size %(page_size)s, %(requests)s requests, "
+            "%(retries)s retries" % stats
+        )
+
+
+class SourceStats:
+    """Import throughput and lag for a single source."""
+
+    def __init__(
+        self, source_url: str, kind: str = "games", time_column: Optional[int] = None
+    ) -> None:
+        """Create import stats.
+
+        Parameters:
+            kind: what's being imported, 'games' or 'milestones'
+            time_column: index of the event time in imported rows. Defaults
+                to the game end time.
+        """
+        self.source_url = source_url
+        self.kind = kind
+        self.time_column = GAME_END_COLUMN if time_column is None else time_column
+        self.events = 0
+        self.start = time.time()
+        self.end = None  # type: Optional[float]
+        # Time of the most recent event (eg game end) imported
+        self.newest_event = None  # type: Optional[datetime.datetime]
+        # For local logfiles, bytes not yet imported
+        self.bytes_behind = None  # type: Optional[int]
+        # For API sources
+        self.api = None  # type: Optional[ApiController]
+        # Why the import stopped early, if it did
+        self.stopped = None  # type: Optional[str]
+
+    def add_rows(self, rows: Sequence[tuple]) -> None:
+        """Record newly imported rows."""
+        self.events += len(rows)
+        if rows:
+            newest = max(row[self.time_column] for row in rows)
+            if self.newest_event is None or newest > self.newest_event:
+                self.newest_event = newest
+
+    def finish(self) -> None:
+        """Record that the import from this source is finished."""
+        self.end = time.time()
+        IMPORTED.inc(self.events, source=self.source_url, kind=self.kind)
+        IMPORT_RATE.set(self.per_sec, source=self.source_url, kind=self.kind)
+        if self.lag is not None:
+            IMPORT_LAG.set(
+                self.lag.total_seconds(), source=self.source_url, kind=self.kind
+            )
+
+    @property
+    def duration(self) -> float:
+        """Seconds spent importing from this source."""
+        return (self.end or time.time()) - self.start
+
+    @property
+    def per_sec(self) -> float:
+        """Import throughput."""
+        return self.events / self.duration if self.duration else 0.0
+
+    @property
+    def lag(self) -> Optional[datetime.timedelta]:
+        """How long ago the most recent event imported happened."""
+        if self.newest_event is None:
+            return None
+        return datetime.datetime.utcnow() - self.newest_event
+
+    def __str__(self) -> str:
+        behind = []
+        if self.lag is not None:
+            behind.append("newest was %s ago" % str(self.lag).split(".")[0])
+        if self.bytes_behind is not None:
+            behind.append("%s bytes behind" % self.bytes_behind)
+        if self.api is not None:
+            behind.append(str(self.api))
+        if self.stopped is not None:
+            behind.append("stopped early: %s" % self.stopped)
+        return "%s: %s new %s in %.2f secs (%.1f/sec)%s" % (
+            self.source_url,
+            self.events,
+            self.kind,
+            self.duration,
+            self.per_sec,
+            ", " + ", ".join(behind) if behind else "",
+        )
+
+
+def _iter_results(f: io.RawIOBase, header: dict) -> Iterator[dict]:
+    """Incrementally parse a game API response, yielding its results.
+
+    The response's other top-level fields are stored in header as they're
+    found.
+    """
+    events = ijson.parse(f, use_float=True)
+    for prefix, event, value in events:
+        if prefix == "results.item" and event == "start_map":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            for prefix, event, value in events:
+                builder.event(event, value)
+                if prefix == "results.item" and event == "end_map":
+                    break
+            yield builder.value
+        elif "." not in prefix and event in ("string", "number", "boolean", "null"):
+            header[prefix] = value
+
+
+def decode_page(r: requests.models.Response, stream: bool = False) -> dict:
+    """Decode a game API response.
+
+    If stream is True (and ijson is installed), the response is parsed as
+    it's downloaded, so the raw response is never held in memory. Use with
+    request_logfile_lines(..., stream=True).
+    """
+    if stream and ijson is not None:
+        r.raw.decode_content = True
+        response = {}  # type: dict
+        response["results"] = list(_iter_results(r.raw, response))
+        return response
+    return json_loads(r.content)
+
+
+def _no_op(*args) -> None:  # type: ignore
+    """Do nothing."""
+    pass
+
+
+class PageImporter:
+    """Import pages of games from a source, committing every so often.
+
+    Each page's games and the source's progress are saved in the same
+    transaction, so a crash loses nothing but uncommitted pages, which are
+    imported again next time.
+
+    Each commit ends a unit of work (and session), so nothing loaded while
+    importing outlives it. Use as a context manager, which commits on a clean
+    exit.
+    """
+
+    def __init__(
+        self,
+        source_url: str,
+        add_page: Callable,
+        note_session: Callable,
+        commit_pages: int = 1,
+        commit_interval: Optional[float] = None,
+        on_commit: Callable = _no_op,
+        counter: Optional[str] = None,
+    ) -> None:
+        """Create a page importer.
+
+        Parameters:
+            source_url: source url, for LogfileProgress
+            add_page: called with (session, page) to add a page of events to
+                the database, returning the rows added (eg add_games)
+            commit_pages: commit after this many pages
+            commit_interval: commit when this many seconds have passed since
+                the last commit (at the end of a page)
+            on_commit: called with the rows added by each commit, once
+                they're committed (eg to score the games, see pipeline)
+            counter: status counter to add the number of rows added to. It's
+                updated just before each commit, so concurrent importers only
+                wait for each other's row lock while committing.
+        """
+        self.source_url = source_url
+        self.add_page = add_page
+        self.note_session = note_session
+        self.commit_pages = commit_pages
+        self.commit_interval = commit_interval
+        self.on_commit = on_commit
+        self.counter = counter
+        self.s = orm.get_session()
+        self.pages = 0
+        self.added = []  # type: List[tuple]
+        self.last_commit = time.time()
+
+    def __enter__(self) -> "PageImporter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:  # type: ignore
+        if exc_type is None:
+            self.commit()
+        self.s.close()
+
+    def import_page(self, page: Iterable[dict], next_key: int) -> List[tuple]:
+        """Import a page of events and save the source's progress.
+
+        Returns the rows added.
+        """
+        added = self.add_page(self.s, page)
+        model.save_logfile_progress(self.s, self.source_url, next_key)
+        self.pages += 1
+        self.added.extend(added)
+        if self.pages >= self.commit_pages or (
+            self.commit_interval is not None
+            and time.time() - self.last_commit >= self.commit_interval
+        ):
+            self.commit()
+        return added
+
+    def commit(self) -> None:
+        """Commit the pages imported so far, and start a new session."""
+        if not self.pages:
+            return
+        if self.counter is not None:
+            model.adjust_status_counter(self.s, self.counter, len(self.added))
+        self.s.commit()
+        self.note_session(self.s)
+        self.s.close()
+        self.s = orm.get_session()
+        self.pages = 0
+        self.last_commit = time.time()
+        added, self.added = self.added, []
+        self.on_commit(added)
+
+
+def _load_api(
+    api_url: str,
+    stats: SourceStats,
+    progress_url: str,
+    args: dict,
+    add_page: Callable,
+    *,
+    min_interval: float,
+    stream: bool,
+    note_session: Callable,
+    commit_pages: int,
+    commit_interval: Optional[float],
+    controller: Optional[ApiController],
+    limiter: Optional[RateLimiter],
+    on_commit: Callable = _no_op,
+    counter: Optional[str] = None
+) -> SourceStats:
+    """Import new events from the game API.
+
+    If the API keeps failing, the import stops early (see ApiController),
+    keeping the progress made so far.
+
+    See load_logfiles for parameters.
+
+    Parameters:
+        stats: SourceStats to record progress in
+        progress_url: source url for LogfileProgress
+        args: API arguments, eg const.LOGFILE_API_GAME_ARGS
+        add_page, counter: see PageImporter
+    """
+    if controller is None:
+        controller = ApiController(int(args["limit"]))
+    if limiter is None:
+        limiter = RateLimiter(min_interval)
+    stats.api = controller
+    s = orm.get_session()
+    try:
+        current_key = model.get_logfile_progress(s, progress_url).current_key
+    finally:
+        s.close()
+
+    with PageImporter(
+        progress_url,
+        add_page,
+        note_session,
+        commit_pages,
+        commit_interval,
+        on_commit,
+        counter,
+    ) as importer:
+        while True:
+            limiter.wait()
+            try:
+                response = controller.request(api_url, current_key, args, stream)
+            except CircuitOpen as e:
+                print("Stopping import from %s: %s" % (api_url, e))
+                stats.stopped = str(e)
+                break
+            assert response["status"] == 200 and response["message"] == "OK"
+
+            if not len(response["results"]):
+                break
+
+            # The API can repeat events from before the offset asked for.
+            # They were imported (and counted, for milestones) in the same
+            # transaction as the progress which skips them, so drop them.
+            events = [
+                event
+                for event in response["results"]
+                if event.get("id", current_key) >= current_key
+            ]
+            previous_events = stats.events
+            current_key = max(current_key, response["next_offset"])
+            stats.add_rows(importer.import_page(events, current_key))
+            if stats.events // 10000 > previous_events // 10000:
+                print(
+                    "Processed %s %s from %s..." % (stats.events, stats.kind, api_url)
+                )
+    stats.finish()
+    print(stats)
+    return stats
+
+
+def load_logfiles(
+    api_url: str,
+    *,
+    min_interval: float = 0,
+    stream: bool = False,
+    normaliser: Optional["GameNormaliser"] = None,
+    gid_filter: Optional[gidfilter.GidFilter] = None,
+    note_session: Callable = _no_op,
+    commit_pages: int = 1,
+    commit_interval: Optional[float] = None,
+    controller: Optional[ApiController] = None,
+    limiter: Optional[RateLimiter] = None,
+    on_commit: Callable = _no_op
+) -> SourceStats:
+    """Import new games from the game API.
+
+    Parameters:
+        api_url: game API url
+        min_interval: minimum seconds between requests to the API
+        stream: parse API responses as they're downloaded (needs ijson)
+        normaliser: GameNormaliser to share with other sources
+        gid_filter: GidFilter of already imported games (see add_games)
+        note_session: called with each unit of work's session (see
+            util.memory_report)
+        commit_pages, commit_interval: how often to commit (see
+            PageImporter)
+        controller: ApiController to use, eg to keep its state between
+            imports
+        limiter: RateLimiter to share with other imports from the same API
+            (eg load_milestones), instead of one for min_interval
+        on_commit: called with the rows of the games added by each commit
+            (see PageImporter)
+    """
+    print("Loading games from %s" % api_url)
+    if normaliser is None:
+        normaliser = GameNormaliser()
+    return _load_api(
+        api_url,
+        SourceStats(api_url),
+        api_url,
+        const.LOGFILE_API_GAME_ARGS,
+        lambda s, page: add_games(s, page, normaliser, gid_filter),
+        min_interval=min_interval,
+        stream=stream,
+        note_session=note_session,
+        commit_pages=commit_pages,
+        commit_interval=commit_interval,
+        controller=controller,
+        limiter=limiter,
+        on_commit=on_commit,
+        counter=model.UNSCORED_GAMES,
+    )
+
+
+def load_milestones(
+    api_url: str,
+    *,
+    min_interval: float = 0,
+    stream: bool = False,
+    note_session: Callable = _no_op,
+    commit_pages: int = 1,
+    commit_interval: Optional[float] = None,
+    controller: Optional[ApiController] = None,
+    limiter: Optional[RateLimiter] = None
+) -> SourceStats:
+    """Import new milestones from the game API into per-player aggregates.
+
+    Progress is saved separately from the API's games (see
+    MILESTONE_PROGRESS_SUFFIX). See load_logfiles for parameters.
+    """
+    print("Loading milestones from %s" % api_url)
+    return _load_api(
+        api_url,
+        SourceStats(api_url, "milestones", MILESTONE_TIME_COLUMN),
+        api_url + MILESTONE_PROGRESS_SUFFIX,
+        const.LOGFILE_API_MILESTONE_ARGS,
+        add_milestones,
+        min_interval=min_interval,
+        stream=stream,
+        note_session=note_session,
+        commit_pages=commit_pages,
+        commit_interval=commit_interval,
+        controller=controller,
+        limiter=limiter,
+    )
+
+
+def parse_logfile_line(line: str) -> dict:
+    """Parse a logfile line into a dict like the game API's 'data'.
+
+    Fields are separated by ':', and literal colons in values are escaped as
+    '::'.
+    """
+    data = {}
+    for field in line.replace("::", "\0").split(":"):
+        key, _, value = field.partition("=")
+        if "\0" in value:
+            value = value.replace("\0", ":")
+        if key in LOGFILE_INTEGER_FIELDS:
+            data[key] = int(value)
+        else:
+            data[key] = value
+    return data
+
+
+def load_local_logfile(
+    path: str,
+    src: str,
+    *,
+    normaliser: Optional["GameNormaliser"] = None,
+    gid_filter: Optional[gidfilter.GidFilter] = None,
+    note_session: Callable = _no_op,
+    commit_pages: int = 1,
+    commit_interval: Optional[float] = None,
+    on_commit: Callable = _no_op
+) -> SourceStats:
+    """Import new games from a local logfile (eg one mirrored with rsync).
+
+    The logfile is read with mmap, starting from the byte offset saved by the
+    previous run, so each run only parses lines appended since then. Only
+    complete lines are imported.
+
+    Parameters:
+        path: path to the logfile
+        src: abbreviation of the server the logfile came from, eg 'cao'
+        normaliser: GameNormaliser to share with other sources
+        gid_filter: GidFilter of already imported games (see add_games)
+        note_session: called with each unit of work's session (see
+            util.memory_report)
+        commit_pages, commit_interval: how often to commit (see
+            PageImporter)
+        on_commit: called with the rows of the games added by each commit
+            (see PageImporter)
+    """
+    url = "file://" + os.path.abspath(path)
+    print("Loading games from %s (%s)" % (url, src))
+    stats = SourceStats(url)
+    if normaliser is None:
+        normaliser = GameNormaliser()
     s = orm.get_session()
+    try:
+        offset = model.get_logfile_progress(s, url).current_key
+    finally:
+        s.close()
+
+    size = os.path.getsize(path)
+    if size < offset:
+        print(
+            "Warning: %s is smaller than the saved offset (%s < %s), skipping"
+            % (path, size, offset)
+        )
+        stats.finish()
+        return stats
+
+    if size > offset:
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as m, PageImporter(
+            url,
+            lambda s, page: add_games(s, page, normaliser, gid_filter),
+            note_session,
+            commit_pages,
+            commit_interval,
+            on_commit,
+            model.UNSCORED_GAMES,
+        ) as importer:
+            while offset < size:
+                # Import everything up to the last newline in the chunk, or
+                # the end of the first line if it's longer than the chunk.
+                end = m.rfind(b"\n", offset, offset + LOGFILE_CHUNK_SIZE)
+                if end == -1:
+                    end = m.find(b"\n", offset)
+                if end == -1:
+                    # Incomplete line, wait for the rest of it
+                    break
+                lines = m[offset:end].decode("utf8", errors="replace").split("\n")
+                page = []
+                for line in lines:
+                    if not line:
+                        continue
+                    try:
+                        data = parse_logfile_line(line)
+                    except ValueError:
+                        # Rejected by the normaliser
+                        page.append({"src_abbr": src, "line": line})
+                        continue
+                    page.append({"src_abbr": src, "data": data})
+                offset = end + 1
+                previous_games = stats.events
+                stats.add_rows(importer.import_page(page, offset))
+                if stats.events // 10000 > previous_games // 10000:
+                    print("Processed %s games from %s..." % (stats.events, url))
+    stats.bytes_behind = size - offset
+    stats.finish()
+    print(stats)
+    return stats
+
 
-    url = api_url
-    current_key = model.get_logfile_progress(s, url).current_key
+def import_sources(
+    api_urls: Sequence[str],
+    logfiles: Sequence[Tuple[str, str]],
+    *,
+    workers: int = 4,
+    min_interval: float = 0,
+    stream: bool = False,
+    gid_filter_path: Optional[str] = None,
+    commit_pages: int = 1,
+    commit_interval: Optional[float] = None,
+    milestones: bool = False,
+    on_commit: Callable = _no_op,
+    on_done: Callable = _no_op
+) -> List[SourceStats]:
+    """Import new games from several sources concurrently.
 
-    while True:
-        r = request_logfile_lines(url, current_key)
+    Each source keeps its own progress, and a failing or slow source doesn't
+    stop the others. Dimension ids (players, versions, etc) are shared.
+
+    Parameters:
+        api_urls: game API urls
+        logfiles: (src, path) tuples of local logfiles
+        workers: maximum number of sources to import from at once
+        min_interval: minimum seconds between requests to each API (for
+            its games and milestones together)
+        stream: parse API responses as they're downloaded (needs ijson)
+        gid_filter_path: if specified, a GidFilter of imported games is
+            loaded from (and saved back to) this path, so games which have
+            already been imported are skipped cheaply.
+        commit_pages, commit_interval: how often to commit (see
+            PageImporter)
+        milestones: also import milestones from the game APIs (see
+            load_milestones)
+        on_commit: called (from the import threads) with the source (its
+            api url or logfile path) and the rows of the games added by
+            each commit (see PageImporter)
+        on_done: called with each game source once it's finished
+            importing, or failed
+
+    Returns:
+        SourceStats for each source which was imported successfully.
+    """
+    print("Loading latest games from %s sources" % (len(api_urls) + len(logfiles)))
+    start = time.time()
+    if stream and ijson is None:
+        print("Warning: ijson isn't installed, not streaming API responses")
+    normaliser = GameNormaliser()
+    gid_filter = gidfilter.load(gid_filter_path) if gid_filter_path else None
+    results = []
+    with util.memory_report("load_logfiles") as note_session:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            milestone_futures = set()
+            for url in api_urls:
+                # Games and milestones come from the same API
+                limiter = RateLimiter(min_interval)
+                future = pool.submit(
+                    load_logfiles,
+                    url,
+                    limiter=limiter,
+                    stream=stream,
+                    normaliser=normaliser,
+                    gid_filter=gid_filter,
+                    note_session=note_session,
+                    commit_pages=commit_pages,
+                    commit_interval=commit_interval,
+                    on_commit=functools.partial(on_commit, url),
+                )
+                futures[future] = url
+                if milestones:
+                    future = pool.submit(
+                        load_milestones,
+                        url,
+                        limiter=limiter,
+                        stream=stream,
+                        note_session=note_session,
+                        commit_pages=commit_pages,
+                        commit_interval=commit_interval,
+                    )
+                    futures[future] = url + MILESTONE_PROGRESS_SUFFIX
+                    milestone_futures.add(future)
+            for src, path in logfiles:
+                future = pool.submit(
+                    load_local_logfile,
+                    path,
+                    src,
+                    normaliser=normaliser,
+                    gid_filter=gid_filter,
+                    note_session=note_session,
+                    commit_pages=commit_pages,
+                    commit_interval=commit_interval,
+                    on_commit=functools.partial(on_commit, path),
+                )
+                futures[future] = path
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception:
+                    print("Couldn't import from %s:" % futures[future])
+                    print(traceback.format_exc())
+                if future not in milestone_futures:
+                    on_done(futures[future])
+    if gid_filter is not None:
+        gid_filter.save(gid_filter_path)
+
+    print("Import summary:")
+    for stats in results:
+        print("  %s" % stats)
+    rejections.summary()
+    print(
+        "Loaded %s new games in %s secs"
+        % (
+            sum(stats.events for stats in results if stats.kind == "games"),
+            round(time.time() - start, 2),
+        )
+    )
+    return results
+
+
+# Simplify version to 0.17/0.18/etc
+VERSION_PATTERN = re.compile(r"(0.\d+)")
+# Versions where 'Gn' meant Gnome, before Gnoll took that species code.
+GNOME_VERSIONS = frozenset(("0.1", "0.2", "0.3", "0.4", "0.5"))
+# Column order of the row tuples produced by GameNormaliser
+GAME_COLUMNS = (
+    "gid",
+    "account_id",
+    "player_id",
+    "species_id",
+    "background_id",
+    "god_id",
+    "version_id",
+    "place_id",
+    "xl",
+    "tmsg",
+    "turn",
+    "dur",
+    "runes",
+    "score",
+    "start",
+    "end",
+    "ktyp_id",
+    "potions_used",
+    "scrolls_used",
+    "dam",
+    "tdam",
+    "sdam",
+)
+GAME_END_COLUMN = GAME_COLUMNS.index("end")
+
+# Milestone aggregate kinds
+MILESTONE_RUNE = "rune"
+MILESTONE_UNIQUE = "unique"
+MILESTONE_BRANCH = "branch"
+# Milestone rows returned by add_milestones
+MILESTONE_COLUMNS = ("player_name", "kind", "key", "time")
+MILESTONE_TIME_COLUMN = MILESTONE_COLUMNS.index("time")
+# Milestone progress is saved as the API url plus this
+MILESTONE_PROGRESS_SUFFIX = "#milestones"
+
+
+def api_game_gid(api_game: dict) -> str:
+    """Return the gid of an API game record."""
+    data = api_game.get("data", {})
+    return "%s:%s:%s" % (data.get("name"), api_game["src_abbr"], data.get("start"))
+
+
+class GameNormaliser:
+    """Convert API game records into rows for the games table.
+
+    All the data cleansing (name fixups, the Gnome special case, version
+    simplification) and dimension id lookups are memoised per raw value, so
+    each distinct (version, char), god, place, ktyp and account is only
+    processed once per import rather than once per game.
+
+    Normalisers can be shared between importers in different threads: ids
+    of dimension rows which aren't committed yet are only memoised once
+    they are (see model.memoised).
+
+    Rows are tuples in GAME_COLUMNS order.
+    """
+
+    def __init__(self) -> None:
+        self._versions = model.IdMemo()
+        self._chars = model.IdMemo()
+        self._gods = model.IdMemo()
+        self._places = model.IdMemo()
+        self._ktyps = model.IdMemo()
+        self._accounts = model.IdMemo()
+
+    def _version(self, s: sqlalchemy.orm.session.Session, v: str) -> tuple:
+        """Return (short version, version id) for a raw version string."""
+        try:
+            return self._versions.ids[v]
+        except KeyError:
+            short = VERSION_PATTERN.match(v).group()
+            return model.memoised(
+                s, self._versions, v, lambda: (short, model.get_version_id(s, short))
+            )
+
+    def _char(self, s: sqlalchemy.orm.session.Session, v: str, char: str) -> tuple:
+        """Return (species id, background id) for a short version and char."""
+        try:
+            return self._chars.ids[v, char]
+        except KeyError:
+            rc, bg = char[:2], char[2:]
+            if v in GNOME_VERSIONS and rc == "Gn":
+                rc = "Gm"
+            rc = const.SPECIES_SHORTNAME_FIXUPS.get(rc, rc)
+            bg = const.BACKGROUND_SHORTNAME_FIXUPS.get(bg, bg)
+            return model.memoised(
+                s,
+                self._chars,
+                (v, char),
+                lambda: (model.get_species_id(s, rc), model.get_background_id(s, bg)),
+            )
+
+    def _god(self, s: sqlalchemy.orm.session.Session, god: str) -> int:
+        """Return the god id for a raw god name."""
         try:
-            response = r.json()
-        except Exception:
-            print("Failed to decode into json")
-            print(r.text)
-            raise
-        assert response["status"] == 200 and response["message"] == "OK"
+            return self._gods.ids[god]
+        except KeyError:
+            name = const.GOD_NAME_FIXUPS.get(god, god)
+            return model.memoised(
+                s, self._gods, god, lambda: model.get_god_id(s, name)
+            )
 
-        if not len(response["results"]):
-            break
+    def _place(self, s: sqlalchemy.orm.session.Session, br: str, lvl: int) -> int:
+        """Return the place id for a raw branch name and level."""
+        try:
+            return self._places.ids[br, lvl]
+        except KeyError:
+            return model.memoised(
+                s,
+                self._places,
+                (br, lvl),
+                lambda: model.get_place_id(
+                    s,
+                    model.get_branch_id(s, const.BRANCH_NAME_FIXUPS.get(br, br)),
+                    lvl,
+                ),
+            )
+
+    def _ktyp(self, s: sqlalchemy.orm.session.Session, ktyp: str) -> int:
+        """Return the ktyp id for a raw ktyp."""
+        try:
+            return self._ktyps.ids[ktyp]
+        except KeyError:
+            name = const.KTYP_FIXUPS.get(ktyp, ktyp)
+            return model.memoised(
+                s, self._ktyps, ktyp, lambda: model.get_ktyp_id(s, name)
+            )
+
+    def _account(self, s: sqlalchemy.orm.session.Session, name: str, src: str) -> tuple:
+        """Return (account id, player id) for an account name and server."""
+        try:
+            return self._accounts.ids[name, src]
+        except KeyError:
+            return model.memoised(
+                s,
+                self._accounts,
+                (name, src),
+                lambda: (
+                    model.get_account_id(s, name, model.get_server_id(s, src)),
+                    model.get_player_id(s, name),
+                ),
+            )
 
-        for game in response["results"]:
+    def normalise(self, s: sqlalchemy.orm.session.Session, api_game: dict) -> tuple:
+        """Convert a single API game record into a row.
+
+        Returns None if the game should be skipped, and raises GameRejected
+        if the record is invalid.
+        """
+        data = api_game.get("data")
+        if data is None:
+            raise GameRejected(REJECT_UNPARSEABLE, "Couldn't parse logfile line")
+        # Validate the data -- some old broken games don't have these fields
+        for field in ("start", "v", "char"):
+            if field not in data:
+                raise GameRejected(REJECT_MISSING_FIELD, "Couldn't find %s" % field)
+        # We should only parse vanilla dcss games
+        if data["lv"] != "0.1":
+            return None
+
+        name = data["name"]
+        src = api_game["src_abbr"]
+        start = data["start"]
+        v, version_id = self._version(s, data["v"])
+        species_id, background_id = self._char(s, v, data["char"])
+        account_id, player_id = self._account(s, name, src)
+        dam = data.get("dam", 0)
+        return (
+            api_game_gid(api_game),
+            account_id,
+            player_id,
+            species_id,
+            background_id,
+            self._god(s, data.get("god", "Atheist")),
+            version_id,
+            self._place(s, data["br"], data["lvl"]),
+            data["xl"],
+            data.get("tmsg", ""),
+            data["turn"],
+            data["dur"],
+            data.get("urune", 0),
+            data["sc"],
+            modelutils.crawl_date_to_datetime(start),
+            modelutils.crawl_date_to_datetime(data["end"]),
+            self._ktyp(s, data["ktyp"]),
+            data.get("potionsused", -1),
+            data.get("scrollsused", -1),
+            dam,
+            data.get("tdam", dam),
+            data.get("sdam", dam),
+        )
+
+    def normalise_page(
+        self,
+        s: sqlalchemy.orm.session.Session,
+        api_games: Iterable[dict],
+        rejects: Optional[list] = None,
+    ) -> List[tuple]:
+        """Convert a page of API game records into rows.
+
+        Games which should be skipped, or are invalid, are left out.
+
+        Parameters:
+            rejects: if specified, RejectedGame columns for each invalid
+                record are appended to it (see reject).
+        """
+        if rejects is None:
+            rejects = []
+        rows = []
+        for api_game in api_games:
             try:
-                add_game(s, game)
-            except Exception as e:
-                print("Couldn't add game, skipping: %s" % game)
-            else:
-                games += 1
-            if games % 10000 == 0:
-                print("Processed %s games..." % games)
-
-        current_key = response["next_offset"]
-        model.save_logfile_progress(s, url, current_key)
-        s.commit()
-    s.commit()
-    end = time.time()
-    print("Loaded %s new games in %s secs" % (games, round(end - start, 2)))
+                row = self.normalise(s, api_game)
+            except GameRejected as e:
+                rejects.append(reject(api_game, e.reason, e.detail))
+                continue
+            except (KeyError, ValueError, TypeError, AttributeError) as e:
+                # Database errors aren't the game's fault, so they're raised
+                rejects.append(reject(api_game, REJECT_INVALID, repr(e)))
+                continue
+            if row is not None:
+                rows.append(row)
+        return rows
 
 
-def add_game(s: sqlalchemy.orm.session.Session, api_game: dict) -> bool:
-    """Add a game to the database.
+def add_games(
+    s: sqlalchemy.orm.session.Session,
+    api_games: Iterable[dict],
+    normaliser: Optional[GameNormaliser] = None,
+    gid_filter: Optional[gidfilter.GidFilter] = None,
+) -> List[tuple]:
+    """Add a page of games to the database.
 
-    Returns True if a game was found and successfully added.
+    Games which are already in the database are skipped. Invalid games are
+    added to the rejected_games table instead.
+
+    Parameters:
+        normaliser: GameNormaliser to share between pages
+        gid_filter: if specified, used to skip games which have already been
+            imported before normalising them, and only games which might
+            have been imported are looked up in the database. Added games
+            are added to the filter.
+
+    The caller adds the games to the model.UNSCORED_GAMES status counter,
+    just before committing (see PageImporter).
+
+    Returns the rows (see GAME_COLUMNS) of the games added.
     """
-    # Validate the data -- some old broken games don't have this field and
-    # and should be ignored.
-    if "start" not in api_game["data"]:
-        print("Couldn't find start in game, skipping (%s)" % api_game["data"])
-        return None
-    if "v" not in api_game["data"]:
-        print("Couldn't find v in game, skipping (%s)" % api_game["data"])
-        return None
-    if "char" not in api_game["data"]:
-        print("Couldn't find char in game, skipping (%s)" % api_game["data"])
-        return None
-    # We should only parse vanilla dcss games
-    if api_game["data"]["lv"] != "0.1":
-        return None
-
-    game = {}
-    game.update(api_game["data"])
-    game["gid"] = "%s:%s:%s" % (game["name"], api_game["src_abbr"], game["start"])
-    # Data cleansing
-    # Simplify version to 0.17/0.18/etc
-    game["v"] = re.match(r"(0.\d+)", game["v"]).group()
-    if "god" not in game:
-        game["god"] = "Atheist"
-    # Normalise old data
-    game["god"] = const.GOD_NAME_FIXUPS.get(game["god"], game["god"])
-    game["race"] = const.SPECIES_NAME_FIXUPS.get(game["race"], game["race"])
-    # Special fixup for Gnome, which was the original Gn, before Gnoll took
-    # that species code.
-    if game["v"] in ("0.1", "0.2", "0.3", "0.4", "0.5") and game["char"][:2] == "Gn":
-        game["char"] = "Gm" + game["char"][2:]
-    if game["char"][:2] in const.SPECIES_SHORTNAME_FIXUPS:
-        oldrace = game["char"][:2]
-        newrace = const.SPECIES_SHORTNAME_FIXUPS[oldrace]
-        game["char"] = newrace + game["char"][2:]
-    if game["char"][2:] in const.BACKGROUND_SHORTNAME_FIXUPS:
-        oldbg = game["char"][2:]
-        newbg = const.BACKGROUND_SHORTNAME_FIXUPS[oldbg]
-        game["char"] = game["char"][:2] + newbg
-    game["br"] = const.BRANCH_NAME_FIXUPS.get(game["br"], game["br"])
-    game["ktyp"] = const.KTYP_FIXUPS.get(game["ktyp"], game["ktyp"])
-    game["rc"] = game["char"][:2]
-    game["bg"] = game["char"][2:]
-
-    # Create a dict with the mappings needed for orm.Game objects
-    branch = model.get_branch(s, game["br"])
-    server = model.get_server(s, api_game["src_abbr"])
-    gamedict = {
-        "gid": game["gid"],
-        "account_id": model.get_account_id(s, game["name"], server),
-        "player_id": model.get_player_id(s, game["name"]),
-        "species_id": model.get_species(s, game["char"][:2]).id,
-        "background_id": model.get_background(s, game["char"][2:]).id,
-        "god_id": model.get_god(s, game["god"]).id,
-        "version_id": model.get_version(s, game["v"]).id,
-        "place_id": model.get_place(s, branch, game["lvl"]).id,
-        "xl": game["xl"],
-        "tmsg": game.get("tmsg", ""),
-        "turn": game["turn"],
-        "dur": game["dur"],
-        "runes": game.get("urune", 0),
-        "score": game["sc"],
-        "start": modelutils.crawl_date_to_datetime(game["start"]),
-        "end": modelutils.crawl_date_to_datetime(game["end"]),
-        "ktyp_id": model.get_ktyp(s, game["ktyp"]).id,
-        "potions_used": game.get("potionsused", -1),
-        "scrolls_used": game.get("scrollsused", -1),
-        "dam": game.get("dam", 0),
-        "tdam": game.get("tdam", game.get("dam", 0)),
-        "sdam": game.get("sdam", game.get("dam", 0)),
-    }
-    # Store the game in the database
+    if normaliser is None:
+        normaliser = GameNormaliser()
+    api_games = list(api_games)
+    rejects = []  # type: list
+    if gid_filter is None:
+        rows = normaliser.normalise_page(s, api_games, rejects)
+        known = model.existing_gids(s, [row[0] for row in rows])
+    else:
+        gids = [api_game_gid(api_game) for api_game in api_games]
+        known = model.existing_gids(s, [gid for gid in gids if gid in gid_filter])
+        if known:
+            print("Skipping %s already imported games" % len(known))
+            api_games = [
+                api_game
+                for api_game, gid in zip(api_games, gids)
+                if gid not in known
+            ]
+        rows = normaliser.normalise_page(s, api_games, rejects)
+    # Drop duplicates (within the page, and already imported) up front, so
+    # the page can be inserted in one go.
+    new_rows = []
+    for row in rows:
+        if row[0] in known:
+            print("Tried to import duplicate game: %s" % row[0])
+            continue
+        known.add(row[0])
+        new_rows.append(row)
+    # Use a savepoint, so a failure doesn't lose the caller's earlier work
     try:
-        model.add_games(s, [gamedict])
+        with s.begin_nested():
+            model.add_game_rows(s, GAME_COLUMNS, new_rows)
     except model.DBError:
-        print("Couldn't import %s. Exception follows:" % game)
+        print("Couldn't import %s games. Exception follows:" % len(new_rows))
         print(traceback.format_exc())
-        print()
-        s.rollback()
-        return False
+        print("Retrying one at a time")
+        new_rows = _add_game_rows_singly(s, new_rows, api_games, rejects)
     except model.DBIntegrityError:
-        print("Tried to import duplicate game: %s" % game["gid"])
-        s.rollback()
-        return False
-    else:
-        # s.commit()
-        pass
-    return True
+        # Someone else imported some of these games since we checked, or
+        # one of them is invalid
+        print("Tried to import duplicate games, retrying one at a time")
+        new_rows = _add_game_rows_singly(s, new_rows, api_games, rejects)
+    model.add_rejected_games(s, rejects)
+    if gid_filter is not None:
+        for row in new_rows:
+            gid_filter.add(row[0])
+    return new_rows
+
+
+def _add_game_rows_singly(
+    s: sqlalchemy.orm.session.Session,
+    rows: Sequence[tuple],
+    api_games: Sequence[dict],
+    rejects: list,
+) -> List[tuple]:
+    """Add game rows one at a time, each in its own savepoint.
+
+    Slow, so only used to recover from a failed page insert. Games which
+    someone else has imported since are skipped, and games which fail for
+    any other reason are added to rejects.
+
+    Parameters:
+        api_games: the page's API game records, for rejects
+        rejects: list of RejectedGame columns to add to
+    """
+    by_gid = {api_game_gid(api_game): api_game for api_game in api_games}
+    added = []
+    for row in rows:
+        try:
+            with s.begin_nested():
+                model.add_game_rows(s, GAME_COLUMNS, [row])
+        except (model.DBError, model.DBIntegrityError) as e:
+            if isinstance(e, model.DBIntegrityError) and model.existing_gids(
+                s, [row[0]]
+            ):
+                print("Tried to import duplicate game: %s" % row[0])
+                continue
+            print("Couldn't import %s: %r" % (row[0], e.__cause__))
+            if row[0] in by_gid:
+                rejects.append(
+                    reject(by_gid[row[0]], REJECT_DB_ERROR, repr(e.__cause__))
+                )
+        else:
+            added.append(row)
+    return added
+
+
+def add_game(s: sqlalchemy.orm.session.Session, api_game: dict) -> bool:
+    """Add a game to the database.
+
+    Returns True if a game was found and successfully added.
+    """
+    added = len(add_games(s, [api_game]))
+    model.adjust_status_counter(s, model.UNSCORED_GAMES, added)
+    return added == 1
+
+
+def milestone_aggregate_key(data: dict) -> Optional[Tuple[str, str]]:
+    """Return the (kind, key) aggregate a milestone counts towards, if any."""
+    milestone_type = data.get("type")
+    if milestone_type == "rune":
+        match = const.MILESTONE_RUNE_REGEX.search(data.get("milestone", ""))
+        return (MILESTONE_RUNE, match.group(1)) if match else None
+    elif milestone_type == "uniq":
+        match = const.MILESTONE_UNIQUE_REGEX.match(data.get("milestone", ""))
+        return (MILESTONE_UNIQUE, match.group(1)) if match else None
+    elif milestone_type == "br.enter" and "br" in data:
+        return MILESTONE_BRANCH, const.BRANCH_NAME_FIXUPS.get(data["br"], data["br"])
+    return None
+
+
+def add_milestones(
+    s: sqlalchemy.orm.session.Session, api_milestones: Iterable[dict]
+) -> List[tuple]:
+    """Add a page of milestones to the per-player aggregates.
+
+    Milestones which don't count towards an aggregate, aren't from vanilla
+    dcss, or are invalid, are skipped. Each milestone is counted every time
+    it's passed in, so callers drop ones they've already added (see
+    _load_api).
+
+    Returns the rows (see MILESTONE_COLUMNS) of the milestones counted.
+    """
+    rows = []
+    aggregates = {}  # type: dict
+    for api_milestone in api_milestones:
+        data = api_milestone.get("data", {})
+        if data.get("lv", "0.1") != "0.1" or "name" not in data:
+            continue
+        kind_key = milestone_aggregate_key(data)
+        if kind_key is None:
+            continue
+        try:
+            milestone_time = modelutils.crawl_date_to_datetime(data["time"])
+        except (KeyError, ValueError):
+            continue
+        key = (data["name"].lower(),) + kind_key
+        rows.append(key + (milestone_time,))
+        count, first, last = aggregates.get(key, (0, milestone_time, milestone_time))
+        aggregates[key] = (
+            count + 1,
+            min(first, milestone_time),
+            max(last, milestone_time),
+        )
+    model.add_milestone_aggregates(s, aggregates)
+    return rows
+
+
+def redrive_rejected_games(
+    *, reason: Optional[str] = None, batch_size: int = 1000
+) -> int:
+    """Try to import the games in the rejected_games table again.
+
+    Use after adding a fixup to constants for the problem. Games which are
+    still invalid are rejected again.
+
+    Parameters:
+        reason: If specified, only retry games rejected for this reason
+
+    Returns the number of games imported.
+    """
+    print("Re-importing rejected games")
+    start = time.time()
+    normaliser = GameNormaliser()
+    retried = imported = 0
+    s = orm.get_session()
+    try:
+        for batch in model.iter_rejected_game_batches(
+            s, reason=reason, batch_size=batch_size
+        ):
+            ids = [rejected.id for rejected in batch]
+            api_games = []
+            for rejected in batch:
+                api_game = json.loads(rejected.record)
+                if "line" in api_game:
+                    try:
+                        api_game = {
+                            "src_abbr": api_game["src_abbr"],
+                            "data": parse_logfile_line(api_game["line"]),
+                        }
+                    except ValueError:
+                        pass
+                api_games.append(api_game)
+            added = len(add_games(s, api_games, normaliser))
+            model.delete_rejected_games(s, ids)
+            model.adjust_status_counter(s, model.UNSCORED_GAMES, added)
+            s.commit()
+            imported += added
+            retried += len(ids)
+    finally:
+        s.close()
+    rejections.summary()
+    print(
+        "Re-imported %s of %s rejected games in %s secs"
+        % (imported, retried, round(time.time() - start, 2))
+    )
+    return imported
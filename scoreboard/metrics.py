@@ -0,0 +1,273 @@
+"""Pipeline metrics: counters, gauges and histograms.
+
+Metrics are recorded in a process-wide registry as the pipeline runs, and
+written out at the end of each run by `write`:
+
+- a Prometheus textfile collector file, so node_exporter can scrape a time
+  series of runs (eg across run-one-constantly cycles)
+- a JSON summary of the run, for humans and scripts
+
+Metrics are per run: counters start from zero in each process.
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+import collections
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+# Latency buckets in seconds, roughly Prometheus's defaults
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Where write puts its files, relative to the website dir
+METRICS_DIR = "metrics"
+PROMETHEUS_FILE = "scoreboard.prom"
+SUMMARY_FILE = "run.json"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> Labels:
+    """Return labels as a hashable, sorted tuple."""
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    """Format labels for the Prometheus text format."""
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, v.replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels
+    )
+
+
+class Metric:
+    """Base class for metrics. Values are kept per set of labels."""
+
+    kind = ""
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self.values = collections.OrderedDict()  # type: Dict[Labels, Any]
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        """Return (name, labels, value) for each sample."""
+        with self.lock:
+            return [
+                (self.name, labels, value)
+                for labels, value in self.values.items()
+            ]
+
+    def by_label(self, label: str) -> Dict[str, Any]:
+        """Return the values by one of their labels, eg stage seconds by stage."""
+        with self.lock:
+            return collections.OrderedDict(
+                (dict(labels).get(label, ""), value)
+                for labels, value in self.values.items()
+            )
+
+    def summary(self) -> dict:
+        """Return the metric's values for the JSON run summary."""
+        with self.lock:
+            return {
+                ",".join("%s=%s" % kv for kv in labels): value
+                for labels, value in self.values.items()
+            }
+
+
+class Counter(Metric):
+    """A count of things which happened during the run."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: object) -> None:
+        """Add amount to the counter."""
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value measured during the run, like a rate or a duration."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: object) -> None:
+        """Set the gauge's value."""
+        with self.lock:
+            self.values[_labels(labels)] = value
+
+
+class HistogramValue:
+    """Observations for one set of a histogram's labels."""
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(Metric):
+    """The distribution of observed values, like request latencies."""
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, description: str, buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels: object) -> None:
+        """Record an observation."""
+        key = _labels(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = HistogramValue(self.buckets)
+            hist = self.values[key]
+            hist.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            hist.count += 1
+            hist.sum += value
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        """Return cumulative bucket, count and sum samples."""
+        out = []
+        with self.lock:
+            for labels, hist in self.values.items():
+                cumulative = 0
+                bounds = [str(b) for b in self.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, hist.bucket_counts):
+                    cumulative += count
+                    out.append(
+                        (self.name + "_bucket", labels + (("le", bound),), cumulative)
+                    )
+                out.append((self.name + "_count", labels, hist.count))
+                out.append((self.name + "_sum", labels, hist.sum))
+        return out
+
+    def summary(self) -> dict:
+        """Return the count, sum and mean of observations."""
+        with self.lock:
+            return {
+                ",".join("%s=%s" % kv for kv in labels): {
+                    "count": hist.count,
+                    "sum": hist.sum,
+                    "mean": hist.sum / hist.count if hist.count else None,
+                }
+                for labels, hist in self.values.items()
+            }
+
+
+class Registry:
+    """All of a run's metrics, by name."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.metrics = collections.OrderedDict()  # type: Dict[str, Metric]
+        self.start = time.time()
+
+    def start_run(self) -> None:
+        """Start timing a new run, eg each cycle of the daemon.
+
+        Counters keep counting across runs.
+        """
+        self.start = time.time()
+
+    def _get(self, cls: type, name: str, description: str, **kwargs: object) -> Metric:
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, description, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name: str, description: str) -> Counter:
+        """Get or create a counter."""
+        return self._get(Counter, name, description)  # type: ignore
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        """Get or create a gauge."""
+        return self._get(Gauge, name, description)  # type: ignore
+
+    def histogram(
+        self, name: str, description: str, buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        """Get or create a histogram."""
+        return self._get(Histogram, name, description, buckets=buckets)  # type: ignore
+
+    def prometheus_text(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append("# HELP %s %s" % (metric.name, metric.description))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, _format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """Return a JSON-serialisable summary of the run."""
+        end = time.time()
+        return collections.OrderedDict(
+            [
+                ("start", self.start),
+                ("end", end),
+                ("duration", end - self.start),
+                (
+                    "metrics",
+                    collections.OrderedDict(
+                        (metric.name, metric.summary())
+                        for metric in self.metrics.values()
+                    ),
+                ),
+            ]
+        )
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.gauge(
+    "scoreboard_stage_seconds", "Seconds taken by each pipeline stage"
+)
+LAST_RUN = registry.gauge(
+    "scoreboard_last_run_timestamp_seconds", "When the last run finished"
+)
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Context manager to record how long a pipeline stage takes."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.set(time.perf_counter() - start, stage=name)
+
+
+def _write_atomically(path: str, data: str) -> None:
+    """Write a file so readers never see it half-written."""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf8") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def write(website_dir: str) -> None:
+    """Write the Prometheus textfile and JSON run summary.
+
+    They're written to METRICS_DIR in website_dir. Point node_exporter's
+    --collector.textfile.directory there to scrape them.
+    """
+    LAST_RUN.set(time.time())
+    path = os.path.join(website_dir, METRICS_DIR)
+    os.makedirs(path, exist_ok=True)
+    _write_atomically(
+        os.path.join(path, PROMETHEUS_FILE), registry.prometheus_text()
+    )
+    _write_atomically(
+        os.path.join(path, SUMMARY_FILE), json.dumps(registry.summary(), indent=2)
+    )
+    print("Wrote run metrics to %s" % path)
@@ -2,7 +2,9 @@
 
 import functools
 import datetime
-from typing import Optional, Tuple, Callable, Sequence
+import threading
+import collections
+from typing import Optional, Tuple, Callable, Sequence, Iterator
 
 import sqlalchemy
 import sqlalchemy.orm
@@ -25,8 +27,15 @@ from scoreboard.orm import (
     Account,
     Ktyp,
     Streak,
+    BlacklistEntry,
+    RejectedGame,
+    MilestoneAggregate,
+    StatusCounter,
 )
 
+# StatusCounter names
+UNSCORED_GAMES = "unscored_games"
+
 
 class DBError(BaseException):
     """Generic wrapper for sqlalchemy errors passed out of this module."""
@@ -63,42 +72,208 @@ def _reraise_dberror(function: Callable) -> Callable:
     return f
 
 
-@functools.lru_cache(maxsize=16)
-def get_server(s: sqlalchemy.orm.session.Session, name: str) -> Server:
-    """Get a server, creating it if needed."""
-    server = s.query(Server).filter(Server.name == name).first()
-    if server:
-        return server
+_DIMENSION_CACHES = []  # type: list
+# Session.info key for ids looked up in a transaction which has created
+# dimension rows. See _dimension_cache.
+_PENDING_IDS = "pending_dimension_ids"
+
+
+def _dimension_cache(maxsize: int) -> Callable:
+    """Memoise a get-or-create function taking (session, *args) across sessions.
+
+    Like functools.lru_cache, but the session isn't part of the cache key, so
+    lookups stay warm when callers switch to a fresh session for each unit of
+    work. Only cache ids with this -- a cached ORM object would keep its
+    session (and the session's identity map) alive.
+
+    On SQLite, dimension rows are created without committing (see
+    _get_or_create_id), so once a session's transaction has created one, the
+    ids it looks up are held in the session until it commits. If it rolls back they're dropped,
+    so the cache never holds ids of rows which don't exist.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        cache = collections.OrderedDict()  # type: collections.OrderedDict
+        # Importers in different threads share the cache
+        lock = threading.Lock()
+
+        @functools.wraps(function)
+        def f(s: sqlalchemy.orm.session.Session, *args):  # type: ignore
+            """Look up args in the cache, calling function on a miss."""
+            with lock:
+                if args in cache:
+                    cache.move_to_end(args)
+                    return cache[args]
+            pending = s.info.get(_PENDING_IDS)
+            if pending is not None and (f, args) in pending:
+                return pending[f, args]
+            result = function(s, *args)
+            pending = s.info.get(_PENDING_IDS)
+            if pending is not None:
+                pending[f, args] = result
+            else:
+                f.cache_set(args, result)
+            return result
+
+        def cache_set(args: tuple, result: int) -> None:
+            """Add an id to the cache."""
+            with lock:
+                cache[args] = result
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+
+        def cache_clear() -> None:
+            """Empty the cache."""
+            with lock:
+                cache.clear()
+
+        f.cache_set = cache_set  # type: ignore
+        f.cache_clear = cache_clear  # type: ignore
+        _DIMENSION_CACHES.append(f)
+        return f
+
+    return decorator
+
+
+class IdMemo:
+    """An unbounded memo of ids (or tuples of them) for memoised.
+
+    Unlike _dimension_cache, callers keep their own memos, eg keyed by raw
+    values before any cleansing.
+    """
+
+    def __init__(self) -> None:
+        self.ids = {}  # type: dict
+
+    def cache_set(self, key: object, result: object) -> None:
+        """Add an id to the memo."""
+        self.ids[key] = result
+
+
+def memoised(
+    s: sqlalchemy.orm.session.Session, memo: IdMemo, key: object, lookup: Callable
+) -> object:
+    """Return memo's id for key, calling lookup on a miss.
+
+    Like _dimension_cache: if s's transaction has created dimension rows,
+    ids it looks up are held in the session until it commits, and dropped
+    if it rolls back, so a memo shared between threads never holds ids of
+    rows which are uncommitted or don't exist.
+    """
+    try:
+        return memo.ids[key]
+    except KeyError:
+        pass
+    pending = s.info.get(_PENDING_IDS)
+    if pending is not None and (memo, key) in pending:
+        return pending[memo, key]
+    result = lookup()
+    pending = s.info.get(_PENDING_IDS)
+    if pending is not None:
+        pending[memo, key] = result
     else:
-        server = Server(name=name)
-        s.add(server)
-        s.commit()
-        return server
+        memo.cache_set(key, result)
+    return result
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_commit")
+def _cache_pending_ids(s: sqlalchemy.orm.session.Session) -> None:
+    """Move ids looked up by a committed transaction into the caches (and
+    memos)."""
+    if s.transaction is not None and s.transaction.nested:
+        return
+    for (cached_function, args), result in s.info.pop(_PENDING_IDS, {}).items():
+        cached_function.cache_set(args, result)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_rollback")
+def _drop_pending_ids(s: sqlalchemy.orm.session.Session) -> None:
+    """Forget ids looked up by a rolled back transaction."""
+    if s.transaction is not None and s.transaction.nested:
+        return
+    s.info.pop(_PENDING_IDS, None)
+
 
+def clear_caches() -> None:
+    """Empty all the dimension id caches."""
+    for cached_function in _DIMENSION_CACHES:
+        cached_function.cache_clear()
+
+
+def _get_or_create_id(
+    s: sqlalchemy.orm.session.Session,
+    query: sqlalchemy.orm.query.Query,
+    factory: Callable,
+) -> Tuple[int, bool]:
+    """Get the id of a dimension row, creating it if needed.
+
+    Parameters:
+        query: query for the row's id
+        factory: called to make the row if the query finds nothing
 
-@functools.lru_cache(maxsize=128)
-def get_account_id(s: sqlalchemy.orm.session.Session, name: str, server: Server) -> int:
+    Returns:
+        (id, created) tuple.
+
+    New rows are committed straight away in their own short transaction, so
+    concurrent imports which need the same row don't wait for (or deadlock
+    with) the caller's transaction. If a concurrent import creates the same
+    row first, we use theirs.
+
+    On SQLite, transactions take turns (see orm.serialise_sqlite_transactions)
+    and another connection can't write once the caller's transaction has, so
+    new rows are flushed (in a savepoint) but not committed, and committed
+    along with whatever the caller is doing.
+    """
+    row = query.first()
+    if row:
+        return row[0], False
+    obj = factory()
+    bind = s.get_bind()
+    if bind.dialect.name == "sqlite":
+        try:
+            with s.begin_nested():
+                s.add(obj)
+        except sqlalchemy.exc.IntegrityError:
+            return query.one()[0], False
+        s.info.setdefault(_PENDING_IDS, {})
+        return obj.id, True
+    own = sqlalchemy.orm.Session(bind=bind)
+    try:
+        own.add(obj)
+        own.commit()
+        return obj.id, True
+    except sqlalchemy.exc.IntegrityError:
+        own.rollback()
+        return query.one()[0], False
+    finally:
+        own.close()
+
+
+@_dimension_cache(maxsize=16)
+def get_server_id(s: sqlalchemy.orm.session.Session, name: str) -> int:
+    """Get a server's id, creating it if needed."""
+    return _get_or_create_id(
+        s, s.query(Server.id).filter(Server.name == name), lambda: Server(name=name)
+    )[0]
+
+
+@_dimension_cache(maxsize=4096)
+def get_account_id(s: sqlalchemy.orm.session.Session, name: str, server_id: int) -> int:
     """Get an account id, creating the account if needed.
 
     Note that player names are not case sensitive, so names are stored with
     their canonical capitalisation but we always compare the lowercase version.
     """
     player_id = get_player_id(s, name)
-    acc = (
-        s.query(Account.id)
-        .filter(func.lower(Account.name) == name.lower(), Account.server == server)
-        .one_or_none()
-    )
-    if acc:
-        return acc[0]
-    else:
-        acc = Account(name=name, server=server, player_id=player_id)
-        s.add(acc)
-        s.commit()
-        return acc.id
+    return _get_or_create_id(
+        s,
+        s.query(Account.id).filter(
+            func.lower(Account.name) == name.lower(), Account.server_id == server_id
+        ),
+        lambda: Account(name=name, server_id=server_id, player_id=player_id),
+    )[0]
 
 
-@functools.lru_cache(maxsize=128)
 def get_player(s: sqlalchemy.orm.session.Session, name: str) -> Player:
     """Get a player's object, creating them if needed.
 
@@ -114,26 +289,25 @@ def get_player(s: sqlalchemy.orm.session.Session, name: str) -> Player:
         return _add_player(s, name)
 
 
-@functools.lru_cache(maxsize=128)
-def get_player_id(s: sqlalchemy.orm.session.Session, name: str) -> Player:
+@_dimension_cache(maxsize=4096)
+def get_player_id(s: sqlalchemy.orm.session.Session, name: str) -> int:
     """Get a player's id, creating them if needed.
 
     Note that player names are not case sensitive, so names are stored with
     their canonical capitalisation but we always compare the lowercase version.
     """
-    player = (
-        s.query(Player.id).filter(func.lower(Player.name) == name.lower()).one_or_none()
-    )
-    if player:
-        return player[0]
-    else:
-        return _add_player(s, name).id
+    return _get_or_create_id(
+        s,
+        s.query(Player.id).filter(func.lower(Player.name) == name.lower()),
+        lambda: Player(name=name, page_updated=datetime.datetime.now()),
+    )[0]
 
 
 def _add_player(s, name: str) -> Player:
     player = Player(name=name, page_updated=datetime.datetime.now())
     s.add(player)
-    s.commit()
+    s.flush()
+    s.info.setdefault(_PENDING_IDS, {})
     return player
 
 
@@ -206,17 +380,38 @@ def setup_ktyps(s: sqlalchemy.orm.session.Session) -> None:
     s.commit()
 
 
-@functools.lru_cache(maxsize=32)
-def get_version(s: sqlalchemy.orm.session.Session, v: str) -> Version:
-    """Get a version, creating it if needed."""
-    version = s.query(Version).filter(Version.v == v).first()
-    if version:
-        return version
-    else:
-        version = Version(v=v)
-        s.add(version)
-        s.commit()
-        return version
+def setup_blacklists(s: sqlalchemy.orm.session.Session) -> None:
+    """Sync blacklist data from constants into the database.
+
+    Entries no longer in const.BLACKLISTS are removed, so this can be re-run
+    at any time (eg after reloading constants) to update the blacklists
+    without restarting anything that reads them.
+    """
+    wanted = {
+        (blacklist, value.lower() if blacklist == "bots" else value)
+        for blacklist, values in const.BLACKLISTS.items()
+        for value in values
+    }
+    existing = set(s.query(BlacklistEntry.blacklist, BlacklistEntry.value).all())
+    for blacklist, value in existing - wanted:
+        print("Removing %s blacklist entry '%s'" % (blacklist, value))
+        s.query(BlacklistEntry).filter(
+            BlacklistEntry.blacklist == blacklist, BlacklistEntry.value == value
+        ).delete(synchronize_session=False)
+    new = []
+    for blacklist, value in wanted - existing:
+        print("Adding %s blacklist entry '%s'" % (blacklist, value))
+        new.append({"blacklist": blacklist, "value": value})
+    s.bulk_insert_mappings(BlacklistEntry, new)
+    s.commit()
+
+
+@_dimension_cache(maxsize=32)
+def get_version_id(s: sqlalchemy.orm.session.Session, v: str) -> int:
+    """Get a version's id, creating it if needed."""
+    return _get_or_create_id(
+        s, s.query(Version.id).filter(Version.v == v), lambda: Version(v=v)
+    )[0]
 
 
 def setup_branches(s: sqlalchemy.orm.session.Session) -> None:
@@ -237,113 +432,251 @@ def setup_branches(s: sqlalchemy.orm.session.Session) -> None:
     s.commit()
 
 
-@functools.lru_cache(maxsize=256)
-def get_place(s: sqlalchemy.orm.session.Session, branch: Branch, lvl: int) -> Place:
-    """Get a place, creating it if needed."""
-    place = s.query(Place).filter(Place.branch == branch, Place.level == lvl).first()
-    if place:
-        return place
-    else:
-        place = Place(branch=branch, level=lvl)
-        s.add(place)
-        s.commit()
-        return place
+@_dimension_cache(maxsize=256)
+def get_place_id(s: sqlalchemy.orm.session.Session, branch_id: int, lvl: int) -> int:
+    """Get a place's id, creating it if needed."""
+    return _get_or_create_id(
+        s,
+        s.query(Place.id).filter(Place.branch_id == branch_id, Place.level == lvl),
+        lambda: Place(branch_id=branch_id, level=lvl),
+    )[0]
 
 
-@functools.lru_cache(maxsize=64)
-def get_species(s: sqlalchemy.orm.session.Session, sp: str) -> Species:
-    """Get a species by short code, creating it if needed."""
-    species = s.query(Species).filter(Species.short == sp).first()
-    if species:
-        return species
-    else:
-        species = Species(short=sp, name=sp, playable=False)
-        s.add(species)
-        s.commit()
+@_dimension_cache(maxsize=64)
+def get_species_id(s: sqlalchemy.orm.session.Session, sp: str) -> int:
+    """Get a species' id by short code, creating it if needed."""
+    id_, created = _get_or_create_id(
+        s,
+        s.query(Species.id).filter(Species.short == sp),
+        lambda: Species(short=sp, name=sp, playable=False),
+    )
+    if created:
         print(
             "Warning: Found new species %s, please add me to constants.py"
             " and update the database." % sp
         )
-        return species
+    return id_
 
 
-@functools.lru_cache(maxsize=64)
-def get_background(s: sqlalchemy.orm.session.Session, bg: str) -> Background:
-    """Get a background by short code, creating it if needed."""
-    background = s.query(Background).filter(Background.short == bg).first()
-    if background:
-        return background
-    else:
-        background = Background(short=bg, name=bg, playable=False)
-        s.add(background)
-        s.commit()
+@_dimension_cache(maxsize=64)
+def get_background_id(s: sqlalchemy.orm.session.Session, bg: str) -> int:
+    """Get a background's id by short code, creating it if needed."""
+    id_, created = _get_or_create_id(
+        s,
+        s.query(Background.id).filter(Background.short == bg),
+        lambda: Background(short=bg, name=bg, playable=False),
+    )
+    if created:
         print(
             "Warning: Found new background %s, please add me to constants.py"
             " and update the database." % bg
         )
-        return background
+    return id_
 
 
-@functools.lru_cache(maxsize=32)
-def get_god(s: sqlalchemy.orm.session.Session, name: str) -> God:
-    """Get a god by name, creating it if needed."""
-    god = s.query(God).filter(God.name == name).first()
-    if god:
-        return god
-    else:
-        god = God(name=name, playable=False)
-        s.add(god)
-        s.commit()
+@_dimension_cache(maxsize=32)
+def get_god_id(s: sqlalchemy.orm.session.Session, name: str) -> int:
+    """Get a god's id by name, creating it if needed."""
+    id_, created = _get_or_create_id(
+        s,
+        s.query(God.id).filter(God.name == name),
+        lambda: God(name=name, playable=False),
+    )
+    if created:
         print(
             "Warning: Found new god %s, please add me to constants.py"
             " and update the database." % name
         )
-        return god
+    return id_
 
 
-@functools.lru_cache(maxsize=64)
-def get_ktyp(s: sqlalchemy.orm.session.Session, name: str) -> Ktyp:
-    """Get a ktyp by name, creating it if needed."""
-    ktyp = s.query(Ktyp).filter(Ktyp.name == name).first()
-    if ktyp:
-        return ktyp
-    else:
-        ktyp = Ktyp(name=name)
-        s.add(ktyp)
-        s.commit()
+@_dimension_cache(maxsize=64)
+def get_ktyp_id(s: sqlalchemy.orm.session.Session, name: str) -> int:
+    """Get a ktyp's id by name, creating it if needed."""
+    id_, created = _get_or_create_id(
+        s, s.query(Ktyp.id).filter(Ktyp.name == name), lambda: Ktyp(name=name)
+    )
+    if created:
         print("Warning: Found new ktyp %s, please add me to constants.py" % name)
-        return ktyp
+    return id_
 
 
-@functools.lru_cache(maxsize=64)
-def get_branch(s: sqlalchemy.orm.session.Session, br: str) -> Branch:
-    """Get a branch by short name, creating it if needed."""
-    branch = s.query(Branch).filter(Branch.short == br).first()
-    if branch:
-        return branch
-    else:
-        branch = Branch(short=br, name=br, multilevel=True, playable=False)
-        s.add(branch)
-        s.commit()
+@_dimension_cache(maxsize=64)
+def get_branch_id(s: sqlalchemy.orm.session.Session, br: str) -> int:
+    """Get a branch's id by short name, creating it if needed."""
+    id_, created = _get_or_create_id(
+        s,
+        s.query(Branch.id).filter(Branch.short == br),
+        lambda: Branch(short=br, name=br, multilevel=True, playable=False),
+    )
+    if created:
         print(
             "Warning: Found new branch %s, please add me to constants.py"
             " and update the database." % br
         )
-        return branch
+    return id_
 
 
 def create_streak(s: sqlalchemy.orm.session.Session, player: Player) -> Streak:
     """Create a new streak for a given player."""
-    streak = Streak(player_id=player.id, active=True)
+    streak = Streak(player_id=player.id, active=True, length=0)
     s.add(streak)
-    s.commit()
+    s.flush()
     return streak
 
 
 @_reraise_dberror
-def add_games(s: sqlalchemy.orm.session.Session, games: Sequence[dict]) -> None:
-    """Normalise and add multiple games to the database."""
-    s.bulk_insert_mappings(Game, games)
+def add_game_rows(
+    s: sqlalchemy.orm.session.Session,
+    columns: Sequence[str],
+    rows: Sequence[tuple],
+) -> None:
+    """Add multiple games to the database in a single executemany.
+
+    Parameters:
+        columns: games table column names
+        rows: tuples of values, in the same order as columns
+    """
+    if not rows:
+        return
+    s.execute(Game.__table__.insert(), [dict(zip(columns, row)) for row in rows])
+
+
+def existing_gids(s: sqlalchemy.orm.session.Session, gids: Sequence[str]) -> set:
+    """Return the subset of gids which are already in the database."""
+    if not gids:
+        return set()
+    return {row[0] for row in s.query(Game.gid).filter(Game.gid.in_(gids))}
+
+
+def iter_gids(
+    s: sqlalchemy.orm.session.Session, *, batch_size: int = 10000
+) -> Iterator[str]:
+    """Iterate over the gids of all games, using keyset pagination on gid."""
+    last_gid = None
+    while True:
+        q = s.query(Game.gid)
+        if last_gid is not None:
+            q = q.filter(Game.gid > last_gid)
+        batch = [row[0] for row in q.order_by(Game.gid.asc()).limit(batch_size)]
+        if not batch:
+            return
+        last_gid = batch[-1]
+        yield from batch
+
+
+def add_rejected_games(
+    s: sqlalchemy.orm.session.Session, rejects: Sequence[dict]
+) -> None:
+    """Add rejected game records to the database in a single executemany.
+
+    Parameters:
+        rejects: dicts of RejectedGame columns (except id)
+    """
+    if not rejects:
+        return
+    s.execute(RejectedGame.__table__.insert(), list(rejects))
+
+
+def iter_rejected_game_batches(
+    s: sqlalchemy.orm.session.Session,
+    *,
+    reason: Optional[str] = None,
+    batch_size: int = 1000
+) -> Iterator[Sequence[RejectedGame]]:
+    """Iterate over rejected games (oldest first) in batches.
+
+    Only games rejected before iteration started are returned, so callers
+    may delete rejected games and reject them again as they go.
+
+    Parameters:
+        reason: If specified, only games rejected for this reason
+        batch_size: number of rejected games per batch
+    """
+    last_id = 0
+    max_id = s.query(func.max(RejectedGame.id)).scalar()
+    if max_id is None:
+        return
+    while True:
+        q = s.query(RejectedGame).filter(
+            RejectedGame.id > last_id, RejectedGame.id <= max_id
+        )
+        if reason is not None:
+            q = q.filter(RejectedGame.reason == reason)
+        batch = q.order_by(RejectedGame.id.asc()).limit(batch_size).all()
+        if not batch:
+            return
+        last_id = batch[-1].id
+        yield batch
+
+
+def delete_rejected_games(s: sqlalchemy.orm.session.Session, ids: Sequence[int]) -> None:
+    """Delete rejected games by id."""
+    s.query(RejectedGame).filter(RejectedGame.id.in_(ids)).delete(
+        synchronize_session=False
+    )
+
+
+def add_milestone_aggregates(
+    s: sqlalchemy.orm.session.Session, aggregates: dict
+) -> None:
+    """Add milestones to per-player aggregates, creating them as needed.
+
+    Parameters:
+        aggregates: {(player_name, kind, key): (count, first, last)}
+    """
+    for (player_name, kind, key), (count, first, last) in aggregates.items():
+        q = s.query(MilestoneAggregate).filter(
+            MilestoneAggregate.player_name == player_name,
+            MilestoneAggregate.kind == kind,
+            MilestoneAggregate.key == key,
+        )
+        # Update in SQL, so concurrent imports don't lose each other's counts
+        values = {
+            MilestoneAggregate.count: MilestoneAggregate.count + count,
+            MilestoneAggregate.first: sqlalchemy.case(
+                [(MilestoneAggregate.first > first, first)],
+                else_=MilestoneAggregate.first,
+            ),
+            MilestoneAggregate.last: sqlalchemy.case(
+                [(MilestoneAggregate.last < last, last)],
+                else_=MilestoneAggregate.last,
+            ),
+        }
+        if q.update(values, synchronize_session=False):
+            continue
+        try:
+            with s.begin_nested():
+                s.add(
+                    MilestoneAggregate(
+                        player_name=player_name,
+                        kind=kind,
+                        key=key,
+                        count=count,
+                        first=first,
+                        last=last,
+                    )
+                )
+        except sqlalchemy.exc.IntegrityError:
+            # Added by a concurrent import
+            q.update(values, synchronize_session=False)
+
+
+def get_milestone_aggregates(
+    s: sqlalchemy.orm.session.Session, player_name: str, kind: Optional[str] = None
+) -> Sequence[MilestoneAggregate]:
+    """Get a player's milestone aggregates.
+
+    Parameters:
+        kind: If specified, only aggregates of this kind ('rune', 'unique' or
+            'branch')
+    """
+    q = s.query(MilestoneAggregate).filter(
+        MilestoneAggregate.player_name == player_name.lower()
+    )
+    if kind is not None:
+        q = q.filter(MilestoneAggregate.kind == kind)
+    return q.order_by(MilestoneAggregate.kind, MilestoneAggregate.key).all()
 
 
 def get_logfile_progress(
@@ -371,6 +704,59 @@ def save_logfile_progress(
     s.add(log)
 
 
+def list_logfile_progress(
+    s: sqlalchemy.orm.session.Session
+) -> Sequence[LogfileProgress]:
+    """Get the progress records of all sources, by url."""
+    return s.query(LogfileProgress).order_by(LogfileProgress.source_url).all()
+
+
+def setup_status_counters(s: sqlalchemy.orm.session.Session) -> None:
+    """Add missing status counters, counting from scratch.
+
+    After that they're kept up to date with adjust_status_counter.
+    """
+    if s.query(StatusCounter).get(UNSCORED_GAMES) is None:
+        print("Counting unscored games")
+        s.add(StatusCounter(name=UNSCORED_GAMES, value=count_games(s, scored=False)))
+
+
+def adjust_status_counter(
+    s: sqlalchemy.orm.session.Session, name: str, delta: int
+) -> None:
+    """Add delta to a status counter, as part of the caller's transaction."""
+    if not delta:
+        return
+    s.query(StatusCounter).filter(StatusCounter.name == name).update(
+        {StatusCounter.value: StatusCounter.value + delta}, synchronize_session=False
+    )
+
+
+def get_status_counters(s: sqlalchemy.orm.session.Session) -> dict:
+    """Return the status counters' values, by name."""
+    return {counter.name: counter.value for counter in s.query(StatusCounter)}
+
+
+def newest_game_end(
+    s: sqlalchemy.orm.session.Session
+) -> Optional[datetime.datetime]:
+    """Return the end time of the most recently finished game.
+
+    A single lookup in the index on end.
+    """
+    return s.query(func.max(Game.end)).scalar()
+
+
+def count_stale_player_pages(
+    s: sqlalchemy.orm.session.Session, before: datetime.datetime
+) -> int:
+    """Return the number of player pages last updated before before.
+
+    A range scan of the page_updated index.
+    """
+    return s.query(func.count(Player.id)).filter(Player.page_updated < before).scalar()
+
+
 def list_accounts(
     s: sqlalchemy.orm.session.Session, *, blacklisted: Optional[bool] = None
 ) -> Sequence[Account]:
@@ -389,12 +775,29 @@ def list_accounts(
     return results
 
 
-def list_players(s: sqlalchemy.orm.session.Session) -> Sequence[Player]:
-    """Get a list of all players."""
+def list_players(
+    s: sqlalchemy.orm.session.Session, *, ids: Optional[Sequence[int]] = None
+) -> Sequence[Player]:
+    """Get a list of all players.
+
+    If ids is specified, only return players with those ids.
+    """
     q = s.query(Player)
+    if ids is not None:
+        q = q.filter(Player.id.in_(ids))
     return q.all()
 
 
+def list_player_ids(s: sqlalchemy.orm.session.Session) -> Sequence[int]:
+    """Get the ids of all players, without loading the players."""
+    return [row[0] for row in s.query(Player.id)]
+
+
+def list_player_names(s: sqlalchemy.orm.session.Session) -> Sequence[str]:
+    """Get the names of all players, without loading the players."""
+    return [row[0] for row in s.query(Player.name)]
+
+
 def _generic_char_type_lister(
     s: sqlalchemy.orm.session.Session,
     *,
@@ -485,14 +888,14 @@ def _games(
     if gid is not None:
         q = q.filter(Game.gid == gid)
     if winning is not None:
-        ktyp = get_ktyp(s, "winning")
+        ktyp_id = get_ktyp_id(s, "winning")
         if winning:
-            q = q.filter(Game.ktyp_id == ktyp.id)
+            q = q.filter(Game.ktyp_id == ktyp_id)
         else:
-            q = q.filter(Game.ktyp_id != ktyp.id)
+            q = q.filter(Game.ktyp_id != ktyp_id)
     if boring is not None:
         boring_ktyps = [
-            get_ktyp(s, ktyp).id for ktyp in ("quitting", "leaving", "wizmode")
+            get_ktyp_id(s, ktyp) for ktyp in ("quitting", "leaving", "wizmode")
         ]
         if boring:
             q = q.filter(Game.ktyp_id.in_(boring_ktyps))
@@ -537,6 +940,47 @@ def list_games(
     ).all()
 
 
+def iter_game_batches(
+    s: sqlalchemy.orm.session.Session,
+    *,
+    scored: Optional[bool] = None,
+    until: Optional[datetime.datetime] = None,
+    batch_size: int = 1000
+) -> Iterator[Sequence[Game]]:
+    """Iterate over all games (least->most recent) in batches.
+
+    Uses keyset pagination on (end, gid), so each batch is a single range scan
+    of the unscored_games index with no re-sorting, and memory use is bounded
+    by batch_size. Callers may commit between batches, and may change the
+    filtered columns (eg scored) of games they have already seen.
+
+    Parameters:
+        scored: If specified, only games with a matching scored
+        until: If specified, only games which ended at or before this
+        batch_size: number of games per batch
+
+    Yields:
+        lists of up to batch_size Games.
+    """
+    last_key = None
+    while True:
+        q = s.query(Game)
+        if scored is not None:
+            q = q.filter(
+                Game.scored == (sqlalchemy.true() if scored else sqlalchemy.false())
+            )
+        if until is not None:
+            q = q.filter(Game.end <= until)
+        if last_key is not None:
+            q = q.filter(sqlalchemy.tuple_(Game.end, Game.gid) > last_key)
+        batch = q.order_by(Game.end.asc(), Game.gid.asc()).limit(batch_size).all()
+        if not batch:
+            return
+        # Read the key now, the caller's commit will expire these objects
+        last_key = (batch[-1].end, batch[-1].gid)
+        yield batch
+
+
 def count_games(
     s: sqlalchemy.orm.session.Session,
     *,
@@ -693,14 +1137,29 @@ def fastest_wins(
 
     exclude_bots: If True, exclude known bot accounts from the rankings.
     """
-    ktyp = get_ktyp(s, "winning")
-    q = s.query(Game).filter(Game.ktyp == ktyp).order_by("dur")
+    ktyp_id = get_ktyp_id(s, "winning")
+    q = s.query(Game).filter(Game.ktyp_id == ktyp_id).order_by("dur")
     if exclude_bots:
-        for bot_name in const.BLACKLISTS["bots"]:
-            bot_id = get_player_id(s, bot_name)
-            q = q.filter(Game.player_id != bot_id)
-        for bad_gid in const.BLACKLISTS["bot-games"]:
-            q = q.filter(Game.gid != bad_gid)
+        # Both subqueries are tiny and uncorrelated, so they're hashed once and
+        # the planner can still walk fastest_highscore_index until it has
+        # enough rows for the limit.
+        bot_ids = (
+            s.query(Player.id)
+            .join(
+                BlacklistEntry,
+                sqlalchemy.and_(
+                    BlacklistEntry.blacklist == "bots",
+                    BlacklistEntry.value == func.lower(Player.name),
+                ),
+            )
+            .subquery()
+        )
+        bot_gids = (
+            s.query(BlacklistEntry.value)
+            .filter(BlacklistEntry.blacklist == "bot-games")
+            .subquery()
+        )
+        q = q.filter(Game.player_id.notin_(bot_ids), Game.gid.notin_(bot_gids))
     if player is not None:
         q = q.filter(Game.player_id == player.id)
     return q.limit(limit).all()
@@ -713,8 +1172,8 @@ def shortest_wins(
     player: Optional[Player] = None
 ) -> Sequence[Game]:
     """Return up to limit shortest wins."""
-    ktyp = get_ktyp(s, "winning")
-    q = s.query(Game).filter(Game.ktyp == ktyp).order_by("turn")
+    ktyp_id = get_ktyp_id(s, "winning")
+    q = s.query(Game).filter(Game.ktyp_id == ktyp_id).order_by("turn")
     if player is not None:
         q = q.filter(Game.player_id == player.id)
     return q.limit(limit).all()
@@ -781,34 +1240,24 @@ def get_streaks(
     Returns:
         List of active streaks.
     """
-    # The following code is a translation of this basic SQL:
-    # SELECT streaks.*, count(games.streak_id) as streak_length
-    # FROM streaks
-    # JOIN games ON (streaks.id = games.streak_id)
-    # GROUP BY streaks.id
-    # HAVING streak_length > 1
-    # ORDER BY streak_length DESC
-    streak_length = func.count(Game.streak_id).label("streak_length")
-    streak_last_activity = func.max(Game.end).label("streak_last_activity")
-    q = s.query(Streak, streak_length).join(Streak.games)
-    q = q.group_by(Streak.id)
-    q = q.having(streak_length > 1)
-    if max_age is not None:
-        oldest_age = datetime.datetime.now() - datetime.timedelta(days=max_age)
-        q = q.having(streak_last_activity > oldest_age)
-    q = q.order_by(streak_length.desc())
+    q = s.query(Streak).filter(Streak.length > 1)
     if active is not None:
         q = q.filter(
             Streak.active == (sqlalchemy.true() if active else sqlalchemy.false())
         )
+    if max_age is not None:
+        oldest_age = datetime.datetime.now() - datetime.timedelta(days=max_age)
+        q = q.filter(Streak.last_win_end > oldest_age)
+    q = q.order_by(Streak.length.desc())
     if limit is not None:
         q = q.limit(limit)
-    streaks = q.all()
-    # Since we added a column to the query, the result format is:
-    # ((Streak, length), (Streak, length), ...)
-    # It's annoying to deal with a custom format, and recalculating the streak
-    # length for a few streaks is NBD, so just return a list of Streaks
-    return [t.Streak for t in streaks]
+    # Callers list each streak's games and breaker, so load them up front
+    q = q.options(
+        sqlalchemy.orm.selectinload(Streak.games),
+        sqlalchemy.orm.joinedload(Streak.breaker),
+        sqlalchemy.orm.joinedload(Streak.player),
+    )
+    return q.all()
 
 
 def list_achievements(s: sqlalchemy.orm.session.Session) -> Sequence[Achievement]:
@@ -817,14 +1266,34 @@ def list_achievements(s: sqlalchemy.orm.session.Session) -> Sequence[Achievement
 
 
 def get_old_player_pages(
-    s: sqlalchemy.orm.session.Session, num: int
+    s: sqlalchemy.orm.session.Session,
+    num: int,
+    after: Optional[Tuple[datetime.datetime, int]] = None,
 ) -> Sequence[Player]:
-    """Return a list of num players, sorted by least recently updated page."""
-    return s.query(Player).order_by(Player.page_updated).limit(num).all()
+    """Return a list of num players, sorted by least recently updated page.
+
+    Parameters:
+        num: maximum number of players to return
+        after: (page_updated, id) of the last player from a previous call.
+            If specified, continue from after that player, so successive calls
+            walk the page_updated index instead of re-reading earlier rows.
+    """
+    q = s.query(Player)
+    if after is not None:
+        q = q.filter(sqlalchemy.tuple_(Player.page_updated, Player.id) > after)
+    return q.order_by(Player.page_updated, Player.id).limit(num).all()
+
 
+def updated_player_pages(
+    s: sqlalchemy.orm.session.Session, player_ids: Sequence[int]
+) -> None:
+    """Mark the pages of the players with these ids as having been updated.
 
-def updated_player_page(s: sqlalchemy.orm.session.Session, player: Player) -> None:
-    """Mark a player's page as having been updated."""
-    p = s.query(Player).filter(Player.id == player.id).one()
-    p.page_updated = datetime.datetime.now()
-    s.add(p)
+    Issues a single UPDATE without loading the players, so callers should
+    pass in reasonably sized chunks of ids.
+    """
+    if not player_ids:
+        return
+    s.query(Player).filter(Player.id.in_(player_ids)).update(
+        {Player.page_updated: datetime.datetime.now()}, synchronize_session=False
+    )
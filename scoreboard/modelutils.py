@@ -1,27 +1,77 @@
 """Utility functions for the model."""
 
 import datetime
-from typing import Optional
+from typing import Dict, Iterable, List, Optional
 
 import scoreboard.orm as orm
 
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+# Crawl dates end in S for standard time, D for daylight saving time
+_TIME_SUFFIXES = frozenset(("S", "D", ""))
+# Seconds since the epoch at the start of a crawl date's day, by "YYYYMMDD"
+_DAY_EPOCHS = {}  # type: Dict[str, int]
+# Seconds since midnight, by "hhmmssS". Bounded, since there are a lot of them
+_TIME_SECONDS = {}  # type: Dict[str, int]
+_MAX_TIME_SECONDS = 65536
+
+
+def crawl_date_to_epoch(d: str) -> int:
+    """Converts a crawl date string to seconds since the epoch.
+
+    Crawl date strings look like YYYYMMDDhhmmssS. Note: crawl dates use a
+    0-indexed month... I think you can blame struct_tm for this.
+
+    The final character is S for standard time or D for daylight saving
+    time (and may be missing). It's only validated: times are kept as the
+    server's wall clock time, which morgue filenames are named after.
+    """
+    day = d[:8]
+    try:
+        day_epoch = _DAY_EPOCHS[day]
+    except KeyError:
+        if len(d) < 14:
+            raise ValueError("Invalid crawl date %r" % d)
+        date = datetime.date(int(d[:4]), int(d[4:6]) + 1, int(d[6:8]))
+        day_epoch = _DAY_EPOCHS[day] = (date.toordinal() - _EPOCH_ORDINAL) * 86400
+    time_of_day = d[8:]
+    try:
+        return day_epoch + _TIME_SECONDS[time_of_day]
+    except KeyError:
+        suffix = time_of_day[6:]
+        if len(time_of_day) < 6 or suffix not in _TIME_SUFFIXES:
+            raise ValueError("Invalid crawl date %r" % d)
+        seconds = (
+            int(time_of_day[:2]) * 3600
+            + int(time_of_day[2:4]) * 60
+            + int(time_of_day[4:6])
+        )
+        if len(_TIME_SECONDS) < _MAX_TIME_SECONDS:
+            _TIME_SECONDS[time_of_day] = seconds
+        return day_epoch + seconds
+
+
 def crawl_date_to_datetime(d: str) -> datetime.datetime:
     """Converts a crawl date string to a datetime object.
 
-    Note: crawl dates use a 0-indexed month... I think you can blame struct_tm
-    for this.
+    See crawl_date_to_epoch for the format.
     """
-    # Increment the month by one
-    d = d[:4] + "%02d" % (int(d[4:6]) + 1) + d[6:]
-    return datetime.datetime(
-        year=int(d[:4]),
-        month=int(d[4:6]),
-        day=int(d[6:8]),
-        hour=int(d[8:10]),
-        minute=int(d[10:12]),
-        second=int(d[12:14]),
-    )
+    return _EPOCH + datetime.timedelta(seconds=crawl_date_to_epoch(d))
+
+
+def crawl_dates_to_epochs(dates: Iterable[str]) -> List[int]:
+    """Converts many crawl date strings to seconds since the epoch."""
+    to_epoch = crawl_date_to_epoch
+    return [to_epoch(d) for d in dates]
+
+
+def crawl_dates_to_datetimes(dates: Iterable[str]) -> List[datetime.datetime]:
+    """Converts many crawl date strings to datetime objects."""
+    to_epoch = crawl_date_to_epoch
+    epoch = _EPOCH
+    timedelta = datetime.timedelta
+    return [epoch + timedelta(seconds=to_epoch(d)) for d in dates]
 
 
 def _morgue_prefix(src: str, version: str) -> Optional[str]:
@@ -2,6 +2,11 @@
 
 import sqlite3  # for typing
 import os
+import json
+import hashlib
+import datetime
+import threading
+from typing import Optional
 
 import characteristic
 
@@ -11,8 +16,10 @@ from sqlalchemy import (
     Column,
     String,
     Integer,
+    BigInteger,
     Boolean,
     DateTime,
+    Text,
     ForeignKey,
     UniqueConstraint,
     Index,
@@ -23,12 +30,17 @@ from sqlalchemy.orm import sessionmaker
 import sqlalchemy.pool
 import sqlalchemy.ext.declarative.api
 
+from . import constants as const
 from . import model
+from . import querycount
 
 Base = declarative_base()  # type: sqlalchemy.ext.declarative.api.DeclarativeMeta
 
 Session = None
 
+# See serialise_sqlite_transactions
+_sqlite_lock = threading.RLock()
+
 
 @characteristic.with_repr(["name"])  # pylint: disable=too-few-public-methods
 class Server(Base):
@@ -247,16 +259,33 @@ class Streak(Base):
 
     Columns:
         active: is the streak currently active?
+        length: number of wins in the streak.
+        start: start time of the streak's first win.
+        last_win_end: end time of the streak's most recent win.
+        breaker_gid: gid of the game which ended the streak (if any).
+
+    The length/start/last_win_end/breaker_gid columns are denormalised from
+    the streak's games, and are maintained by scoring.
     """
 
     __tablename__ = "streaks"
     id = Column(Integer, primary_key=True, nullable=False)  # type: int
     active = Column(Boolean, nullable=False, index=True)  # type: bool
+    length = Column(Integer, nullable=False, default=0)  # type: int
+    start = Column(DateTime)  # type: DateTime
+    last_win_end = Column(DateTime)  # type: DateTime
 
     player_id = Column(Integer, ForeignKey("players.id"), nullable=False)  # type: int
     player = relationship("Player", back_populates="streak")
 
-    games = relationship("Game", order_by="Game.start")
+    games = relationship("Game", order_by="Game.start", foreign_keys="Game.streak_id")
+
+    # games.streak_id already references streaks, so this foreign key has to
+    # be added after both tables are created.
+    breaker_gid = Column(
+        String(50), ForeignKey("games.gid", use_alter=True, name="streak_breaker_fk")
+    )  # type: str
+    breaker = relationship("Game", foreign_keys=[breaker_gid], post_update=True)
 
     __table_args__ = (
         Index(
@@ -265,6 +294,9 @@ class Streak(Base):
             postgresql_where=active == sqlalchemy.true(),
             sqlite_where=active == sqlalchemy.true(),
         ),
+        # Used by model.get_streaks
+        Index("streak_length_index", length),
+        Index("streak_last_win_index", active, last_win_end),
     )
 
 
@@ -334,7 +366,7 @@ class Game(Base):
     scored = Column(Boolean, default=False, nullable=False, index=True)  # type: bool
 
     streak_id = Column(Integer, ForeignKey("streaks.id"), index=True)  # type: int
-    streak = relationship("Streak")
+    streak = relationship("Streak", foreign_keys=[streak_id])
 
     __table_args__ = (
         # Used to find various highscores in model
@@ -346,8 +378,8 @@ class Game(Base):
         Index("combo_highscore_index", species_id, background_id, score),
         Index("fastest_highscore_index", ktyp_id, dur),
         Index("shortest_highscore_index", ktyp_id, turn),
-        # Used by scoring.score_games
-        Index("unscored_games", scored, end),
+        # Used by scoring.score_games (via model.iter_game_batches)
+        Index("unscored_games", scored, end, gid),
         # Used by scoring.is_grief
         Index("first_game_index", account_id, end),
     )
@@ -418,13 +450,91 @@ class LogfileProgress(Base):
     """Logfile import progress.
 
     Columns:
-        source_url: logfile source url
-        current_key: the key of the next logfile event to import.
+        source_url: logfile source url. Local logfiles use a file:// url.
+        current_key: the key of the next logfile event to import. For local
+            logfiles, this is the byte offset of the next line to import.
     """
 
     __tablename__ = "logfile_progress"
-    source_url = Column(String(100), primary_key=True)  # type: str
-    current_key = Column(Integer, default=0, nullable=False)  # type: int
+    source_url = Column(String(255), primary_key=True)  # type: str
+    current_key = Column(BigInteger, default=0, nullable=False)  # type: int
+
+
+@characteristic.with_repr(["id", "reason"])  # pylint: disable=too-few-public-methods
+class RejectedGame(Base):
+    """A game record which couldn't be imported, kept so it can be re-imported.
+
+    See log_import.redrive_rejected_games.
+
+    Columns:
+        src: server abbreviation of the record, eg 'cao'.
+        reason: why the record was rejected, one of log_import.REJECT_*.
+        detail: human-readable description of the problem.
+        record: the API game record (or for unparseable logfile lines,
+            {"src_abbr": ..., "line": ...}) as JSON.
+        rejected: when the record was rejected (UTC).
+    """
+
+    __tablename__ = "rejected_games"
+    id = Column(Integer, primary_key=True, nullable=False)  # type: int
+    src = Column(String(20), nullable=False)  # type: str
+    reason = Column(String(20), nullable=False, index=True)  # type: str
+    detail = Column(String(1000), nullable=False)  # type: str
+    record = Column(Text, nullable=False)  # type: str
+    rejected = Column(DateTime, nullable=False)  # type: DateTime
+
+
+@characteristic.with_repr(
+    ["player_name", "kind", "key"]
+)  # pylint: disable=too-few-public-methods
+class MilestoneAggregate(Base):
+    """Per-player milestone counts, eg how often a player found the silver rune.
+
+    Kept instead of the milestones themselves, see log_import.load_milestones.
+
+    Columns:
+        player_name: lowercase player name. Milestones can arrive before the
+            player's first game, so this isn't a reference to players.
+        kind: 'rune', 'unique' or 'branch'.
+        key: rune, unique or branch (short) name, eg 'silver', 'Sigmund', 'Lair'.
+        count: number of milestones.
+        first, last: times of the first and most recent milestones (UTC).
+    """
+
+    __tablename__ = "milestone_aggregates"
+    player_name = Column(String(20), primary_key=True)  # type: str
+    kind = Column(String(10), primary_key=True)  # type: str
+    key = Column(String(50), primary_key=True)  # type: str
+    count = Column(Integer, nullable=False)  # type: int
+    first = Column(DateTime, nullable=False)  # type: DateTime
+    last = Column(DateTime, nullable=False)  # type: DateTime
+
+    def as_dict(self) -> dict:
+        """Convert to a dict, for public consumption."""
+        return {
+            "kind": self.kind,
+            "key": self.key,
+            "count": self.count,
+            "first": self.first.timestamp(),
+            "last": self.last.timestamp(),
+        }
+
+
+@characteristic.with_repr(["blacklist", "value"])  # pylint: disable=too-few-public-methods
+class BlacklistEntry(Base):
+    """An entry in one of the blacklists in constants.BLACKLISTS.
+
+    Loaded at setup time so queries can exclude blacklisted rows with a single
+    anti-join rather than one filter per entry.
+
+    Columns:
+        blacklist: name of the blacklist, eg 'bots', 'bot-games'.
+        value: the blacklisted value. Player names are stored lowercase.
+    """
+
+    __tablename__ = "blacklist_entries"
+    blacklist = Column(String(20), primary_key=True)  # type: str
+    value = Column(String(50), primary_key=True)  # type: str
 
 
 @characteristic.with_repr(["key"])  # pylint: disable=too-few-public-methods
@@ -450,6 +560,78 @@ class Achievement(Base):
     )
 
 
+class SchemaStamp(Base):  # pylint: disable=too-few-public-methods
+    """A fingerprint of the schema and seed data the database was set up with.
+
+    If it matches setup_fingerprint(), setup_database can skip creating
+    tables and seeding them from constants.
+
+    Columns:
+        name: what's stamped, always 'setup'
+        fingerprint: setup_fingerprint() when the database was last set up
+        stamped: when the database was last set up (UTC)
+    """
+
+    __tablename__ = "schema_stamp"
+    name = Column(String(20), primary_key=True)  # type: str
+    fingerprint = Column(String(64), nullable=False)  # type: str
+    stamped = Column(DateTime, nullable=False)  # type: DateTime
+
+
+class StatusCounter(Base):  # pylint: disable=too-few-public-methods
+    """A count kept up to date as games are imported and scored.
+
+    Published in the website's status.json, so it never needs a full table
+    count. See model.adjust_status_counter, and log_import.PageImporter.
+
+    Columns:
+        name: what's counted, eg 'unscored_games'
+        value: the count
+    """
+
+    __tablename__ = "status_counters"
+    name = Column(String(40), primary_key=True)  # type: str
+    value = Column(BigInteger, nullable=False, default=0)  # type: int
+
+
+# Constants which seed_database loads into the database
+SEED_CONSTANTS = (
+    "SPECIES",
+    "BACKGROUNDS",
+    "GODS",
+    "BRANCHES",
+    "ACHIEVEMENTS",
+    "KTYPS",
+    "BLACKLISTS",
+)
+
+
+def _canonical(obj: object) -> object:
+    """Return obj as JSON-serialisable data which doesn't depend on set order."""
+    if isinstance(obj, dict):
+        return sorted((str(k), _canonical(v)) for k, v in obj.items())
+    if isinstance(obj, (set, frozenset)):
+        return sorted((_canonical(v) for v in obj), key=repr)
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(v) for v in obj]
+    return obj
+
+
+def setup_fingerprint() -> str:
+    """Return a hash of the schema and the constants seed_database loads."""
+    schema = [
+        (
+            table.name,
+            [(c.name, str(c.type), c.nullable) for c in table.columns],
+            sorted(index.name for index in table.indexes),
+        )
+        for table in Base.metadata.sorted_tables
+    ]
+    seed = [_canonical(getattr(const, name)) for name in SEED_CONSTANTS]
+    data = json.dumps([schema, seed], default=repr, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
 def sqlite_performance_over_safety(
     dbapi_con: sqlite3.Connection,
     con_record: sqlalchemy.pool._ConnectionRecord,  # pylint: disable=protected-access
@@ -460,35 +642,107 @@ def sqlite_performance_over_safety(
     dbapi_con.execute("PRAGMA synchronous = OFF")
 
 
-def setup_database() -> None:
-    """Set up the database and create the master sessionmaker."""
-    db_uri = "postgresql+psycopg2://{u}:{p}@{h}/scoreboard".format(
-        u=os.environ.get('SCOREBOARD_SCOREBOARD_DB_USERNAME', 'scoreboard'),
-        p=os.environ.get('SCOREBOARD_DB_PASSWORD', 'scoreboard'),
-        h=os.environ.get('SCOREBOARD_DB_HOST', 'localhost'),
-    )
+def serialise_sqlite_transactions(
+    session_factory: sqlalchemy.orm.session.sessionmaker
+) -> None:
+    """Make transactions in different threads take turns.
+
+    SQLite allows one writer at a time, and a transaction which has read and
+    then tries to write fails straight away if another connection has
+    written since. So when several threads use the database at once (import
+    workers, the streaming pipeline's stages), each session holds a lock from
+    its first statement until its transaction ends.
+    """
+
+    @sqlalchemy.event.listens_for(session_factory, "after_begin")
+    def after_begin(session, transaction, connection):  # type: ignore
+        if not session.info.get("sqlite_lock"):
+            _sqlite_lock.acquire()
+            session.info["sqlite_lock"] = True
+
+    @sqlalchemy.event.listens_for(session_factory, "after_transaction_end")
+    def after_transaction_end(session, transaction):  # type: ignore
+        if transaction.parent is None and session.info.pop("sqlite_lock", False):
+            _sqlite_lock.release()
+
+
+def setup_database(db_uri: Optional[str] = None) -> None:
+    """Set up the database and create the master sessionmaker.
+
+    Parameters:
+        db_uri: sqlalchemy database URI. Defaults to the postgres server
+            specified by the SCOREBOARD_DB_* environment variables.
+    """
+    if db_uri is None:
+        db_uri = "postgresql+psycopg2://{u}:{p}@{h}/scoreboard".format(
+            u=os.environ.get('SCOREBOARD_SCOREBOARD_DB_USERNAME', 'scoreboard'),
+            p=os.environ.get('SCOREBOARD_DB_PASSWORD', 'scoreboard'),
+            h=os.environ.get('SCOREBOARD_DB_HOST', 'localhost'),
+        )
     print("Connecting to {}".format(db_uri))
     engine_opts = {"poolclass": sqlalchemy.pool.NullPool}
     engine = sqlalchemy.create_engine(db_uri, **engine_opts)
 
     if db_uri.startswith("sqlite"):
         sqlalchemy.event.listen(engine, "connect", sqlite_performance_over_safety)
-
-    Base.metadata.create_all(engine)
+    querycount.install(engine)
 
     # Create the global session manager
     global Session  # pylint: disable=global-statement
     Session = sessionmaker(bind=engine)
+    if db_uri.startswith("sqlite"):
+        serialise_sqlite_transactions(Session)
 
-    sess = Session()
+    # If the database was set up with the same schema and constants, there's
+    # nothing to do
+    if _read_stamp() == setup_fingerprint():
+        return
+
+    Base.metadata.create_all(engine)
 
     if os.environ.get('SCOREBOARD_SKIP_DB_SETUP') == None:
+        seed_database()
+
+
+def _read_stamp() -> Optional[str]:
+    """Return the database's setup fingerprint, if it has one."""
+    sess = Session()
+    try:
+        stamp = sess.query(SchemaStamp).get("setup")
+        return stamp.fingerprint if stamp is not None else None
+    except sqlalchemy.exc.DBAPIError:
+        # No schema_stamp table yet
+        return None
+    finally:
+        sess.close()
+
+
+def seed_database() -> None:
+    """Add species, backgrounds, etc from constants to the database.
+
+    Safe to re-run, eg after reloading constants. Afterwards the database is
+    stamped with setup_fingerprint().
+    """
+    sess = Session()
+    try:
         model.setup_species(sess)
         model.setup_backgrounds(sess)
         model.setup_gods(sess)
         model.setup_branches(sess)
         model.setup_achievements(sess)
         model.setup_ktyps(sess)
+        model.setup_blacklists(sess)
+        model.setup_status_counters(sess)
+        sess.merge(
+            SchemaStamp(
+                name="setup",
+                fingerprint=setup_fingerprint(),
+                stamped=datetime.datetime.utcnow(),
+            )
+        )
+        sess.commit()
+    finally:
+        sess.close()
 
 
 def get_session() -> sqlalchemy.orm.session.Session:
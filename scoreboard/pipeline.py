@@ -0,0 +1,307 @@
+"""Streaming import -> score -> website pipeline (see loader.py --stream).
+
+The three stages run concurrently, connected by bounded queues:
+
+- import: as each source's games are committed, its watermark moves to the
+  end time of the oldest game in the commit, less watermark_margin. Once
+  every source has one, the oldest watermark is put on the scoring queue
+  (see log_import.PageImporter's on_commit).
+- score: scores the unscored games which ended by then, least->most recent,
+  and puts the names of the affected players on the website queue. Once
+  every source has finished, the rest are scored.
+- website: writes the pages of the affected players every batch_seconds.
+  Any scored game can change the streaks and global records, so the global
+  pages are rewritten too, but at most every global_interval seconds.
+
+Streaks depend on the order games are scored in. The APIs return games in
+the order they arrived, not the order they ended, so games are held back
+until every source has committed games which ended watermark_margin later.
+Games which arrive later than that are scored after newer ones, like games
+which arrive after a batch run has scored newer ones.
+
+So a game's player page is updated soon after every source has imported the
+games which ended up to watermark_margin after it, rather than after every
+source has been imported and every game scored.
+
+When a queue is full, the stage putting work on it waits, so a slow stage
+slows the ones before it instead of using more memory. If a stage fails, it
+keeps taking work from its queue (and dropping it) so the others can finish,
+and the error is raised by Pipeline.run. Whatever wasn't scored or written is
+picked up by the next run, like after a crash.
+"""
+
+import time
+import queue
+import datetime
+import threading
+import traceback
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from . import log_import
+from . import metrics
+from . import scoring
+from . import write_website
+
+# Batches of work each queue holds before the stage feeding it waits
+QUEUE_SIZE = 100
+# Seconds games can arrive out of end order in a source (see above)
+WATERMARK_MARGIN = 3600
+
+LATENCY = metrics.registry.histogram(
+    "scoreboard_pipeline_latency_seconds",
+    "Seconds from a game being imported to its player's page being written",
+    buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+QUEUE_DEPTH = metrics.registry.gauge(
+    "scoreboard_pipeline_queue_depth", "Most batches waiting in each queue"
+)
+
+# Put on a queue when the stage feeding it has finished
+_DONE = None
+
+
+class PipelineError(Exception):
+    """A pipeline stage failed."""
+
+    pass
+
+
+class Pipeline:
+    """Runs import, scoring and the website concurrently.
+
+    Parameters:
+        urlbase: website base URL (see write_website)
+        sources: the game sources being imported (api urls and logfile
+            paths, see log_import.import_sources)
+        players: player pages to write at the end as well as the affected
+            ones (see write_website's players: None means all of them)
+        extra_player_pages: see write_website
+        global_pages: write the global pages even if nothing is scored
+        scoring_batch_size: see scoring.score_games
+        batch_seconds: collect affected players for this long before
+            writing their pages
+        global_interval: minimum seconds between global page rewrites
+        watermark_margin: see WATERMARK_MARGIN
+        queue_size: see QUEUE_SIZE
+    """
+
+    def __init__(
+        self,
+        urlbase: Optional[str],
+        *,
+        sources: Iterable[str] = (),
+        players: Optional[Iterable[str]] = (),
+        extra_player_pages: int = 0,
+        global_pages: bool = True,
+        scoring_batch_size: int = 1000,
+        batch_seconds: float = 5,
+        global_interval: float = 60,
+        watermark_margin: float = WATERMARK_MARGIN,
+        queue_size: int = QUEUE_SIZE
+    ) -> None:
+        self.urlbase = urlbase
+        self.players = None if players is None else set(players)
+        self.extra_player_pages = extra_player_pages
+        self.global_pages = global_pages
+        self.scoring_batch_size = scoring_batch_size
+        self.batch_seconds = batch_seconds
+        self.global_interval = global_interval
+        self.watermark_margin = datetime.timedelta(seconds=watermark_margin)
+        # Oldest game end in each unfinished source's latest commit, less
+        # the margin, None until its first commit
+        self.watermarks = {
+            source: None for source in sources
+        }  # type: Dict[str, Optional[datetime.datetime]]
+        # Import time of the oldest commit not yet queued for scoring
+        self.unqueued_since = None  # type: Optional[float]
+        self.lock = threading.Lock()
+        # (import time of the oldest game, scoring watermark)
+        self.to_score = queue.Queue(queue_size)  # type: queue.Queue
+        # (import time of the oldest game, player names)
+        self.to_write = queue.Queue(queue_size)  # type: queue.Queue
+        self.errors = []  # type: List[Tuple[str, str]]
+        self.timings = {}  # type: dict
+        self.max_depth = {"score": 0, "website": 0}
+
+    def _put(self, q: queue.Queue, name: str, item: object) -> None:
+        """Put item on a queue, waiting if it's full."""
+        q.put(item)
+        self.max_depth[name] = max(self.max_depth[name], q.qsize())
+
+    def imported(self, source: str, rows: Sequence[tuple]) -> None:
+        """Note a source's committed game rows (see GAME_COLUMNS).
+
+        Pass as log_import's on_commit.
+        """
+        if not rows:
+            return
+        oldest = min(row[log_import.GAME_END_COLUMN] for row in rows)
+        with self.lock:
+            self.watermarks[source] = oldest - self.watermark_margin
+            if self.unqueued_since is None:
+                self.unqueued_since = time.time()
+            item = self._scoring_item()
+        if item is not None:
+            self._put(self.to_score, "score", item)
+
+    def source_done(self, source: str) -> None:
+        """Note that a source has finished importing.
+
+        Pass as log_import's on_done.
+        """
+        with self.lock:
+            self.watermarks.pop(source, None)
+            item = self._scoring_item()
+        if item is not None:
+            self._put(self.to_score, "score", item)
+
+    def _scoring_item(self) -> Optional[Tuple[float, datetime.datetime]]:
+        """Return the scoring queue item for the games committed before every
+        source's watermark, if there's anything new to score.
+
+        Call with lock held, and put the item on the queue after releasing
+        it, so import threads don't wait for each other while it's full.
+        """
+        if self.unqueued_since is None or not self.watermarks:
+            # Nothing new, or everything's scored once import finishes
+            return None
+        watermarks = self.watermarks.values()
+        if None in watermarks:
+            return None
+        item = (self.unqueued_since, min(watermarks))
+        self.unqueued_since = None
+        return item
+
+    def _failed(self, stage: str, q: Optional[queue.Queue]) -> None:
+        """Record a stage's error, and drop the rest of its input."""
+        print("Pipeline %s stage failed:" % stage)
+        self.errors.append((stage, traceback.format_exc()))
+        if q is not None:
+            while q.get() is not _DONE:
+                pass
+
+    def _score(self) -> None:
+        """Score the games imported, up to each watermark queued."""
+        start = time.time()
+        done = False
+        try:
+            while not done:
+                item = self.to_score.get()
+                done = item is _DONE
+                if done:
+                    # Every source has finished, score everything left
+                    imported, until = self.unqueued_since or start, None
+                else:
+                    imported, until = item
+                players = scoring.score_games(
+                    batch_size=self.scoring_batch_size, until=until
+                )
+                if players:
+                    self._put(self.to_write, "website", (imported, players))
+        except Exception:  # pylint: disable=broad-except
+            self._failed("score", None if done else self.to_score)
+        finally:
+            self.timings["score"] = time.time() - start
+            self.to_write.put(_DONE)
+
+    def _collect(self, deadline: float) -> Tuple[Optional[float], set, bool]:
+        """Collect affected players from the queue until deadline.
+
+        Returns the import time of the oldest game, the players, and whether
+        scoring has finished.
+        """
+        oldest = None  # type: Optional[float]
+        players = set()  # type: set
+        while True:
+            try:
+                item = self.to_write.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                return oldest, players, False
+            if item is _DONE:
+                return oldest, players, True
+            imported, names = item
+            oldest = imported if oldest is None else min(oldest, imported)
+            players.update(names)
+
+    def _write(self, players: Optional[set], global_pages: bool, last: bool) -> None:
+        """Write the website (see write_website)."""
+        write_website.write_website(
+            players=players,
+            urlbase=self.urlbase,
+            extra_player_pages=self.extra_player_pages if last else 0,
+            global_pages=global_pages,
+        )
+
+    def _website(self) -> None:
+        """Write the pages of affected players as they're scored."""
+        start = time.time()
+        last_global = 0.0
+        global_dirty = self.global_pages
+        done = False
+        try:
+            while not done:
+                oldest, players, done = self._collect(
+                    time.time() + self.batch_seconds
+                )
+                global_dirty = global_dirty or bool(players)
+                if done:
+                    # Write whatever was asked for on the command line too
+                    self._write(
+                        None if self.players is None else players | self.players,
+                        global_dirty,
+                        last=True,
+                    )
+                elif players:
+                    write_global = (
+                        global_dirty
+                        and time.time() - last_global >= self.global_interval
+                    )
+                    self._write(players, write_global, last=False)
+                    if write_global:
+                        last_global = time.time()
+                        global_dirty = False
+                if oldest is not None:
+                    LATENCY.observe(time.time() - oldest)
+        except Exception:  # pylint: disable=broad-except
+            self._failed("website", None if done else self.to_write)
+        finally:
+            self.timings["website"] = time.time() - start
+
+    def run(self, import_games: Callable[[Callable], object]) -> dict:
+        """Run the pipeline.
+
+        Parameters:
+            import_games: called with the on_commit and on_done callbacks,
+                imports the new games (eg log_import.import_sources)
+
+        Returns:
+            Seconds each stage took, by stage name.
+
+        Raises:
+            PipelineError: if any stage failed.
+        """
+        threads = [
+            threading.Thread(target=self._score, name="pipeline-score"),
+            threading.Thread(target=self._website, name="pipeline-website"),
+        ]
+        for thread in threads:
+            thread.start()
+        start = time.time()
+        try:
+            import_games(self.imported, self.source_done)
+        except Exception:  # pylint: disable=broad-except
+            self._failed("import", None)
+        finally:
+            self.timings["import"] = time.time() - start
+            self.to_score.put(_DONE)
+        for thread in threads:
+            thread.join()
+        for stage, seconds in self.timings.items():
+            metrics.STAGE_SECONDS.set(seconds, stage="pipeline." + stage)
+        for name, depth in self.max_depth.items():
+            QUEUE_DEPTH.set(depth, queue=name)
+        if self.errors:
+            raise PipelineError(
+                "\n".join("%s stage: %s" % error for error in self.errors)
+            )
+        return self.timings
@@ -0,0 +1,239 @@
+"""Opt-in profiling of pipeline stages (see loader.py --profile).
+
+Each profiled stage is run under cProfile and a sampling profiler, and
+written to the profile directory as:
+
+- STAGE.TIMESTAMP.pstats: cProfile stats, for pstats/snakeviz. cProfile only
+  sees the thread which runs the stage, not eg import worker threads.
+- STAGE.TIMESTAMP.collapsed: sampled stacks from all threads in the collapsed
+  format used by flamegraph.pl and speedscope.
+- STAGE.TIMESTAMP.tracemalloc.txt: if memory profiling is enabled, the
+  allocations which grew most during the stage.
+
+When profiled stages are nested, like website and website.index, only the
+outermost is run under cProfile.
+
+The player_page stage is different: it profiles each player page render,
+accumulating them into one profile which is written by `finish`.
+"""
+
+import os
+import sys
+import time
+import cProfile
+import threading
+import contextlib
+import collections
+import tracemalloc
+from typing import Dict, Iterable, Iterator, Optional
+
+# Stages which can be profiled
+STAGES = (
+    "import",
+    "score",
+    "website",
+    "website.setup_website_dir",
+    "website.index",
+    "website.404",
+    "website.streaks",
+    "website.highscores",
+    "website.player_pages",
+    "website.player_api",
+    "website.status",
+    "player_page",
+    "pipeline",
+)
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+# Allocation sites to list in tracemalloc diffs
+TRACEMALLOC_TOP = 50
+
+_enabled = frozenset()  # type: frozenset
+_directory = "profiles"
+_memory = False
+_accumulated = {}  # type: Dict[str, Profile]
+# Only one cProfile profiler can be active at once
+_cprofile_owner = None  # type: Optional[Profile]
+# Sampler threads, which aren't sampled
+_sampler_threads = set()  # type: set
+
+
+def configure(
+    stages: Iterable[str], directory: str = "profiles", memory: bool = False
+) -> None:
+    """Profile stages from now on.
+
+    Parameters:
+        stages: names of stages to profile, from STAGES
+        directory: where to write profiles
+        memory: also write tracemalloc diffs for each stage
+    """
+    global _enabled, _directory, _memory  # pylint: disable=global-statement
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError("Unknown stages: %s" % ", ".join(sorted(unknown)))
+    _enabled = frozenset(stages)
+    _directory = directory
+    _memory = memory
+
+
+def _frame_name(frame) -> str:  # type: ignore
+    """Return a frame's function as module:function."""
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return "%s:%s" % (module, code.co_name)
+
+
+class Sampler:
+    """Samples the stacks of all threads in a background thread."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL) -> None:
+        self.interval = interval
+        self.stacks = collections.Counter()  # type: collections.Counter
+        self.active = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        _sampler_threads.add(threading.get_ident())
+        try:
+            self._sample()
+        finally:
+            _sampler_threads.discard(threading.get_ident())
+
+    def _sample(self) -> None:
+        while not self.stopped.is_set():
+            self.active.wait()
+            if self.stopped.is_set():
+                break
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if thread_id in _sampler_threads:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, "thread"))
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def stop(self) -> None:
+        """Stop sampling for good."""
+        self.stopped.set()
+        self.active.set()
+        self.thread.join()
+
+    def collapsed(self) -> str:
+        """Return the samples in the collapsed stack format."""
+        return "".join(
+            "%s %s\n" % (stack, count) for stack, count in self.stacks.most_common()
+        )
+
+
+class Profile:
+    """cProfile, sampled stacks and optionally tracemalloc for one stage."""
+
+    def __init__(self, name: str, memory: bool) -> None:
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.cprofiled = False
+        self.sampler = Sampler()
+        self.memory = memory
+        self.snapshot = None  # type: Optional[tracemalloc.Snapshot]
+        self.started_tracing = False
+        self.memory_diff = None  # type: Optional[list]
+
+    def start(self) -> None:
+        """Start or resume profiling."""
+        if self.memory and self.snapshot is None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            self.snapshot = tracemalloc.take_snapshot()
+        self.sampler.active.set()
+        global _cprofile_owner  # pylint: disable=global-statement
+        if _cprofile_owner is None:
+            _cprofile_owner = self
+            self.cprofiled = True
+            self.profile.enable()
+
+    def pause(self) -> None:
+        """Pause profiling."""
+        global _cprofile_owner  # pylint: disable=global-statement
+        if _cprofile_owner is self:
+            self.profile.disable()
+            _cprofile_owner = None
+        self.sampler.active.clear()
+
+    def write(self, directory: str) -> None:
+        """Stop profiling and write the results."""
+        self.sampler.stop()
+        if self.snapshot is not None:
+            # Leave out the profiler's own allocations
+            ignore = [
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            ]
+            self.memory_diff = (
+                tracemalloc.take_snapshot()
+                .filter_traces(ignore)
+                .compare_to(self.snapshot.filter_traces(ignore), "lineno")
+            )
+            if self.started_tracing:
+                tracemalloc.stop()
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(
+            directory, "%s.%s" % (self.name, time.strftime("%Y%m%d-%H%M%S"))
+        )
+        if self.cprofiled:
+            self.profile.dump_stats(base + ".pstats")
+        with open(base + ".collapsed", "w") as f:
+            f.write(self.sampler.collapsed())
+        if self.memory_diff is not None:
+            with open(base + ".tracemalloc.txt", "w") as f:
+                for stat in self.memory_diff[:TRACEMALLOC_TOP]:
+                    f.write("%s\n" % stat)
+        print("Wrote %s profile to %s.*" % (self.name, base))
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Context manager to profile a stage, if it's enabled."""
+    if name not in _enabled:
+        yield
+        return
+    profile = Profile(name, _memory)
+    profile.start()
+    try:
+        yield
+    finally:
+        profile.pause()
+        profile.write(_directory)
+
+
+@contextlib.contextmanager
+def accumulate(name: str) -> Iterator[None]:
+    """Context manager to add a unit of work to a stage's profile.
+
+    The profile is written by `finish`. tracemalloc diffs aren't taken.
+    """
+    if name not in _enabled:
+        yield
+        return
+    if name not in _accumulated:
+        _accumulated[name] = Profile(name, memory=False)
+    profile = _accumulated[name]
+    profile.start()
+    try:
+        yield
+    finally:
+        profile.pause()
+
+
+def finish() -> None:
+    """Write accumulated profiles."""
+    for profile in _accumulated.values():
+        profile.write(_directory)
+    _accumulated.clear()
@@ -0,0 +1,248 @@
+"""Opt-in SQL query counting, to find chatty code like hidden lazy loads.
+
+Set SCOREBOARD_QUERY_REPORT to count every statement sent to the database
+(see orm.setup_database), along with the time it took. Statements are counted
+per pipeline stage (see `stage`), per unit of work such as a game scored or a
+page rendered (see `unit`), and by their SQL with literals and parameters
+replaced by ?, so the same query issued once per game shows up as one line
+with a large count.
+
+A warning is printed whenever a unit of work issues more statements than its
+budget, which defaults to UNIT_BUDGETS and can be overridden for all units
+with SCOREBOARD_QUERY_BUDGET.
+
+Statements issued while no unit is active, such as the flushes when a batch
+is committed, are only counted against the stage.
+"""
+
+import os
+import re
+import time
+import functools
+import threading
+import contextlib
+import collections
+from typing import Dict, Iterator, Optional
+
+import sqlalchemy
+
+ENABLED = os.environ.get("SCOREBOARD_QUERY_REPORT") is not None
+# Statements a single unit of work may issue before a warning is printed
+UNIT_BUDGETS = {"game": 20, "page": 40, "player_api": 5}
+DEFAULT_BUDGET = 20
+# Warnings printed per unit kind before they're only counted
+BUDGET_WARNING_LIMIT = 10
+# Statements shown in the summary
+SUMMARY_STATEMENTS = 15
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAMETER = re.compile(r"%\(\w+\)s|:\w+|\?")
+_IN_LIST = re.compile(r"\bIN \((?:\?, )+\?\)", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=4096)
+def normalise(statement: str) -> str:
+    """Replace a statement's literals and parameters with ?.
+
+    IN lists of any length become IN (...), and whitespace is collapsed.
+    """
+    statement = _STRING_LITERAL.sub("?", statement)
+    statement = _PARAMETER.sub("?", statement)
+    statement = _NUMBER_LITERAL.sub("?", statement)
+    statement = _IN_LIST.sub("IN (...)", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+class QueryStats:
+    """Number of statements and the seconds they took."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+
+    def add(self, seconds: float) -> None:
+        """Count a statement."""
+        self.count += 1
+        self.seconds += seconds
+
+
+class UnitStats:
+    """Statements issued by units of work of one kind."""
+
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.units = 0
+        self.queries = 0
+        self.seconds = 0.0
+        self.max_queries = 0
+        self.worst = None  # type: Optional[str]
+        self.over_budget = 0
+
+    def add(self, key: str, unit: QueryStats) -> bool:
+        """Count a finished unit of work.
+
+        Returns True if it was over budget.
+        """
+        self.units += 1
+        self.queries += unit.count
+        self.seconds += unit.seconds
+        if unit.count > self.max_queries:
+            self.max_queries = unit.count
+            self.worst = key
+        if unit.count > self.budget:
+            self.over_budget += 1
+            return True
+        return False
+
+
+class QueryCounter:
+    """Counts statements executed on the engines it's installed on."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.stage = "other"
+        self.stages = collections.OrderedDict()  # type: Dict[str, QueryStats]
+        self.statements = {}  # type: Dict[str, QueryStats]
+        self.units = collections.OrderedDict()  # type: Dict[str, UnitStats]
+        self.local = threading.local()
+
+    def install(self, engine: sqlalchemy.engine.Engine) -> None:
+        """Count statements executed on engine."""
+        sqlalchemy.event.listen(
+            engine, "before_cursor_execute", self._before_cursor_execute
+        )
+        sqlalchemy.event.listen(
+            engine, "after_cursor_execute", self._after_cursor_execute
+        )
+
+    def _before_cursor_execute(  # type: ignore
+        self, conn, cursor, statement, parameters, context, executemany
+    ) -> None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def _after_cursor_execute(  # type: ignore
+        self, conn, cursor, statement, parameters, context, executemany
+    ) -> None:
+        seconds = time.perf_counter() - conn.info["query_start"].pop()
+        unit = getattr(self.local, "unit", None)
+        if unit is not None:
+            unit.add(seconds)
+        sql = normalise(statement)
+        with self.lock:
+            if self.stage not in self.stages:
+                self.stages[self.stage] = QueryStats()
+            self.stages[self.stage].add(seconds)
+            if sql not in self.statements:
+                self.statements[sql] = QueryStats()
+            self.statements[sql].add(seconds)
+
+    @contextlib.contextmanager
+    def count_stage(self, name: str) -> Iterator[None]:
+        """Count statements from all threads against the stage name."""
+        previous = self.stage
+        self.stage = name
+        try:
+            yield
+        finally:
+            self.stage = previous
+
+    @contextlib.contextmanager
+    def count_unit(self, kind: str, key: str) -> Iterator[None]:
+        """Count statements from this thread against a unit of work."""
+        unit = QueryStats()
+        self.local.unit = unit
+        try:
+            yield
+        finally:
+            self.local.unit = None
+            with self.lock:
+                if kind not in self.units:
+                    budget = os.environ.get("SCOREBOARD_QUERY_BUDGET")
+                    self.units[kind] = UnitStats(
+                        int(budget)
+                        if budget
+                        else UNIT_BUDGETS.get(kind, DEFAULT_BUDGET)
+                    )
+                stats = self.units[kind]
+                over_budget = stats.add(key, unit)
+            if over_budget and stats.over_budget <= BUDGET_WARNING_LIMIT:
+                print(
+                    "Warning: %s %s issued %s queries (budget %s) in %.3f secs"
+                    % (kind, key, unit.count, stats.budget, unit.seconds)
+                )
+
+    def summary(self) -> str:
+        """Return a summary table of the statements counted."""
+        lines = ["%-28s %10s %10s" % ("stage", "queries", "secs")]
+        for name, stats in self.stages.items():
+            lines.append("%-28s %10d %10.2f" % (name, stats.count, stats.seconds))
+        lines.append("")
+        lines.append(
+            "%-12s %8s %10s %8s %8s %8s  %s"
+            % ("unit", "units", "queries", "avg", "max", "over", "worst")
+        )
+        for kind, unit_stats in self.units.items():
+            lines.append(
+                "%-12s %8d %10d %8.1f %8d %8d  %s"
+                % (
+                    kind,
+                    unit_stats.units,
+                    unit_stats.queries,
+                    unit_stats.queries / max(1, unit_stats.units),
+                    unit_stats.max_queries,
+                    unit_stats.over_budget,
+                    unit_stats.worst,
+                )
+            )
+        lines.append("")
+        lines.append("%10s %10s  %s" % ("queries", "secs", "statement"))
+        statements = sorted(
+            self.statements.items(), key=lambda item: item[1].seconds, reverse=True
+        )
+        for sql, stats in statements[:SUMMARY_STATEMENTS]:
+            lines.append("%10d %10.2f  %s" % (stats.count, stats.seconds, sql[:200]))
+        return "\n".join(lines)
+
+
+counter = QueryCounter()
+
+
+def install(engine: sqlalchemy.engine.Engine) -> None:
+    """Count statements executed on engine, if enabled."""
+    if ENABLED:
+        counter.install(engine)
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Context manager to count statements against a pipeline stage."""
+    if not ENABLED:
+        yield
+        return
+    with counter.count_stage(name):
+        yield
+
+
+@contextlib.contextmanager
+def unit(kind: str, key: str) -> Iterator[None]:
+    """Context manager to count statements against a unit of work.
+
+    Parameters:
+        kind: kind of unit, eg "game" or "page"
+        key: which unit this is, eg the game's gid
+    """
+    if not ENABLED:
+        yield
+        return
+    with counter.count_unit(kind, key):
+        yield
+
+
+def report() -> None:
+    """Print the summary table, if enabled."""
+    if ENABLED:
+        print()
+        print("Database queries:")
+        print(counter.summary())
@@ -1,11 +1,21 @@
 """Take game data and figure out scoring."""
 
 import time
+import datetime
+from typing import Optional
 
 import sqlalchemy.orm  # for sqlalchemy.orm.session.Session type hints
 
+import scoreboard.metrics as metrics
 import scoreboard.model as model
 import scoreboard.orm as orm
+import scoreboard.querycount as querycount
+import scoreboard.util as util
+
+SCORED = metrics.registry.counter("scoreboard_scored_games_total", "Games scored")
+SCORING_RATE = metrics.registry.gauge(
+    "scoreboard_scoring_games_per_second", "Scoring throughput"
+)
 
 
 def is_valid_streak_addition(game: orm.Game, current_streak: orm.Streak) -> bool:
@@ -60,6 +70,11 @@ def handle_player_streak(s: sqlalchemy.orm.session.Session, game: orm.Game) -> N
             if not is_valid_streak_addition(game, current_streak):
                 return
         game.streak = current_streak
+        current_streak.length += 1
+        if current_streak.start is None:
+            current_streak.start = game.start
+        current_streak.last_win_end = game.end
+        s.add(current_streak)
 
     else:  # Game wasn't won
         # If there is no active streak, we're done
@@ -70,6 +85,7 @@ def handle_player_streak(s: sqlalchemy.orm.session.Session, game: orm.Game) -> N
             return
         # If the game is a non-grief loss, close the active streak
         current_streak.active = False
+        current_streak.breaker_gid = game.gid
         s.add(current_streak)
 
 
@@ -87,31 +103,59 @@ def score_game(s: sqlalchemy.orm.session.Session, game: orm.Game) -> None:
     handle_player_streak(s, game)
 
 
-def score_games() -> set:
-    """Score all unscored games."""
+def _score_and_mark(s: sqlalchemy.orm.session.Session, game: orm.Game) -> str:
+    """Score a game and mark it scored.
+
+    Returns the game's player's name.
+    """
+    with querycount.unit("game", game.gid):
+        score_game(s, game)
+        game.scored = True
+        s.add(game)
+        return game.player.name
+
+
+def score_games(
+    batch_size: int = 1000, until: Optional[datetime.datetime] = None
+) -> set:
+    """Score all unscored games, least->most recent.
+
+    Parameters:
+        batch_size: number of games to score per transaction
+        until: if specified, only score games which ended at or before this
+            (see pipeline)
+    """
     start = time.time()
     scored_players = set()
     s = orm.get_session()
     new_scored = 0
     print("Scoring games...")
-    while True:
-        games = model.list_games(s, scored=False, limit=100, reverse_order=True)
-        if not games:
-            break
-        for game in games:
-            score_game(s, game)
-            game.scored = True
-            s.add(game)
-            scored_players.add(game.player.name)
-            new_scored += 1
-            if new_scored and new_scored % 10000 == 0:
-                print(new_scored)
-        s.commit()
+    try:
+        with util.memory_report("score_games") as note_session:
+            for games in model.iter_game_batches(
+                s, scored=False, until=until, batch_size=batch_size
+            ):
+                for game in games:
+                    scored_players.add(_score_and_mark(s, game))
+                    new_scored += 1
+                    if new_scored and new_scored % 10000 == 0:
+                        print(new_scored)
+                model.adjust_status_counter(s, model.UNSCORED_GAMES, -len(games))
+                s.commit()
+                note_session(s)
+                # Each batch is its own unit of work -- drop everything it
+                # loaded
+                s.expunge_all()
+    finally:
+        s.close()
 
     end = time.time()
+    SCORED.inc(new_scored)
+    SCORING_RATE.set(new_scored / (end - start) if end > start else 0.0)
     print(
         "Scored %s new games (for %s players) in %s secs"
         % (new_scored, len(scored_players), round(end - start, 2))
     )
 
     return scored_players
+
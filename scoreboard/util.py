@@ -1,49 +1,79 @@
 """Little helper tidbits."""
 
+import os
 import time
-from typing import Callable
+import contextlib
+import tracemalloc
+from typing import Callable, Iterator
+
+import scoreboard.metrics as metrics
 
 
 def timer(func: Callable) -> Callable:
-    """Decorator to wrap a function and print how long it took."""
+    """Decorator to wrap a function and record how long it took.
+
+    The duration is printed, and recorded as a stage in metrics.
+    """
 
     def wrapper(*arg, **kw):  # type: ignore
-        """Call a function, print the duration."""
+        """Call a function, record the duration."""
         t1 = time.time()
         res = func(*arg, **kw)
-        print(
-            "{name} took {dur:.4} secs".format(name=func.__name__, dur=time.time() - t1)
-        )
+        dur = time.time() - t1
+        metrics.STAGE_SECONDS.set(dur, stage=func.__name__)
+        print("{name} took {dur:.4} secs".format(name=func.__name__, dur=dur))
         return res
 
     return wrapper
 
 
-def retry(max_tries: int, wait: int = 0) -> Callable:
-    """Decorator to add basic retry functionality."""
-
-    def retry_decorator(func: Callable) -> Callable:
-        def wrapper(*args, **kwargs):
-            """Call a function, retry if it fails, waiting some amount of time.
-
-            If we hit the retry limit and the function still fails, pass up the
-            exception.
-            """
-            tries = 0
-            while True:
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    tries += 1
-                    if tries >= max_tries:
-                        raise
-                    else:
-                        print(
-                            "%s failed (%s), waiting %d secs and retrying"
-                            % (func.__name__, e, wait)
-                        )
-                        time.sleep(wait)
-
-        return wrapper
-
-    return retry_decorator
+@contextlib.contextmanager
+def stage_timer(timings: dict, stage: str) -> Iterator[None]:
+    """Context manager to record how long a stage takes in timings[stage]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def memory_report(stage: str) -> Iterator[Callable]:
+    """Context manager to print the peak memory use of a pipeline stage.
+
+    Yields a function which the stage should call with its session at the end
+    of each unit of work, so the largest identity map is reported too.
+
+    Does nothing unless SCOREBOARD_MEMORY_REPORT is set, since tracemalloc
+    slows everything down considerably.
+    """
+    enabled = os.environ.get("SCOREBOARD_MEMORY_REPORT") is not None
+    identity_map_sizes = [0]
+
+    def note_session(s):  # type: ignore
+        """Record the size of a session's identity map."""
+        if enabled:
+            identity_map_sizes.append(len(s.identity_map))
+
+    if not enabled:
+        yield note_session
+        return
+
+    # Restart tracing to reset the peak
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    tracemalloc.start()
+    try:
+        yield note_session
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            "{stage} memory: peak {peak:.1f} MiB, current {current:.1f} MiB, "
+            "largest identity map {objects} objects".format(
+                stage=stage,
+                peak=peak / 2 ** 20,
+                current=current / 2 ** 20,
+                objects=max(identity_map_sizes),
+            )
+        )
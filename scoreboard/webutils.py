@@ -284,14 +284,18 @@ def streakstotable(
                 player_url=streak.player.url_name, player_name=streak.player.name
             )
         if show_loss:
-            loss = "<td>%s</td>" % "TODO"
+            loss = "<td>%s</td>" % (
+                morgue_link(streak.breaker, streak.breaker.char)
+                if streak.breaker
+                else ""
+            )
 
         games_list = ", ".join(morgue_link(g, g.char) for g in streak.games)
-        start_date = prettydate(streak.games[0].start)
-        end_date = prettydate(streak.games[-1].end)
+        start_date = prettydate(streak.start)
+        end_date = prettydate(streak.last_win_end)
 
         return trow.format(
-            wins=len(streak.games),
+            wins=streak.length,
             player=player,
             games=games_list,
             start=start_date,
@@ -5,27 +5,60 @@ import json
 import time
 import datetime
 import subprocess
+import contextlib
 import collections
 import random
 import shutil
 import sys
 
-from typing import Iterable, Optional, Sequence
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
 
 import jsmin
 import jinja2
 import sqlalchemy.orm  # for sqlalchemy.orm.session.Session type hints
 
+from . import metrics
 from . import model
 from . import webutils
 from . import orm
+from . import profiling
+from . import querycount
+from . import util
 from . import constants as const
 
 WEBSITE_DIR = os.environ.get('SCOREBOARD_WEBSITE_PATH', "website")
+# Number of player pages to write between page_updated flushes
+PLAYER_PAGE_CHUNK_SIZE = 500
+# Player pages not updated for this long are counted as stale in status.json
+STALE_PLAYER_PAGE_AGE = datetime.timedelta(days=7)
+
+# Kept between write_website calls when running as a daemon. See clear_cache.
+_cache = {}  # type: dict
+
+PAGES_RENDERED = metrics.registry.counter(
+    "scoreboard_pages_rendered_total", "Website files rendered, by directory"
+)
+BYTES_WRITTEN = metrics.registry.counter(
+    "scoreboard_bytes_written_total", "Bytes of website files written"
+)
+WRITES_SKIPPED = metrics.registry.counter(
+    "scoreboard_writes_skipped_total",
+    "Website files not written because they hadn't changed, by directory",
+)
+UNSCORED_GAMES = metrics.registry.gauge(
+    "scoreboard_unscored_games", "Games imported but not scored yet"
+)
+NEWEST_GAME_AGE = metrics.registry.gauge(
+    "scoreboard_newest_game_age_seconds", "Seconds since the newest game ended"
+)
+STALE_PLAYER_PAGES = metrics.registry.gauge(
+    "scoreboard_stale_player_pages",
+    "Player pages not updated within STALE_PLAYER_PAGE_AGE",
+)
 
 
 def rsync_replacement(src: str, dst: str) -> None:
-    """Poor replacement for rsync on win32.
+    """Poor replacement for rsync on win32 (or if rsync isn't installed).
 
     Needed because shutil.copytree can't handle already existing dest dir.
     """
@@ -41,14 +74,51 @@ def rsync_replacement(src: str, dst: str) -> None:
 
 
 def _write_file(*, path: str, data: str) -> None:
-    """Write a file."""
-    with open(path, "w", encoding="utf8") as f:
-        f.write(data)
+    """Write a file, unless it already has the same contents."""
+    encoded = data.encode("utf8")
+    directory = os.path.relpath(os.path.dirname(path), WEBSITE_DIR)
+    PAGES_RENDERED.inc(dir=directory)
+    try:
+        if os.path.getsize(path) == len(encoded):
+            with open(path, "rb") as f:
+                if f.read() == encoded:
+                    WRITES_SKIPPED.inc(dir=directory)
+                    return
+    except OSError:
+        pass
+    with open(path, "wb") as f:
+        f.write(encoded)
+    BYTES_WRITTEN.inc(len(encoded))
+
+
+def clear_cache() -> None:
+    """Forget the template environment and global records.
+
+    Needed if constants or templates change.
+    """
+    _cache.clear()
 
 
 def jinja_env(
     urlbase: Optional[str], s: sqlalchemy.orm.session.Session
 ) -> jinja2.environment.Environment:
+    """Create the Jinja template environment, or update the cached one.
+
+    The environment is reused between calls with the same urlbase, so
+    templates are only compiled once.
+    """
+    if _cache.get("env_urlbase", False) != urlbase:
+        _cache["env"] = _new_jinja_env(urlbase)
+        _cache["env_urlbase"] = urlbase
+    env = _cache["env"]
+    env.globals["playable_species"] = model.list_species(s, playable=True)
+    env.globals["playable_backgrounds"] = model.list_backgrounds(s, playable=True)
+    env.globals["playable_gods"] = model.list_gods(s, playable=True)
+    env.globals["current_time"] = datetime.datetime.utcnow()
+    return env
+
+
+def _new_jinja_env(urlbase: Optional[str]) -> jinja2.environment.Environment:
     """Create the Jinja template environment."""
     template_path = os.path.join(os.path.dirname(__file__), "html_templates")
     env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_path))
@@ -76,10 +146,6 @@ def jinja_env(
     ] = webutils.background_highscores_to_table
 
     env.globals["tableclasses"] = const.TABLE_CLASSES
-    env.globals["playable_species"] = model.list_species(s, playable=True)
-    env.globals["playable_backgrounds"] = model.list_backgrounds(s, playable=True)
-    env.globals["playable_gods"] = model.list_gods(s, playable=True)
-    env.globals["current_time"] = datetime.datetime.utcnow()
 
     if urlbase:
         env.globals["urlbase"] = urlbase
@@ -96,7 +162,7 @@ def _mkdir(path: str) -> None:
 
 
 def setup_website_dir(
-    env: jinja2.environment.Environment, path: str, all_players: Iterable
+    env: jinja2.environment.Environment, path: str, all_player_names: Iterable[str]
 ) -> None:
     """Create the website dir and add static content."""
     print("Writing HTML to %s" % path)
@@ -106,11 +172,12 @@ def setup_website_dir(
     _mkdir(os.path.join(path, "api", "1"))
     _mkdir(os.path.join(path, "api", "1", "player"))
     _mkdir(os.path.join(path, "api", "1", "player", "wins"))
+    _mkdir(os.path.join(path, "api", "1", "player", "milestones"))
 
     print("Copying static assets")
     src = os.path.join(os.path.dirname(__file__), "html_static")
     dst = os.path.join(path, "static")
-    if sys.platform != "win32":
+    if sys.platform != "win32" and shutil.which("rsync"):
         subprocess.run(["rsync", "-a", src + "/", dst + "/"])
     else:
         rsync_replacement(src, dst)
@@ -118,7 +185,7 @@ def setup_website_dir(
     print("Generating player list")
     _write_file(
         path=os.path.join(dst, "js", "players.json"),
-        data=json.dumps([p.name for p in all_players]),
+        data=json.dumps(list(all_player_names)),
     )
 
     print("Writing minified local JS")
@@ -320,50 +387,197 @@ def write_player_page(player_html_path: str, name: str, data: str) -> None:
     _write_file(path=os.path.join(player_html_path, name + ".html"), data=data)
 
 
+def _player_chunks(
+    player_ids: Sequence[int]
+) -> Iterator[Tuple[sqlalchemy.orm.session.Session, Sequence[orm.Player]]]:
+    """Load players in chunks, each chunk in a fresh session.
+
+    Yields (session, players) tuples. Each chunk's session is committed and
+    closed once the caller is done with it, so memory use is bounded by the
+    chunk size rather than the total number of players.
+    """
+    for i in range(0, len(player_ids), PLAYER_PAGE_CHUNK_SIZE):
+        s = orm.get_session()
+        try:
+            yield s, model.list_players(
+                s, ids=player_ids[i : i + PLAYER_PAGE_CHUNK_SIZE]
+            )
+            s.commit()
+        finally:
+            s.close()
+
+
+def _global_records(s: sqlalchemy.orm.session.Session, cached: bool) -> dict:
+    """Return model.get_gobal_records, cached between calls if cached is True.
+
+    The cached games are detached from s, so they stay usable after s is
+    closed.
+    """
+    if cached and "global_records" in _cache:
+        return _cache["global_records"]
+    global_records = model.get_gobal_records(s)
+    for games in global_records.values():
+        for game in games:
+            # Load what _get_player_records uses before detaching
+            for obj in (game.player, game):
+                if obj in s:
+                    s.expunge(obj)
+    _cache["global_records"] = global_records
+    return global_records
+
+
 def write_player_pages(
     s: sqlalchemy.orm.session.Session,
     env: jinja2.environment.Environment,
-    players: Sequence,
+    player_ids: Sequence[int],
+    global_records: Optional[dict] = None,
 ) -> None:
     """Write all player pages."""
-    print("Writing %s player pages... " % len(players))
+    print("Writing %s player pages... " % len(player_ids))
     start2 = time.time()
     player_html_path = os.path.join(WEBSITE_DIR, "players")
     if not os.path.exists(player_html_path):
         os.mkdir(player_html_path)
-    global_records = model.get_gobal_records(s)
+    if global_records is None:
+        global_records = model.get_gobal_records(s)
     template = env.get_template("player.html")
 
     n = 0
-    for player in players:
-        data = render_player_page(s, template, player, global_records)
-        write_player_page(player_html_path, player.url_name, data)
-        model.updated_player_page(s, player)
-        n += 1
-        if not n % 100:
-            print(n)
-    s.commit()
+    with util.memory_report("write_player_pages") as note_session:
+        for chunk_session, players in _player_chunks(player_ids):
+            for player in players:
+                with querycount.unit("page", player.name), profiling.accumulate(
+                    "player_page"
+                ):
+                    data = render_player_page(
+                        chunk_session, template, player, global_records
+                    )
+                write_player_page(player_html_path, player.url_name, data)
+                n += 1
+                if not n % 100:
+                    print(n)
+            model.updated_player_pages(chunk_session, [p.id for p in players])
+            note_session(chunk_session)
     end = time.time()
     print("Wrote player pages in %s seconds" % round(end - start2, 2))
 
 
 def write_player_api(
-    s: sqlalchemy.orm.session.Session,
-    env: jinja2.environment.Environment,
-    players: Sequence,
+    env: jinja2.environment.Environment, player_ids: Sequence[int]
 ) -> None:
-    """Write all player API pages."""
+    """Write all player API pages.
+
+    Milestone aggregates (see log_import.load_milestones) are only
+    rewritten along with a player's other pages.
+    """
     print("Writing player API pages")
-    for player in players:
-        won_games = model.list_games(s, player=player, winning=True)
-        data = json.dumps([g.as_dict() for g in won_games], sort_keys=True, indent=2)
-        path = os.path.join(WEBSITE_DIR, "api", "1", "player", "wins", player.url_name)
-        _write_file(path=path, data=data)
+    for s, players in _player_chunks(player_ids):
+        for player in players:
+            with querycount.unit("player_api", player.name):
+                files = {
+                    "wins": model.list_games(s, player=player, winning=True),
+                    "milestones": model.get_milestone_aggregates(s, player.name),
+                }
+                for directory, records in files.items():
+                    files[directory] = json.dumps(
+                        [r.as_dict() for r in records], sort_keys=True, indent=2
+                    )
+            for directory, data in files.items():
+                path = os.path.join(
+                    WEBSITE_DIR, "api", "1", "player", directory, player.url_name
+                )
+                _write_file(path=path, data=data)
+
+
+def _least_recently_updated(
+    s: sqlalchemy.orm.session.Session, num: int, exclude: set
+) -> Sequence[orm.Player]:
+    """Return num players with the oldest pages whose id isn't in exclude."""
+    out = []  # type: list
+    after = None
+    while len(out) < num:
+        batch = model.get_old_player_pages(s, num, after=after)
+        if not batch:
+            break
+        out.extend(p for p in batch if p.id not in exclude)
+        after = (batch[-1].page_updated, batch[-1].id)
+    return out[:num]
+
+
+def write_status(s: sqlalchemy.orm.session.Session) -> None:
+    """Write api/1/status.json, for monitoring how up to date the site is.
+
+    Contains:
+        sources: the key of the next event to import, by source url
+        newest_game_end: end time (UTC) of the newest game imported
+        unscored_games: number of games imported but not scored yet
+        stale_player_pages: number of player pages last updated more than
+            stale_player_page_age seconds ago
+        stage_seconds: seconds the latest run of each stage took
+
+    Only cheap, indexed queries are used (see model.get_status_counters).
+    """
+    now = datetime.datetime.utcnow()
+    newest_end = model.newest_game_end(s)
+    unscored = model.get_status_counters(s).get(model.UNSCORED_GAMES)
+    # page_updated is local time
+    stale = model.count_stale_player_pages(
+        s, datetime.datetime.now() - STALE_PLAYER_PAGE_AGE
+    )
+    if newest_end is not None:
+        NEWEST_GAME_AGE.set((now - newest_end).total_seconds())
+    if unscored is not None:
+        UNSCORED_GAMES.set(unscored)
+    STALE_PLAYER_PAGES.set(stale)
+    status = collections.OrderedDict(
+        [
+            ("generated", now.isoformat() + "Z"),
+            (
+                "sources",
+                collections.OrderedDict(
+                    (progress.source_url, progress.current_key)
+                    for progress in model.list_logfile_progress(s)
+                ),
+            ),
+            (
+                "newest_game_end",
+                newest_end.isoformat() + "Z" if newest_end is not None else None,
+            ),
+            ("unscored_games", unscored),
+            ("stale_player_pages", stale),
+            ("stale_player_page_age", STALE_PLAYER_PAGE_AGE.total_seconds()),
+            ("stage_seconds", metrics.STAGE_SECONDS.by_label("stage")),
+        ]
+    )
+    _write_file(
+        path=os.path.join(WEBSITE_DIR, "api", "1", "status.json"),
+        data=json.dumps(status, indent=2),
+    )
+
+
+@contextlib.contextmanager
+def _stage(
+    timings: dict, stage: str, s: sqlalchemy.orm.session.Session
+) -> Iterator[None]:
+    """Time, count the queries of, and maybe profile a write_website stage.
+
+    s's transaction is ended after the stage, so it isn't held (and on
+    SQLite, other threads aren't kept waiting) for the whole website.
+    """
+    name = "website." + stage
+    with util.stage_timer(timings, stage), querycount.stage(name), metrics.stage(
+        name
+    ), profiling.stage(name):
+        yield
+        s.commit()
 
 
 def write_website(
-    players: Optional[Iterable], urlbase: str, extra_player_pages: int
-) -> None:
+    players: Optional[Iterable],
+    urlbase: str,
+    extra_player_pages: int,
+    global_pages: bool = True,
+) -> dict:
     """Write all website files.
 
     Paramers:
@@ -373,42 +587,69 @@ def write_website(
             If you pass in None, all player pages will be rebuilt.
             If you pass in any other false value, no player pages will be
               rebuilt.
+        global_pages (bool) Write the index, streaks and highscores pages.
+            Pass False if no games have been scored since the last call,
+            and the global records from the last call will be reused too.
+
+    Returns:
+        Seconds taken by each stage, by stage name.
     """
     start = time.time()
+    timings = collections.OrderedDict()  # type: collections.OrderedDict
 
     s = orm.get_session()
+    try:
+        env = jinja_env(urlbase, s)
 
-    env = jinja_env(urlbase, s)
-
-    # We need the list of all players to generate players.json
-    all_players = sorted(model.list_players(s), key=lambda p: p.name)
+        # We need the list of all players to generate players.json
+        all_player_names = sorted(model.list_player_names(s))
 
-    # Figure out what player pages to generate
-    if players is None:
-        players = all_players
-    else:
-        if not players:
-            players = []
+        # Figure out what player pages to generate
+        if players is None:
+            player_ids = list(model.list_player_ids(s))
         else:
-            players = [model.get_player(s, p) for p in players]
-        if extra_player_pages:
-            extra_players = model.get_old_player_pages(s, extra_player_pages)
-            players.extend(p for p in extra_players if p not in players)
-    # Randomise order
-    random.shuffle(players)
-
-    setup_website_dir(env, WEBSITE_DIR, all_players)
-
-    write_index(s, env)
-
-    write_404(env)
-
-    write_streaks(s, env)
-
-    write_highscores(s, env)
-
-    write_player_pages(s, env, players)
-
-    write_player_api(s, env, players)
-
+            if not players:
+                player_ids = []
+            else:
+                player_ids = [model.get_player(s, p).id for p in players]
+            if extra_player_pages:
+                player_ids.extend(
+                    p.id
+                    for p in _least_recently_updated(
+                        s, extra_player_pages, exclude=set(player_ids)
+                    )
+                )
+        # Randomise order
+        random.shuffle(player_ids)
+        s.commit()
+
+        with _stage(timings, "setup_website_dir", s):
+            setup_website_dir(env, WEBSITE_DIR, all_player_names)
+
+        if global_pages:
+            with _stage(timings, "index", s):
+                write_index(s, env)
+
+            with _stage(timings, "404", s):
+                write_404(env)
+
+            with _stage(timings, "streaks", s):
+                write_streaks(s, env)
+
+            with _stage(timings, "highscores", s):
+                write_highscores(s, env)
+
+        with _stage(timings, "player_pages", s):
+            global_records = _global_records(s, cached=not global_pages)
+            s.commit()
+            write_player_pages(s, env, player_ids, global_records)
+
+        with _stage(timings, "player_api", s):
+            write_player_api(env, player_ids)
+
+        with _stage(timings, "status", s):
+            write_status(s)
+    finally:
+        s.close()
     print("Wrote website in %s seconds" % round(time.time() - start, 2))
+    return timings